@@ -0,0 +1,156 @@
+import os
+import json
+import argparse
+import torch
+import torch.nn as nn
+from torch.utils.flop_counter import FlopCounterMode
+from model.model import EncoderDecoder, DecoderRNN
+from model.backbones import BACKBONES, hub_weights_filename
+from get_loader import load_or_build_vocabulary
+from feature_cache import get_feature_loader
+from benchmark import time_stage
+from quantize import model_size_mb
+from train import train
+from test import corpus_test_BLEU
+
+'''
+Compares the encoder backbones of model/backbones.py on the same decoder. For every backbone:
+
+    gflops        forward FLOPs of the trunk per image
+    images_per_s  throughput of the encoder (trunk + embed) on batches of batch_size images
+    weights_mb    serialized size of the encoder weights
+    activation_mb memory of the intermediate outputs of the trunk for one batch
+    BLEU-1..4     corpus BLEU on the test split after training the decoder for `epochs` epochs
+
+The trunks are frozen, so their features are extracted once (feature_cache.py) and the decoders,
+all initialized from the same seed, are trained on them:
+
+    python backbone_report.py --data-dir data/Images --train-csv train.csv --test-csv test.csv \
+        --backbones resnet18 resnet50 mobilenet_v3_large efficientnet_b0 --weights-dir ~/.cache/torch/hub/checkpoints
+
+--weights-dir is a folder with the weights of every requested backbone, either under their name
+in the torchvision cache (e.g. resnet18-f37072fd.pth, see model.backbones.hub_weights_filename)
+or as <backbone>.pth. Nothing is downloaded then, a missing file is an error.
+'''
+
+
+def gflops_per_image(trunk, image_size=224):
+    counter = FlopCounterMode(display=False)
+    with torch.no_grad(), counter:
+        trunk(torch.zeros(1, 3, image_size, image_size))
+    return counter.get_total_flops() / 1e9
+
+
+# Sum of the outputs of the leaf modules of the trunk for one forward pass on images, in MB
+def activation_mb(trunk, images):
+    total = [0]
+
+    def hook(module, inputs, output):
+        if torch.is_tensor(output):
+            total[0] += output.numel() * output.element_size()
+
+    handles = [module.register_forward_hook(hook) for module in trunk.modules() if not list(module.children())]
+    with torch.no_grad():
+        trunk(images)
+    for handle in handles:
+        handle.remove()
+    return total[0] / 1024 ** 2
+
+
+def encoder_images_per_s(encoder, batch_size=16, image_size=224, device='cpu', runs=10):
+    images = torch.randn(batch_size, 3, image_size, image_size, device=device)
+    sync = torch.cuda.synchronize if torch.device(device).type == 'cuda' else None
+    with torch.no_grad():
+        result = time_stage(lambda: encoder(images), warmup=2, repeats=runs, items=batch_size, sync=sync)
+    return result['items_per_s']
+
+
+# Local weights of every backbone in weights_dir, the torchvision cache name or <backbone>.pth.
+# Raises FileNotFoundError if one of them is missing
+def find_weights(backbones, weights_dir):
+    weights_paths = {}
+    for name in backbones:
+        candidates = [os.path.join(weights_dir, filename) for filename in (hub_weights_filename(name), name + '.pth')]
+        found = [path for path in candidates if os.path.exists(path)]
+        if not found:
+            raise FileNotFoundError('No weights for {} in {}, expected {}'.format(
+                name, weights_dir, ' or '.join(os.path.basename(path) for path in candidates)))
+        weights_paths[name] = found[0]
+    return weights_paths
+
+
+# weights_paths maps a backbone name to its local torchvision weights, the others are downloaded
+# (pretrained=True) or randomly initialized (pretrained=False)
+def backbone_report(backbones, data_dir, train_df, test_df, transform, embed_size=300, hidden_size=512, num_layers=2,
+                    epochs=1, batch_size=32, lr=3e-4, image_size=224, pretrained=True, weights_paths=None,
+                    cache_dir='feature_cache', device='cpu', runs=10, seed=0):
+    weights_paths = weights_paths or {}
+    vocab, _, _ = load_or_build_vocabulary(train_df['caption'].tolist())
+    report = {}
+    for name in backbones:
+        model = EncoderDecoder(embed_size, hidden_size, len(vocab), num_layers, pretrained=pretrained, backbone=name,
+                               weights_path=weights_paths.get(name))
+        # Same decoder initialization for every backbone
+        torch.manual_seed(seed)
+        model.decoder = DecoderRNN(embed_size, hidden_size, len(vocab), num_layers)
+        row = {'gflops': gflops_per_image(model.encoder.resnet.eval(), image_size)}
+        model = model.to(device)
+        row['images_per_s'] = encoder_images_per_s(model.encoder.eval(), batch_size, image_size, device, runs)
+        row['weights_mb'] = model_size_mb(model.encoder)
+        row['activation_mb'] = activation_mb(model.encoder.resnet, torch.randn(batch_size, 3, image_size, image_size, device=device))
+
+        train_loader = get_feature_loader(model.encoder, data_dir, train_df, transform, batch_size, cache_dir=cache_dir,
+                                          split='train', device=device)
+        test_loader = get_feature_loader(model.encoder, data_dir, test_df, transform, batch_size, shuffle=False,
+                                         cache_dir=cache_dir, split='test', device=device)
+        pad_idx = vocab.stoi['<PAD>']
+        criterion = nn.CrossEntropyLoss(ignore_index=pad_idx)
+        optimizer = torch.optim.Adam(filter(lambda p: p.requires_grad, model.parameters()), lr=lr)
+        for epoch in range(epochs):
+            row['train_loss'] = train(criterion, model, optimizer, train_loader, device, pad_idx)
+        row.update(corpus_test_BLEU(model, test_loader, test_df, vocab.itos, device))
+        report[name] = row
+        print('{:20s} {:6.2f} GFLOPs  {:8.1f} images/s  weights {:7.1f} MB  activations {:7.1f} MB'.format(
+            name, row['gflops'], row['images_per_s'], row['weights_mb'], row['activation_mb'])
+            + ''.join('  {} {:.4f}'.format(k, v) for k, v in row.items() if k.startswith('BLEU')))
+    return report
+
+
+if __name__ == '__main__':
+    import pandas as pd
+    from torchvision import transforms
+    from batch_transforms import IMAGENET_MEAN, IMAGENET_STD
+
+    parser = argparse.ArgumentParser(description='Speed, memory and BLEU of the encoder backbones')
+    parser.add_argument('--data-dir', required=True)
+    parser.add_argument('--train-csv', required=True)
+    parser.add_argument('--test-csv', required=True)
+    parser.add_argument('--backbones', nargs='+', default=list(BACKBONES), choices=list(BACKBONES))
+    parser.add_argument('--weights-dir', default=None, help='folder with the torchvision weights of the backbones (cache file names or <backbone>.pth), no download')
+    parser.add_argument('--no-pretrained', action='store_true', help='random backbones (speed and memory only)')
+    parser.add_argument('--epochs', type=int, default=1)
+    parser.add_argument('--batch-size', type=int, default=32)
+    parser.add_argument('--image-size', type=int, default=224)
+    parser.add_argument('--embed-size', type=int, default=300)
+    parser.add_argument('--hidden-size', type=int, default=512)
+    parser.add_argument('--num-layers', type=int, default=2)
+    parser.add_argument('--device', default='cuda' if torch.cuda.is_available() else 'cpu')
+    parser.add_argument('--out', default='backbone_report.json')
+    args = parser.parse_args()
+
+    transform = transforms.Compose([
+        transforms.Resize((args.image_size, args.image_size)),
+        transforms.ToTensor(),
+        transforms.Normalize(IMAGENET_MEAN, IMAGENET_STD)])
+    weights_paths = {}
+    if args.weights_dir is not None:
+        try:
+            weights_paths = find_weights(args.backbones, os.path.expanduser(args.weights_dir))
+        except FileNotFoundError as e:
+            parser.error(str(e))
+    report = backbone_report(args.backbones, args.data_dir, pd.read_csv(args.train_csv), pd.read_csv(args.test_csv),
+                             transform, args.embed_size, args.hidden_size, args.num_layers, args.epochs, args.batch_size,
+                             image_size=args.image_size, pretrained=not args.no_pretrained, weights_paths=weights_paths,
+                             device=args.device)
+    with open(args.out, 'w') as f:
+        json.dump(report, f, indent=2)
@@ -0,0 +1,98 @@
+import numpy as np
+import torch
+import torch.nn.functional as F
+from PIL import Image
+
+'''
+Image augmentation and normalization on whole batches instead of per image in the DataLoader
+workers. The workers only decode the JPEG and resize it to a fixed load size (ToUint8Tensor),
+so they collate (B, 3, H, W) uint8 tensors, 4x smaller than float32 to pass between processes.
+BatchTransform then crops, resizes, flips and normalizes the batch at once in the main process
+(or on the GPU), with one grid_sample and one fused multiply-add:
+
+    loader = get_loader(data_dir, df, ToUint8Tensor(256), batch_size=32, num_workers=4)
+    loader = BatchTransformLoader(loader, BatchTransform(224, crop_scale=(0.6, 1.0), flip=True), device)
+    train(criterion, model, optimizer, loader, device)
+
+IMAGENET_MEAN and IMAGENET_STD are the normalization constants of the torchvision backbones,
+used here, in the transforms of the scripts and in utils.img_denorm.
+'''
+
+IMAGENET_MEAN = (0.485, 0.456, 0.406)
+IMAGENET_STD = (0.229, 0.224, 0.225)
+
+
+# Per-image transform of the workers: PIL image -> (3, size, size) uint8 tensor
+class ToUint8Tensor:
+    def __init__(self, size=256):
+        self.size = size
+
+    def __call__(self, img):
+        if img.size != (self.size, self.size):
+            img = img.resize((self.size, self.size), Image.BILINEAR)
+        return torch.from_numpy(np.asarray(img, dtype=np.uint8).copy()).permute(2, 0, 1)
+
+
+class BatchTransform:
+    def __init__(self, size=224, crop_scale=None, flip=False, mean=IMAGENET_MEAN, std=IMAGENET_STD):
+        self.size = size
+        # (min, max) fraction of the image area kept by the random square crops, None disables cropping
+        self.crop_scale = crop_scale
+        self.flip = flip
+        # (x / 255 - mean) / std as a single x * scale + shift
+        std = torch.tensor(std, dtype=torch.float32).view(1, 3, 1, 1)
+        self.scale = 1.0 / (255.0 * std)
+        self.shift = -torch.tensor(mean, dtype=torch.float32).view(1, 3, 1, 1) / std
+
+    # (B, 3, H, W) uint8 images -> (B, 3, size, size) normalized float32, on the device of the images
+    def __call__(self, images):
+        images = images.float()
+        if self.crop_scale is not None or self.flip:
+            images = self.crop_and_flip(images)
+        elif images.shape[-2:] != (self.size, self.size):
+            images = F.interpolate(images, size=(self.size, self.size), mode='bilinear', align_corners=False, antialias=True)
+        return images * self.scale.to(images.device) + self.shift.to(images.device)
+
+    # Random crops (side sqrt(scale) of the image, at a random position), resized to size and
+    # flipped with probability 0.5, as one affine grid_sample over the batch
+    def crop_and_flip(self, images):
+        batch_size, device = images.size(0), images.device
+        if self.crop_scale is not None:
+            low, high = self.crop_scale
+            side = torch.empty(batch_size, device=device).uniform_(low, high).sqrt()
+            # Crop centers in normalized [-1, 1] coordinates, so that the crop stays inside the image
+            center_x = (torch.rand(batch_size, device=device) * 2 - 1) * (1 - side)
+            center_y = (torch.rand(batch_size, device=device) * 2 - 1) * (1 - side)
+        else:
+            side = torch.ones(batch_size, device=device)
+            center_x = center_y = torch.zeros(batch_size, device=device)
+        sign_x = torch.ones(batch_size, device=device)
+        if self.flip:
+            sign_x = torch.where(torch.rand(batch_size, device=device) < 0.5, -sign_x, sign_x)
+        theta = torch.zeros(batch_size, 2, 3, device=device)
+        theta[:, 0, 0] = side * sign_x
+        theta[:, 0, 2] = center_x
+        theta[:, 1, 1] = side
+        theta[:, 1, 2] = center_y
+        grid = F.affine_grid(theta, (batch_size, 3, self.size, self.size), align_corners=False)
+        return F.grid_sample(images, grid, mode='bilinear', padding_mode='border', align_corners=False)
+
+
+# Wraps a loader of (uint8 images, captions, img_dirs) batches and yields them with the images moved to
+# device and transformed. The other attributes (dataset, sampler, ...) are the ones of the wrapped loader
+class BatchTransformLoader:
+    def __init__(self, loader, batch_transform, device='cpu'):
+        self.loader = loader
+        self.batch_transform = batch_transform
+        self.device = device
+
+    def __len__(self):
+        return len(self.loader)
+
+    def __getattr__(self, name):
+        return getattr(self.__dict__['loader'], name)
+
+    def __iter__(self):
+        for images, *rest in self.loader:
+            images = images.to(self.device, non_blocking=True)
+            yield (self.batch_transform(images), *rest)
@@ -0,0 +1,244 @@
+import os
+import sys
+import json
+import time
+import platform
+import argparse
+import numpy as np
+import pandas as pd
+import torch
+import torch.nn as nn
+from PIL import Image
+from torchvision import transforms
+from batch_transforms import IMAGENET_MEAN, IMAGENET_STD, ToUint8Tensor, BatchTransform, BatchTransformLoader
+from get_loader import Vocabulary, ImageCaptionDataset, get_loader
+from model.model import EncoderDecoder
+from train import train
+from test import validate
+
+'''
+Stage by stage benchmark of the captioning pipeline on a synthetic Flickr-like dataset, so it
+runs offline and gives the same workload on every machine. Each stage is timed on its own with
+warmup runs and repetitions:
+    decode_transform   ImageCaptionDataset.__getitem__ (JPEG decode + transform)
+    vocab_build        Vocabulary.build_vocabulary over all the captions
+    encoder_forward    EncoderCNN forward of one batch
+    train_step         train() over one batch (forward, backward, optimizer step)
+    validate           validate() over one batch
+    generate_caption   DecoderRNN.generate_caption of one image
+Results are written as JSON, and two result files can be compared to flag regressions:
+    python benchmark.py run --out results.json
+    python benchmark.py compare baseline.json results.json --threshold 0.10
+The loader command measures the DataLoader throughput (images/s, batch transform included) of the
+per-image PIL transforms against the uint8 batches of batch_transforms.py for each worker count:
+    python benchmark.py loader --workers 0 1 2 4
+'''
+
+WORDS = ('a the man woman dog cat child boy girl runs jumps sits plays rides walks on in with at '
+         'grass water street beach snow ball bike red blue black white two people group over near').split()
+
+
+# Writes num_images random JPEGs (of Flickr8k-like sizes) and captions_per_image random captions
+# each to out_dir, returns the image folder and the captions dataframe. Existing files are reused
+def make_synthetic_dataset(out_dir='benchmark_data', num_images=64, captions_per_image=5, seed=0):
+    rng = np.random.default_rng(seed)
+    image_dir = os.path.join(out_dir, 'Images')
+    os.makedirs(image_dir, exist_ok=True)
+    rows = []
+    for i in range(num_images):
+        name = 'synthetic_{:05d}.jpg'.format(i)
+        height, width = (375, 500) if i % 2 == 0 else (500, 375)
+        pixels = rng.integers(0, 256, (height, width, 3), dtype=np.uint8)
+        path = os.path.join(image_dir, name)
+        if not os.path.exists(path):
+            Image.fromarray(pixels).save(path, quality=90)
+        for _ in range(captions_per_image):
+            rows.append((name, ' '.join(rng.choice(WORDS, rng.integers(6, 18))) + ' .'))
+    df = pd.DataFrame(rows, columns=['image', 'caption'])
+    df.to_csv(os.path.join(out_dir, 'captions.csv'), index=False)
+    return image_dir, df
+
+
+# Runs fn warmup times untimed and then repeats times, returns the timing summary in ms.
+# items is the number of samples one call processes, used for the throughput
+def time_stage(fn, warmup=2, repeats=10, items=1, sync=None):
+    for _ in range(warmup):
+        fn()
+    times = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        fn()
+        if sync is not None:
+            sync()
+        times.append((time.perf_counter() - start) * 1000)
+    times = np.array(times)
+    median = float(np.median(times))
+    return {'mean_ms': float(times.mean()), 'median_ms': median, 'min_ms': float(times.min()),
+            'std_ms': float(times.std()), 'repeats': repeats, 'items': items,
+            'items_per_s': items / (median / 1000) if median > 0 else None}
+
+
+def run_suite(data_dir='benchmark_data', num_images=64, batch_size=16, image_size=224, embed_size=300,
+              hidden_size=512, num_layers=2, warmup=2, repeats=10, device='cpu', stages=None):
+    torch.manual_seed(0)
+    image_dir, df = make_synthetic_dataset(data_dir, num_images)
+    transform = transforms.Compose([
+        transforms.Resize((image_size, image_size)),
+        transforms.ToTensor(),
+        transforms.Normalize(IMAGENET_MEAN, IMAGENET_STD)])
+    vocab_dir = os.path.join(data_dir, 'vocab_cache')
+    dataset = ImageCaptionDataset(image_dir, df, transform, vocab_dir=vocab_dir)
+    loader = get_loader(image_dir, df, transform, batch_size, num_workers=0, shuffle=False, vocab_dir=vocab_dir)
+    batch = next(iter(loader))
+    images = batch[0].to(device)
+
+    # Random weights, the timings do not depend on them and the suite must not download anything
+    model = EncoderDecoder(embed_size, hidden_size, len(dataset.vocab), num_layers, pretrained=False).to(device)
+    criterion = nn.CrossEntropyLoss(ignore_index=dataset.pad_idx)
+    optimizer = torch.optim.Adam(model.parameters(), lr=1e-4)
+    sync = torch.cuda.synchronize if str(device).startswith('cuda') else None
+
+    def encoder_forward():
+        model.eval()
+        with torch.no_grad():
+            model.encoder(images)
+
+    def generate_caption():
+        model.eval()
+        with torch.no_grad():
+            features = model.encoder(images[:1])
+            model.decoder.generate_caption(features.unsqueeze(0), vocab=dataset.vocab.itos)
+
+    sample_idx = iter(range(10 ** 9))
+    all_stages = {
+        'decode_transform': (lambda: dataset[next(sample_idx) % len(dataset)], 1),
+        'vocab_build': (lambda: Vocabulary(3).build_vocabulary(df['caption'].tolist()), len(df)),
+        'encoder_forward': (encoder_forward, images.size(0)),
+        'train_step': (lambda: train(criterion, model, optimizer, [batch], device, dataset.pad_idx), images.size(0)),
+        'validate': (lambda: validate(criterion, model, [batch], device, dataset.pad_idx), images.size(0)),
+        'generate_caption': (generate_caption, 1),
+    }
+    results = {}
+    for name, (fn, items) in all_stages.items():
+        if stages is not None and name not in stages:
+            continue
+        results[name] = time_stage(fn, warmup, repeats, items, sync)
+        print('{:18s} median {:10.3f} ms  ({:.1f} items/s)'.format(name, results[name]['median_ms'], results[name]['items_per_s'] or 0))
+
+    meta = {'time': time.strftime('%Y-%m-%d %H:%M:%S'), 'python': sys.version.split()[0], 'torch': torch.__version__,
+            'platform': platform.platform(), 'device': str(device), 'threads': torch.get_num_threads(),
+            'config': {'num_images': num_images, 'batch_size': batch_size, 'image_size': image_size, 'embed_size': embed_size,
+                       'hidden_size': hidden_size, 'num_layers': num_layers, 'warmup': warmup, 'repeats': repeats}}
+    return {'meta': meta, 'stages': results}
+
+
+# Images/s of a loader over `batches` batches, after `warmup` batches (the worker startup is not timed)
+def loader_images_per_s(loader, batches=20, warmup=2):
+    iterator = iter(loader)
+    for _ in range(warmup):
+        next(iterator)
+    start = time.perf_counter()
+    images = 0
+    for _ in range(batches):
+        try:
+            images += next(iterator)[0].size(0)
+        except StopIteration:
+            break
+    return images / (time.perf_counter() - start)
+
+
+# Throughput of the same augmentation (random square crop of 60-100% of the area, flip, normalization)
+# done per image with torchvision in the workers ('per_image') or per batch after collation ('batch'),
+# for every number of workers. Returns {pipeline: {workers: images/s}}
+def loader_benchmark(data_dir='benchmark_data', num_images=64, batch_size=16, image_size=224, load_size=256,
+                     workers=(0, 1, 2, 4), batches=20, warmup=2, device='cpu'):
+    image_dir, df = make_synthetic_dataset(data_dir, num_images)
+    vocab_dir = os.path.join(data_dir, 'vocab_cache')
+    per_image = transforms.Compose([
+        transforms.Resize((load_size, load_size)),
+        transforms.RandomResizedCrop(image_size, scale=(0.6, 1.0), ratio=(1.0, 1.0)),
+        transforms.RandomHorizontalFlip(),
+        transforms.ToTensor(),
+        transforms.Normalize(IMAGENET_MEAN, IMAGENET_STD)])
+    batch_transform = BatchTransform(image_size, crop_scale=(0.6, 1.0), flip=True)
+    results = {'per_image': {}, 'batch': {}}
+    for num_workers in workers:
+        loader = get_loader(image_dir, df, per_image, batch_size, num_workers=num_workers, vocab_dir=vocab_dir)
+        results['per_image'][num_workers] = loader_images_per_s(loader, batches, warmup)
+        loader = get_loader(image_dir, df, ToUint8Tensor(load_size), batch_size, num_workers=num_workers, vocab_dir=vocab_dir)
+        results['batch'][num_workers] = loader_images_per_s(BatchTransformLoader(loader, batch_transform, device), batches, warmup)
+        print('{} workers: per image {:8.1f} images/s  batch {:8.1f} images/s  ({:.2f}x)'.format(
+            num_workers, results['per_image'][num_workers], results['batch'][num_workers],
+            results['batch'][num_workers] / results['per_image'][num_workers]))
+    return results
+
+
+# Compares the median time of every stage of two result files. A stage is a regression when it
+# got slower than threshold (relative). Returns the per-stage comparison and the regressed stages
+def compare_results(baseline, current, threshold=0.10):
+    comparison = {}
+    regressions = []
+    for name, result in current['stages'].items():
+        if name not in baseline['stages']:
+            continue
+        before = baseline['stages'][name]['median_ms']
+        after = result['median_ms']
+        change = (after - before) / before if before > 0 else 0.0
+        comparison[name] = {'baseline_ms': before, 'current_ms': after, 'change': change, 'regression': change > threshold}
+        if change > threshold:
+            regressions.append(name)
+        print('{:18s} {:10.3f} ms -> {:10.3f} ms  {:+7.1%}{}'.format(name, before, after, change,
+                                                                   '  REGRESSION' if change > threshold else ''))
+    if baseline['meta'].get('config') != current['meta'].get('config'):
+        print('Warning: the two runs used a different benchmark configuration')
+    return comparison, regressions
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Stage by stage performance benchmark')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+    run_parser = subparsers.add_parser('run', help='run the benchmark suite')
+    run_parser.add_argument('--out', default='benchmark_results.json')
+    run_parser.add_argument('--data-dir', default='benchmark_data', help='folder of the synthetic dataset')
+    run_parser.add_argument('--num-images', type=int, default=64)
+    run_parser.add_argument('--batch-size', type=int, default=16)
+    run_parser.add_argument('--image-size', type=int, default=224)
+    run_parser.add_argument('--warmup', type=int, default=2)
+    run_parser.add_argument('--repeats', type=int, default=10)
+    run_parser.add_argument('--device', default='cpu')
+    run_parser.add_argument('--stages', nargs='+', default=None, help='subset of the stages to run')
+    loader_parser = subparsers.add_parser('loader', help='loader throughput, per-image against batch transforms')
+    loader_parser.add_argument('--out', default='loader_results.json')
+    loader_parser.add_argument('--data-dir', default='benchmark_data', help='folder of the synthetic dataset')
+    loader_parser.add_argument('--num-images', type=int, default=64)
+    loader_parser.add_argument('--batch-size', type=int, default=16)
+    loader_parser.add_argument('--image-size', type=int, default=224)
+    loader_parser.add_argument('--load-size', type=int, default=256, help='size of the uint8 images of the workers')
+    loader_parser.add_argument('--workers', type=int, nargs='+', default=[0, 1, 2, 4])
+    loader_parser.add_argument('--batches', type=int, default=20)
+    loader_parser.add_argument('--device', default='cpu')
+    compare_parser = subparsers.add_parser('compare', help='compare two result files')
+    compare_parser.add_argument('baseline')
+    compare_parser.add_argument('current')
+    compare_parser.add_argument('--threshold', type=float, default=0.10, help='relative slowdown flagged as a regression')
+    args = parser.parse_args()
+
+    if args.command == 'run':
+        results = run_suite(args.data_dir, args.num_images, args.batch_size, args.image_size, warmup=args.warmup,
+                            repeats=args.repeats, device=args.device, stages=args.stages)
+        with open(args.out, 'w') as f:
+            json.dump(results, f, indent=2)
+        print('Results written to', args.out)
+    elif args.command == 'loader':
+        results = loader_benchmark(args.data_dir, args.num_images, args.batch_size, args.image_size, args.load_size,
+                                   args.workers, args.batches, device=args.device)
+        with open(args.out, 'w') as f:
+            json.dump(results, f, indent=2)
+        print('Results written to', args.out)
+    else:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        with open(args.current) as f:
+            current = json.load(f)
+        _, regressions = compare_results(baseline, current, args.threshold)
+        sys.exit(1 if regressions else 0)
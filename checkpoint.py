@@ -0,0 +1,233 @@
+import os
+import re
+import random
+import itertools
+import threading
+import numpy as np
+import torch
+
+'''
+Checkpoints written from a background thread, so that saving does not stall the training loop.
+A checkpoint holds the EncoderDecoder weights, the optimizer and ReduceLROnPlateau states, the
+python / numpy / torch RNG states and the position in the epoch (epoch, batches seen and the
+running loss totals of train()). The training thread only copies the states to CPU memory, the
+writer thread serializes them to a temporary file that is renamed in place, and only the last
+`keep` checkpoints are kept:
+
+    checkpoint = CheckpointManager('checkpoints', model, optimizer, scheduler, every=500)
+    start_epoch = checkpoint.resume()                     # 1 without a checkpoint
+    train_loader = get_loader(..., seed=0)
+    for epoch in range(start_epoch, epochs + 1):
+        train_loss = train(criterion, model, optimizer, train_loader, device, pad_idx, checkpoint=checkpoint)
+        scheduler.step(validate(criterion, model, val_loader, device, pad_idx))
+        checkpoint.end_epoch()
+    checkpoint.close()
+
+The resumed epoch continues with the batch after the last one saved. It is the exact same
+batch with the loaders of get_loader(..., seed=...) and shards.StreamingLoader, which can
+start an epoch at any position. Other loaders read the consumed batches again and skip them.
+With num_workers=0 the resumed run is bit-identical to an uninterrupted one. DataLoader
+workers seed their random transforms when the iterator starts, so with workers the random
+augmentations of the rest of the resumed epoch differ (the batches are the same).
+'''
+
+CHECKPOINT_NAME = 'checkpoint_e{:04d}_b{:07d}.pt'
+CHECKPOINT_PATTERN = re.compile(r'checkpoint_e(\d+)_b(\d+)\.pt$')
+
+
+# Copy of a (nested) state dict with every tensor cloned to CPU memory
+def to_cpu(state):
+    if torch.is_tensor(state):
+        return state.detach().to('cpu', copy=True)
+    if isinstance(state, dict):
+        return {key: to_cpu(value) for key, value in state.items()}
+    if isinstance(state, (list, tuple)):
+        return type(state)(to_cpu(value) for value in state)
+    return state
+
+
+def rng_state():
+    state = {'python': random.getstate(), 'numpy': np.random.get_state(), 'torch': torch.get_rng_state()}
+    if torch.cuda.is_available():
+        state['cuda'] = torch.cuda.get_rng_state_all()
+    return state
+
+
+def set_rng_state(state):
+    random.setstate(state['python'])
+    np.random.set_state(state['numpy'])
+    torch.set_rng_state(state['torch'])
+    if 'cuda' in state and torch.cuda.is_available():
+        torch.cuda.set_rng_state_all(state['cuda'])
+
+
+# Moves loader to batch batches_seen of the epoch. Returns what to iterate, the loader itself when it can seek
+def set_loader_position(loader, epoch, batches_seen):
+    if hasattr(loader, 'load_state_dict'):  # shards.StreamingLoader
+        loader.load_state_dict({'epoch': epoch, 'batches_seen': batches_seen})
+        return loader
+    batch_sampler = getattr(loader, 'batch_sampler', None)
+    if hasattr(batch_sampler, 'set_position'):  # BucketBatchSampler
+        batch_sampler.set_position(epoch, batches_seen)
+        return loader
+    sampler = getattr(loader, 'sampler', None)
+    if hasattr(sampler, 'set_position'):  # ResumableSampler
+        sampler.set_position(epoch, batches_seen * loader.batch_size)
+        return loader
+    if hasattr(sampler, 'set_epoch'):  # DistributedSampler
+        sampler.set_epoch(epoch)
+    if batches_seen == 0:
+        return loader
+    return itertools.islice(loader, batches_seen, None)
+
+
+# Checkpoints of directory as (epoch, batches seen, path), oldest first
+def list_checkpoints(directory):
+    if not os.path.isdir(directory):
+        return []
+    checkpoints = []
+    for name in os.listdir(directory):
+        match = CHECKPOINT_PATTERN.match(name)
+        if match:
+            checkpoints.append((int(match.group(1)), int(match.group(2)), os.path.join(directory, name)))
+    return sorted(checkpoints)
+
+
+class CheckpointManager:
+    def __init__(self, directory, model, optimizer=None, scheduler=None, every=500, keep=3):
+        if keep < 1:
+            raise ValueError('keep must be at least 1, got {}'.format(keep))
+        self.directory = directory
+        self.model = model
+        self.optimizer = optimizer
+        self.scheduler = scheduler
+        # Checkpoint every `every` batches inside the epoch (None: only at the end of the epochs), keep the last `keep`
+        self.every = every
+        self.keep = keep
+        self.epoch = 1
+        self.batches_seen = 0
+        self.total_loss = 0.0
+        self.total_samples = 0
+        self.last_saved = None
+        self.resumed_rng = None
+        # At most one snapshot waits for the writer, a newer one replaces it
+        self.pending = None
+        self.writing = False
+        self.error = None
+        self.stopping = False
+        self.condition = threading.Condition()
+        self.writer = threading.Thread(target=self.write_loop, daemon=True)
+        self.writer.start()
+
+    # Restores the latest checkpoint of the directory (or path) and returns the epoch to continue with
+    def resume(self, path=None):
+        if path is None:
+            checkpoints = list_checkpoints(self.directory)
+            if not checkpoints:
+                return self.epoch
+            path = checkpoints[-1][2]
+        state = torch.load(path, map_location='cpu', weights_only=False)
+        getattr(self.model, 'module', self.model).load_state_dict(state['model'])
+        if self.optimizer is not None and state['optimizer'] is not None:
+            self.optimizer.load_state_dict(state['optimizer'])
+        if self.scheduler is not None and state['scheduler'] is not None:
+            self.scheduler.load_state_dict(state['scheduler'])
+        set_rng_state(state['rng'])
+        self.resumed_rng = state['rng'] if state['batches_seen'] > 0 else None
+        self.epoch = state['epoch']
+        self.batches_seen = state['batches_seen']
+        self.total_loss = state['total_loss']
+        self.total_samples = state['total_samples']
+        self.last_saved = (self.epoch, self.batches_seen)
+        print('Resumed from {} (epoch {}, batch {})'.format(path, self.epoch, self.batches_seen))
+        return self.epoch
+
+    # Called by train() before the epoch: positions the loader and returns (iterable, batches already seen,
+    # total loss, total samples) so that the epoch average covers the batches of before the interruption
+    def begin_epoch(self, loader):
+        batches = set_loader_position(loader, self.epoch, self.batches_seen)
+        if self.resumed_rng is not None:
+            # Creating the DataLoader iterator draws its base seed from the torch RNG. In the original run that
+            # happened before the checkpoint, so the saved RNG state is restored again once the iterator exists
+            batches = iter(batches)
+            set_rng_state(self.resumed_rng)
+            self.resumed_rng = None
+        return batches, self.batches_seen, self.total_loss, self.total_samples
+
+    # Called by train() after every batch with its running totals, saves every `every` batches
+    def step(self, batches_seen, total_loss, total_samples):
+        self.batches_seen = batches_seen
+        self.total_loss = total_loss
+        self.total_samples = total_samples
+        if self.every is not None and batches_seen % self.every == 0:
+            self.save()
+
+    # Moves to the next epoch and saves, call it once the scheduler has stepped
+    def end_epoch(self):
+        self.epoch += 1
+        self.batches_seen = 0
+        self.total_loss = 0.0
+        self.total_samples = 0
+        self.save()
+
+    # Copies the current state to CPU memory and hands it to the writer thread, returns without waiting for the write
+    def save(self):
+        self.raise_error()
+        model = getattr(self.model, 'module', self.model)  # DistributedDataParallel
+        state = {
+            'epoch': self.epoch, 'batches_seen': self.batches_seen,
+            'total_loss': self.total_loss, 'total_samples': self.total_samples,
+            'model': to_cpu(model.state_dict()),
+            'optimizer': to_cpu(self.optimizer.state_dict()) if self.optimizer is not None else None,
+            'scheduler': self.scheduler.state_dict() if self.scheduler is not None else None,
+            'rng': rng_state(),
+        }
+        with self.condition:
+            self.pending = state
+            self.condition.notify_all()
+
+    def write_loop(self):
+        while True:
+            with self.condition:
+                while self.pending is None and not self.stopping:
+                    self.condition.wait()
+                if self.pending is None:
+                    return
+                state, self.pending = self.pending, None
+                self.writing = True
+            try:
+                self.write(state)
+            except Exception as e:
+                self.error = e
+            with self.condition:
+                self.writing = False
+                self.condition.notify_all()
+
+    # Atomic write (temporary file and rename), then the oldest checkpoints beyond `keep` are deleted
+    def write(self, state):
+        os.makedirs(self.directory, exist_ok=True)
+        path = os.path.join(self.directory, CHECKPOINT_NAME.format(state['epoch'], state['batches_seen']))
+        torch.save(state, path + '.tmp')
+        os.replace(path + '.tmp', path)
+        self.last_saved = (state['epoch'], state['batches_seen'])
+        for _, _, old_path in list_checkpoints(self.directory)[:-self.keep]:
+            os.remove(old_path)
+
+    def raise_error(self):
+        if self.error is not None:
+            error, self.error = self.error, None
+            raise RuntimeError('Writing the checkpoint failed') from error
+
+    # Waits until the pending snapshot is written
+    def wait(self):
+        with self.condition:
+            while self.pending is not None or self.writing:
+                self.condition.wait()
+        self.raise_error()
+
+    def close(self):
+        self.wait()
+        with self.condition:
+            self.stopping = True
+            self.condition.notify_all()
+        self.writer.join()
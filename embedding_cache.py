@@ -0,0 +1,161 @@
+import os
+import hashlib
+import threading
+from collections import OrderedDict
+import torch
+import torch.nn as nn
+from feature_cache import backbone_fingerprint
+
+'''
+Cache of encoder embeddings for repeated images (retries, thumbnails, re-captioning with other
+decode settings). The key is a hash of the preprocessed image tensor and of the encoder weights,
+the entries live in memory under a byte budget with LRU eviction, and the evicted ones can be
+spilled to disk and promoted back on the next hit. The spill folder has its own byte budget,
+its least recently used files are deleted beyond it, and close() deletes the remaining ones.
+get, put and snapshot take a lock, as the server calls them from the event loop and from the
+micro-batch thread. CachedEncoder puts it in front of EncoderCNN so cached images skip the CNN
+entirely.
+'''
+
+
+# Key of one preprocessed image for the given model version
+def image_key(image, model_version: str):
+    h = hashlib.sha1(model_version.encode())
+    h.update(str(tuple(image.shape)).encode())
+    h.update(str(image.dtype).encode())
+    h.update(image.detach().cpu().contiguous().numpy().tobytes())
+    return h.hexdigest()
+
+
+class EmbeddingCache:
+    def __init__(self, max_bytes: int = 256 * 1024 ** 2, spill_dir: str = None, max_spill_bytes: int = 1024 ** 3):
+        self.max_bytes = max_bytes
+        self.spill_dir = spill_dir
+        self.max_spill_bytes = max_spill_bytes
+        self.lock = threading.Lock()
+        self.entries = OrderedDict()
+        self.current_bytes = 0
+        # key: size of its file in spill_dir, least recently used first
+        self.spilled = OrderedDict()
+        self.spill_bytes = 0
+        self.stats = {'hits': 0, 'spill_hits': 0, 'misses': 0, 'evictions': 0, 'spills': 0, 'spill_evictions': 0}
+        if spill_dir is not None:
+            os.makedirs(spill_dir, exist_ok=True)
+            self.index_spill_dir()
+
+    def __len__(self):
+        with self.lock:
+            return len(self.entries)
+
+    def spill_path(self, key):
+        return os.path.join(self.spill_dir, key + '.pt')
+
+    # Files left in spill_dir by a process that did not close its cache, oldest first, within the spill budget
+    def index_spill_dir(self):
+        for name in os.listdir(self.spill_dir):
+            if name.endswith('.pt.tmp'):
+                os.remove(os.path.join(self.spill_dir, name))
+        paths = [os.path.join(self.spill_dir, name) for name in os.listdir(self.spill_dir) if name.endswith('.pt')]
+        for path in sorted(paths, key=os.path.getmtime):
+            self.spilled[os.path.basename(path)[:-len('.pt')]] = os.path.getsize(path)
+            self.spill_bytes += os.path.getsize(path)
+        self.trim_spill()
+
+    def get(self, key):
+        with self.lock:
+            if key in self.entries:
+                self.entries.move_to_end(key)
+                self.stats['hits'] += 1
+                return self.entries[key]
+            if key in self.spilled:
+                # Promoted back to memory, the file is deleted and written again if the entry is evicted again
+                embedding = torch.load(self.spill_path(key))
+                self.remove_spilled(key)
+                self.stats['spill_hits'] += 1
+                self.insert(key, embedding)
+                return embedding
+            self.stats['misses'] += 1
+            return None
+
+    def put(self, key, embedding):
+        embedding = embedding.detach().cpu().clone()
+        with self.lock:
+            if key in self.spilled:
+                self.remove_spilled(key)
+            self.insert(key, embedding)
+
+    # Adds an entry to the memory tier, the caller holds the lock
+    def insert(self, key, embedding):
+        if key in self.entries:
+            old_embedding = self.entries.pop(key)
+            self.current_bytes -= old_embedding.element_size() * old_embedding.nelement()
+        self.entries[key] = embedding
+        self.current_bytes += embedding.element_size() * embedding.nelement()
+        # Least recently used entries are evicted first
+        while self.current_bytes > self.max_bytes and len(self.entries) > 1:
+            old_key, old_embedding = self.entries.popitem(last=False)
+            self.current_bytes -= old_embedding.element_size() * old_embedding.nelement()
+            self.stats['evictions'] += 1
+            if self.spill_dir is not None:
+                self.spill(old_key, old_embedding)
+
+    def spill(self, key, embedding):
+        path = self.spill_path(key)
+        torch.save(embedding, path + '.tmp')
+        os.replace(path + '.tmp', path)
+        self.spilled[key] = os.path.getsize(path)
+        self.spill_bytes += self.spilled[key]
+        self.stats['spills'] += 1
+        self.trim_spill()
+
+    # Deletes the least recently used spill files beyond max_spill_bytes
+    def trim_spill(self):
+        while self.spill_bytes > self.max_spill_bytes and self.spilled:
+            self.remove_spilled(next(iter(self.spilled)))
+            self.stats['spill_evictions'] += 1
+
+    def remove_spilled(self, key):
+        self.spill_bytes -= self.spilled.pop(key)
+        try:
+            os.remove(self.spill_path(key))
+        except FileNotFoundError:
+            pass
+
+    def snapshot(self):
+        with self.lock:
+            lookups = self.stats['hits'] + self.stats['spill_hits'] + self.stats['misses']
+            return dict(self.stats, entries=len(self.entries), bytes=self.current_bytes,
+                        spill_entries=len(self.spilled), spill_bytes=self.spill_bytes,
+                        hit_rate=(self.stats['hits'] + self.stats['spill_hits']) / max(lookups, 1))
+
+    # Drops the memory tier and deletes the spill files
+    def close(self):
+        with self.lock:
+            self.entries.clear()
+            self.current_bytes = 0
+            for key in list(self.spilled):
+                self.remove_spilled(key)
+
+
+# EncoderCNN with an EmbeddingCache in front. Only used for inference: with gradients enabled
+# (training) it simply calls the encoder
+class CachedEncoder(nn.Module):
+    def __init__(self, encoder, cache: EmbeddingCache, model_version: str = None):
+        super(CachedEncoder, self).__init__()
+        self.encoder = encoder
+        self.cache = cache
+        self.model_version = model_version or backbone_fingerprint(encoder)
+
+    def forward(self, images):
+        if torch.is_grad_enabled():
+            return self.encoder(images)
+        keys = [image_key(image, self.model_version) for image in images]
+        embeddings = [self.cache.get(key) for key in keys]
+        missing = [i for i, embedding in enumerate(embeddings) if embedding is None]
+        if missing:
+            # All the missing images go through the CNN in a single batch
+            computed = self.encoder(images[missing])
+            for i, embedding in zip(missing, computed):
+                self.cache.put(keys[i], embedding)
+                embeddings[i] = embedding
+        return torch.stack([embedding.to(images.device) for embedding in embeddings])
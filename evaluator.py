@@ -0,0 +1,178 @@
+import copy
+import time
+import queue
+import threading
+import torch
+import torch.multiprocessing as mp
+from torch.utils.data import DataLoader
+from model.decoding import ids_to_captions
+from get_loader import ImageGroupDataset, CaptionCollate, GroupedCaptionCollate
+from train import compute_loss, batch_image_index
+from utils.bleu import build_reference_index, corpus_bleu
+
+'''
+Periodic evaluation in a background process (or thread) while training keeps running.
+The evaluator holds a CPU replica of the model whose tensors live in shared memory. submit()
+copies the current weights into it (skipped, never waited for, if the evaluator is copying at
+that moment) and returns straight away. The evaluator takes the latest snapshot, computes the
+validation loss and corpus BLEU on num_batches batches of a persistent DataLoader (its workers
+and iterator are created once and reused), and puts the results in a queue that poll() reads:
+
+    evaluator = BackgroundEvaluator(model, val_dataloader.dataset, val_df, criterion, pad_idx,
+                                    collate_fn=val_dataloader.collate_fn)
+    train_and_visualize_caps(..., evaluator=evaluator)
+    evaluator.close()
+
+Snapshots submitted while an evaluation is running overwrite each other, so the evaluator
+always moves on to the newest weights. Without collate_fn the batches are collated as the ones
+of get_loader for the same dataset (bucketing or group_images loaders included).
+'''
+
+
+# Loss and BLEU of the model on a list of batches, with greedy captions for the unique images
+def evaluate_batches(model, batches, criterion, pad_idx, itos, reference_index, max_len=20, num_examples=3):
+    model.eval()
+    total_loss = 0.0
+    total_samples = 0
+    seen_images = set()
+    hypotheses = []
+    references = []
+    examples = []
+    with torch.no_grad():
+        for images, captions, *rest in batches:
+            # Grouped batches hold each image once, img_dir is then per image and image_index maps the captions to them
+            img_dir = rest[0]
+            loss = compute_loss(criterion, model, images, captions, pad_idx, image_index=batch_image_index(rest))
+            total_loss += loss.item() * captions.size(0)
+            total_samples += captions.size(0)
+            keep = [i for i, name in enumerate(img_dir) if name not in seen_images]
+            seen_images.update(img_dir)
+            if not keep:
+                continue
+            ids, lengths = model.decoder.generate_captions(model.encoder(images[keep]), max_len=max_len)
+            for i, words in zip(keep, ids_to_captions(ids, lengths, itos)):
+                hypotheses.append(words)
+                references.append(reference_index[img_dir[i]])
+                if len(examples) < num_examples:
+                    examples.append({'image': img_dir[i], 'predicted': ' '.join(words)})
+    result = {'val_loss': total_loss / max(total_samples, 1), 'images': len(hypotheses), 'examples': examples}
+    result.update(corpus_bleu(hypotheses, references))
+    return result
+
+
+# Collate function of the loaders of get_loader for dataset, None for the default collate of fixed-size captions
+def default_collate_fn(dataset):
+    if isinstance(dataset, ImageGroupDataset):
+        return GroupedCaptionCollate(dataset.pad_idx)
+    if getattr(dataset, 'dynamic_padding', False):
+        return CaptionCollate(dataset.pad_idx)
+    return None
+
+
+# Batches of a loader that is iterated forever, the iterator (and its workers) is created once
+def cycle_batches(loader):
+    while True:
+        for batch in loader:
+            yield batch
+
+
+def evaluator_loop(shared_model, meta, lock, pending, stop, results, dataset, val_df, criterion, pad_idx, config):
+    torch.set_num_threads(config['threads'])
+    model = copy.deepcopy(shared_model)
+    itos = dataset.vocab.itos
+    reference_index = build_reference_index(val_df)
+    loader = DataLoader(dataset, batch_size=config['batch_size'], shuffle=True, drop_last=False,
+                        collate_fn=config['collate_fn'], num_workers=config['num_workers'], persistent_workers=config['num_workers'] > 0)
+    batches = cycle_batches(loader)
+    while not stop.is_set():
+        if not pending.wait(timeout=0.5):
+            continue
+        pending.clear()
+        with lock:
+            model.load_state_dict(shared_model.state_dict())
+            epoch, batch = int(meta[0]), int(meta[1])
+        start = time.perf_counter()
+        result = evaluate_batches(model, [next(batches) for _ in range(config['num_batches'])], criterion, pad_idx,
+                                  itos, reference_index, config['max_len'])
+        result.update({'epoch': epoch, 'batch': batch, 'eval_seconds': time.perf_counter() - start})
+        results.put(result)
+
+
+class BackgroundEvaluator:
+    def __init__(self, model, dataset, val_df, criterion, pad_idx=None, num_batches=10, batch_size=32,
+                 num_workers=1, threads=1, max_len=20, mode='process', log_wandb=False, collate_fn=None):
+        model = getattr(model, 'module', model)  # DistributedDataParallel
+        self.shared_model = copy.deepcopy(model).cpu().eval()
+        self.shared_model.share_memory()
+        self.meta = torch.zeros(2, dtype=torch.long).share_memory_()
+        self.log_wandb = log_wandb
+        self.results = []
+        config = {'num_batches': num_batches, 'batch_size': batch_size, 'num_workers': num_workers,
+                  'threads': threads, 'max_len': max_len,
+                  'collate_fn': collate_fn if collate_fn is not None else default_collate_fn(dataset)}
+        if mode == 'process':
+            ctx = mp.get_context('spawn')
+            self.lock, self.pending, self.stop, self.queue = ctx.Lock(), ctx.Event(), ctx.Event(), ctx.Queue()
+            worker = ctx.Process
+        elif mode == 'thread':
+            self.lock, self.pending, self.stop, self.queue = threading.Lock(), threading.Event(), threading.Event(), queue.Queue()
+            worker = threading.Thread
+        else:
+            raise ValueError("mode must be 'process' or 'thread', got {}".format(mode))
+        # The process is not a daemon, as daemonic processes cannot start the DataLoader workers
+        self.worker = worker(target=evaluator_loop, daemon=mode == 'thread',
+                             args=(self.shared_model, self.meta, self.lock, self.pending, self.stop, self.queue,
+                                   dataset, val_df, criterion, pad_idx, config))
+        self.worker.start()
+
+    # Copies the weights of model into the shared snapshot and returns without waiting for the evaluation.
+    # Returns False if the evaluator was reading the previous snapshot and this one was skipped
+    def submit(self, model, epoch=0, batch=0):
+        model = getattr(model, 'module', model)
+        if not self.lock.acquire(False):
+            return False
+        try:
+            with torch.no_grad():
+                for shared, current in zip(self.shared_model.state_dict().values(), model.state_dict().values()):
+                    shared.copy_(current)
+            self.meta[0], self.meta[1] = epoch, batch
+        finally:
+            self.lock.release()
+        self.pending.set()
+        return True
+
+    # Reports and returns the results that arrived since the last call, never blocks
+    def poll(self):
+        new_results = []
+        while True:
+            try:
+                new_results.append(self.queue.get_nowait())
+            except queue.Empty:
+                break
+        for result in new_results:
+            self.report(result)
+        self.results.extend(new_results)
+        return new_results
+
+    def report(self, result):
+        print("Eval Epoch: {} Batch {}\tVal loss: {:.5f}  BLEU-1 {:.4f}  BLEU-4 {:.4f}  ({:.1f}s, {} images)".format(
+            result['epoch'], result['batch'], result['val_loss'], result['BLEU-1'], result['BLEU-4'],
+            result['eval_seconds'], result['images']))
+        for example in result['examples']:
+            print("    {}: {}".format(example['image'], example['predicted']))
+        if self.log_wandb:
+            import wandb
+            wandb.log({'eval/' + key: value for key, value in result.items() if isinstance(value, (int, float))})
+
+    # Stops the evaluator once the running evaluation is finished. With wait=True a submitted snapshot
+    # that was not picked up yet is evaluated first
+    def close(self, wait=True):
+        while wait and self.pending.is_set() and self.worker.is_alive():
+            time.sleep(0.05)
+        self.stop.set()
+        # The results are read while waiting, a process does not exit before its queue is flushed
+        while self.worker.is_alive():
+            self.worker.join(0.1)
+            self.poll()
+        self.poll()
+        return self.results
@@ -0,0 +1,207 @@
+import os
+import time
+import inspect
+import argparse
+import importlib
+import torch
+import torch.nn as nn
+from model.decoding import greedy_decode, EOS_IDX, PAD_IDX
+
+'''
+Export of a trained EncoderDecoder to TorchScript and ONNX as three graphs:
+    encoder      images (B, 3, H, W)            -> features (B, embed)
+    decoder_init features (B, embed)            -> logits, hidden, cell
+    decoder_step tokens (B,), hidden, cell      -> logits, hidden, cell   (embedding -> LSTM step -> fcn)
+The LSTM state is an explicit input/output, so the greedy loop only calls one graph per token.
+benchmark() compares the per-caption latency against eager mode and checks that the
+generated indices are identical.
+'''
+
+
+def check_exportable(decoder):
+    if getattr(decoder, 'adaptive', None) is not None:
+        raise ValueError('Only decoders with the full softmax fcn output layer can be exported')
+
+
+class DecoderInit(nn.Module):
+    def __init__(self, decoder):
+        super(DecoderInit, self).__init__()
+        check_exportable(decoder)
+        self.lstm = decoder.lstm
+        self.fcn = decoder.fcn
+
+    def forward(self, features):
+        output, (hidden, cell) = self.lstm(features.unsqueeze(1))
+        return self.fcn(output.squeeze(1)), hidden, cell
+
+
+class DecoderStep(nn.Module):
+    def __init__(self, decoder):
+        super(DecoderStep, self).__init__()
+        check_exportable(decoder)
+        self.embedding = decoder.embedding
+        self.lstm = decoder.lstm
+        self.fcn = decoder.fcn
+
+    def forward(self, tokens, hidden, cell):
+        output, (hidden, cell) = self.lstm(self.embedding(tokens).unsqueeze(1), (hidden, cell))
+        return self.fcn(output.squeeze(1)), hidden, cell
+
+
+# Example inputs of the three graphs for a batch of images
+def example_inputs(model, image_size=224, batch_size=1):
+    images = torch.randn(batch_size, 3, image_size, image_size)
+    with torch.no_grad():
+        features = model.encoder(images)
+        _, hidden, cell = DecoderInit(model.decoder)(features)
+    tokens = torch.zeros(batch_size, dtype=torch.long)
+    return images, features, (tokens, hidden, cell)
+
+
+def export_torchscript(model, out_dir, image_size=224):
+    model = model.eval()
+    os.makedirs(out_dir, exist_ok=True)
+    images, features, step_inputs = example_inputs(model, image_size)
+    paths = {}
+    with torch.no_grad():
+        graphs = {'encoder': (model.encoder, images),
+                  'decoder_init': (DecoderInit(model.decoder), features),
+                  'decoder_step': (DecoderStep(model.decoder), step_inputs)}
+        for name, (module, inputs) in graphs.items():
+            traced = torch.jit.trace(module, inputs)
+            paths[name] = os.path.join(out_dir, name + '.pt')
+            traced.save(paths[name])
+    return paths
+
+
+# onnx and onnxruntime are only needed for the ONNX path (see the pip section of environment.yml)
+def require_onnx_module(name):
+    try:
+        return importlib.import_module(name)
+    except ImportError as e:
+        raise ImportError('The ONNX export needs the {} package: pip install onnx onnxruntime'.format(name)) from e
+
+
+def export_onnx(model, out_dir, image_size=224, opset_version=17):
+    require_onnx_module('onnx')
+    model = model.eval()
+    os.makedirs(out_dir, exist_ok=True)
+    images, features, step_inputs = example_inputs(model, image_size)
+    # Newer PyTorch versions export with dynamo by default, the graphs here are traced
+    kwargs = {'dynamo': False} if 'dynamo' in inspect.signature(torch.onnx.export).parameters else {}
+    state_axes = {1: 'batch'}
+    graphs = {
+        'encoder': (model.encoder, (images,), ['images'], ['features'],
+                    {'images': {0: 'batch'}, 'features': {0: 'batch'}}),
+        'decoder_init': (DecoderInit(model.decoder), (features,), ['features'], ['logits', 'hidden', 'cell'],
+                         {'features': {0: 'batch'}, 'logits': {0: 'batch'}, 'hidden': state_axes, 'cell': state_axes}),
+        'decoder_step': (DecoderStep(model.decoder), step_inputs, ['tokens', 'hidden_in', 'cell_in'], ['logits', 'hidden', 'cell'],
+                         {'tokens': {0: 'batch'}, 'hidden_in': state_axes, 'cell_in': state_axes,
+                          'logits': {0: 'batch'}, 'hidden': state_axes, 'cell': state_axes}),
+    }
+    paths = {}
+    with torch.no_grad():
+        for name, (module, inputs, input_names, output_names, dynamic_axes) in graphs.items():
+            paths[name] = os.path.join(out_dir, name + '.onnx')
+            torch.onnx.export(module, inputs, paths[name], input_names=input_names, output_names=output_names,
+                              dynamic_axes=dynamic_axes, opset_version=opset_version, **kwargs)
+    return paths
+
+
+# The three graphs loaded as callables that take and return torch tensors
+def load_torchscript(paths):
+    return tuple(torch.jit.load(paths[name]).eval() for name in ('encoder', 'decoder_init', 'decoder_step'))
+
+
+def load_onnxruntime(paths, num_threads=None):
+    ort = require_onnx_module('onnxruntime')
+    options = ort.SessionOptions()
+    if num_threads is not None:
+        options.intra_op_num_threads = num_threads
+
+    def wrap(path):
+        session = ort.InferenceSession(path, options, providers=['CPUExecutionProvider'])
+        input_names = [i.name for i in session.get_inputs()]
+
+        def run(*inputs):
+            outputs = session.run(None, {name: x.numpy() for name, x in zip(input_names, inputs)})
+            outputs = tuple(torch.from_numpy(output) for output in outputs)
+            return outputs[0] if len(outputs) == 1 else outputs
+        return run
+    return tuple(wrap(paths[name]) for name in ('encoder', 'decoder_init', 'decoder_step'))
+
+
+# Greedy decoding with the exported graphs, same output as model.decoding.greedy_decode
+def exported_greedy_decode(encoder, decoder_init, decoder_step, images, max_len=20, eos_idx=EOS_IDX, pad_idx=PAD_IDX):
+    with torch.no_grad():
+        features = encoder(images)
+        logits, hidden, cell = decoder_init(features)
+        batch_size = features.size(0)
+        ids = torch.full((batch_size, max_len), pad_idx, dtype=torch.long)
+        lengths = torch.zeros(batch_size, dtype=torch.long)
+        finished = torch.zeros(batch_size, dtype=torch.bool)
+        for t in range(max_len):
+            predicted = logits.argmax(dim=1).masked_fill(finished, pad_idx)
+            ids[:, t] = predicted
+            lengths += (~finished).long()
+            finished |= predicted == eos_idx
+            if bool(finished.all()):
+                break
+            logits, hidden, cell = decoder_step(predicted, hidden, cell)
+    return ids[:, :t + 1], lengths
+
+
+def eager_greedy_decode(model, images, max_len=20):
+    with torch.no_grad():
+        return greedy_decode(model.decoder, model.encoder(images), max_len=max_len)
+
+
+# Mean per-caption latency (one image per call) of every backend and whether its indices match eager mode
+def benchmark(model, images, backends, runs=20, warmup=3, max_len=20):
+    model = model.eval()
+    decoders = {'eager': lambda x: eager_greedy_decode(model, x, max_len)}
+    for name, graphs in backends.items():
+        decoders[name] = lambda x, graphs=graphs: exported_greedy_decode(*graphs, x, max_len=max_len)
+
+    reference = [eager_greedy_decode(model, images[i:i + 1], max_len) for i in range(images.size(0))]
+    report = {}
+    for name, decode in decoders.items():
+        identical = all(torch.equal(decode(images[i:i + 1])[0], reference[i][0]) for i in range(images.size(0)))
+        for i in range(warmup):
+            decode(images[i % images.size(0):i % images.size(0) + 1])
+        start = time.perf_counter()
+        for i in range(runs):
+            decode(images[i % images.size(0):i % images.size(0) + 1])
+        latency_ms = (time.perf_counter() - start) / runs * 1000
+        report[name] = {'latency_ms': latency_ms, 'identical_to_eager': identical}
+        print("{:12s} {:8.2f} ms/caption  identical to eager: {}".format(name, latency_ms, identical))
+    return report
+
+
+if __name__ == '__main__':
+    from get_loader import Vocabulary
+    from model.model import EncoderDecoder
+    from model.backbones import BACKBONES
+
+    parser = argparse.ArgumentParser(description='Export the captioning model to TorchScript/ONNX and benchmark it')
+    parser.add_argument('--weights', required=True, help='state_dict of the trained EncoderDecoder')
+    parser.add_argument('--vocab', required=True, help='vocabulary artifact (vocab_cache/<hash>.json)')
+    parser.add_argument('--embed-size', type=int, default=300)
+    parser.add_argument('--hidden-size', type=int, default=512)
+    parser.add_argument('--num-layers', type=int, default=2)
+    parser.add_argument('--image-size', type=int, default=224)
+    parser.add_argument('--backbone', default='resnet50', choices=list(BACKBONES))
+    parser.add_argument('--out-dir', default='exported')
+    parser.add_argument('--onnx', action='store_true', help='also export to ONNX and benchmark ONNX Runtime')
+    parser.add_argument('--runs', type=int, default=20)
+    args = parser.parse_args()
+
+    model = EncoderDecoder(args.embed_size, args.hidden_size, len(Vocabulary.load(args.vocab)), args.num_layers, pretrained=False,
+                           backbone=args.backbone)
+    model.load_state_dict(torch.load(args.weights, map_location='cpu'))
+    model.eval()
+
+    backends = {'torchscript': load_torchscript(export_torchscript(model, args.out_dir, args.image_size))}
+    if args.onnx:
+        backends['onnxruntime'] = load_onnxruntime(export_onnx(model, args.out_dir, args.image_size))
+    benchmark(model, torch.randn(8, 3, args.image_size, args.image_size), backends, runs=args.runs)
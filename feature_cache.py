@@ -0,0 +1,145 @@
+import os
+import json
+import hashlib
+import numpy as np
+import torch
+from torch.utils.data import Dataset, DataLoader
+from PIL import Image
+from get_loader import ImageCaptionDataset
+
+'''
+The ResNet of EncoderCNN is frozen, so its pooled features never change during training.
+This file runs encoder.resnet once over a split, stores the pooled vectors in a memory-mapped
+.npy file indexed by image filename and serves (feature, caption) pairs from it, so that
+only encoder.embed and the DecoderRNN are trained on each batch.
+'''
+
+
+# Hash of the backbone weights and the transform, used as the cache key. A different
+# backbone or transform gives a different key, so old features are never reused by mistake
+def backbone_fingerprint(resnet, transform=None):
+    h = hashlib.sha1()
+    for name, tensor in resnet.state_dict().items():
+        h.update(name.encode())
+        h.update(tensor.detach().cpu().contiguous().numpy().tobytes())
+    h.update(repr(transform).encode())
+    return h.hexdigest()[:16]
+
+
+# Dataset over the unique images of a split, only used for the extraction pass
+class ImageOnlyDataset(Dataset):
+    def __init__(self, data_dir: str, image_names, transform=None):
+        self.data_dir = data_dir
+        self.image_names = list(image_names)
+        self.transform = transform
+
+    def __len__(self):
+        return len(self.image_names)
+
+    def __getitem__(self, idx: int):
+        img = Image.open(os.path.join(self.data_dir, self.image_names[idx])).convert('RGB')
+        if self.transform is not None:
+            img = self.transform(img)
+        return img, idx
+
+
+# Runs encoder.resnet over every unique image of the dataframe and writes the features to
+# <cache_dir>/<fingerprint>/<split>.npy. The transform must be deterministic (no random crops/flips)
+def extract_features(encoder, data_dir, dataframe, transform=None, cache_dir='feature_cache', split='train',
+                     batch_size=64, num_workers=1, device='cpu'):
+    resnet = encoder.resnet
+    store_dir = os.path.join(cache_dir, backbone_fingerprint(resnet, transform))
+    index_path = os.path.join(store_dir, split + '.json')
+    features_path = os.path.join(store_dir, split + '.npy')
+    image_names = sorted(dataframe['image'].unique())
+
+    # Reuse the store if it was completely written and covers every image of the split
+    if os.path.exists(index_path) and os.path.exists(features_path):
+        with open(index_path) as f:
+            index = json.load(f)
+        if all(name in index for name in image_names):
+            return store_dir
+
+    os.makedirs(store_dir, exist_ok=True)
+    loader = DataLoader(ImageOnlyDataset(data_dir, image_names, transform), batch_size=batch_size,
+                        num_workers=num_workers, shuffle=False)
+    tmp_path = features_path + '.tmp'
+    features = None
+    was_training = resnet.training
+    resnet.eval()
+    with torch.no_grad():
+        for images, idx in loader:
+            batch_features = resnet(images.to(device)).view(images.size(0), -1).cpu().numpy()
+            if features is None:
+                features = np.lib.format.open_memmap(tmp_path, mode='w+', dtype=np.float32,
+                                                     shape=(len(image_names), batch_features.shape[1]))
+            features[idx.numpy()] = batch_features
+    resnet.train(was_training)
+    features.flush()
+    del features
+    os.replace(tmp_path, features_path)
+
+    # The index is written last, so its presence means the features file is complete
+    index = {name: row for row, name in enumerate(image_names)}
+    with open(index_path + '.tmp', 'w') as f:
+        json.dump(index, f)
+    os.replace(index_path + '.tmp', index_path)
+    return store_dir
+
+
+# Read-only view of an extracted split, looked up by image filename
+class FeatureStore:
+    def __init__(self, store_dir: str, split: str = 'train'):
+        self.features_path = os.path.join(store_dir, split + '.npy')
+        with open(os.path.join(store_dir, split + '.json')) as f:
+            self.index = json.load(f)
+        self._features = None
+
+    def __len__(self):
+        return len(self.index)
+
+    # The memmap is opened lazily so every DataLoader worker maps the same file pages
+    @property
+    def features(self):
+        if self._features is None:
+            self._features = np.load(self.features_path, mmap_mode='r')
+        return self._features
+
+    def __getitem__(self, image_name: str):
+        return self.features[self.index[image_name]]
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['_features'] = None
+        return state
+
+
+# Same items as ImageCaptionDataset, but with the pooled feature vector instead of the image
+class FeatureCaptionDataset(Dataset):
+    def __init__(self, dataset, store: FeatureStore):
+        self.dataset = dataset
+        self.store = store
+        self.vocab = dataset.vocab
+
+    def __len__(self):
+        return len(self.dataset)
+
+    def __getitem__(self, idx: int):
+        img_dir = self.dataset.image_name(idx)
+        feature = torch.from_numpy(np.array(self.store[img_dir]))
+        return feature, self.dataset.encode_caption(idx), img_dir
+
+
+# Extracts (or reuses) the features of the split and returns a loader of (feature, caption, img_dir).
+# A prebuilt dataset (e.g. from get_loader_30k) can be passed to reuse its vocabulary and captions
+def get_feature_loader(encoder, data_dir, dataframe, transform=None, batch_size=None, num_workers=1, shuffle=True,
+                       pin_memory=True, cache_dir='feature_cache', split='train', device='cpu', dataset=None):
+    store_dir = extract_features(encoder, data_dir, dataframe, transform=transform, cache_dir=cache_dir,
+                                 split=split, num_workers=num_workers, device=device)
+    if dataset is None:
+        dataset = ImageCaptionDataset(data_dir=data_dir, dataframe=dataframe, transform=transform)
+    feature_dataset = FeatureCaptionDataset(dataset, FeatureStore(store_dir, split))
+    data_loader = DataLoader(dataset=feature_dataset, batch_size=batch_size,
+                             num_workers=num_workers, shuffle=shuffle,
+                             pin_memory=pin_memory, drop_last=True)
+    return data_loader
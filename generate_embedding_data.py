@@ -1,33 +1,56 @@
-import bcolz
-import pickle
+import os
+import argparse
 import numpy as np
 
 '''
-File to generate the needed Pickles and other files to
-use the pretrained embedding by only having the txt
+File to convert the GloVe txt into the files used to load the pretrained embedding:
+a memory-mapped float32 .npy matrix and a word index with one word per line, where the
+line number is the row of the word in the matrix (see utils/glove.py)
 '''
-main_path_miguel = r'C:\Users\Miguel\OneDrive\Escritorio\dlnn-project_ia-group_2\GLOVE EMBEDDING\300dim_embedding'
-main_path_pol = r"C:\Users\polme\OneDrive - UAB\Escritorio\Universitat\Deep Learning\Embeddings"
-
-
-glove_path = main_path_pol
-
-words = []
-idx = 0
-word2idx = {}
-vectors = bcolz.carray(np.zeros(1), rootdir=f'{glove_path}/6B.300.dat', mode='w')
-
-with open(f'{glove_path}/glove.6B.300d.txt', 'rb') as f:
-    for l in f:
-        line = l.decode().split()
-        word = line[0]
-        words.append(word)
-        word2idx[word] = idx
-        idx += 1
-        vect = np.array(line[1:]).astype(float)
-        vectors.append(vect)
-    
-vectors = bcolz.carray(vectors[1:].reshape((400000, 300)), rootdir=f'{glove_path}/6B.300.dat', mode='w')
-vectors.flush()
-pickle.dump(words, open(f'{glove_path}/6B.300_words.pkl', 'wb'))
-pickle.dump(word2idx, open(f'{glove_path}/6B.300_idx.pkl', 'wb'))
\ No newline at end of file
+
+
+def convert_glove(glove_txt, out_dir=None, chunk_lines=50000):
+    out_dir = out_dir or os.path.dirname(os.path.abspath(glove_txt))
+    name = os.path.splitext(os.path.basename(glove_txt))[0]
+    vectors_path = os.path.join(out_dir, name + '.npy')
+    words_path = os.path.join(out_dir, name + '.words.txt')
+    os.makedirs(out_dir, exist_ok=True)
+
+    # First pass only to know the matrix shape
+    with open(glove_txt, 'rb') as f:
+        num_words = sum(1 for _ in f)
+        f.seek(0)
+        dim = len(f.readline().rstrip().split(b' ')) - 1
+
+    vectors = np.lib.format.open_memmap(vectors_path + '.tmp', mode='w+', dtype=np.float32, shape=(num_words, dim))
+    words = []
+    row = 0
+    with open(glove_txt, 'r', encoding='utf-8') as f:
+        while True:
+            lines = f.readlines(chunk_lines * dim * 10)
+            if not lines:
+                break
+            values = []
+            for line in lines:
+                word, values_text = line.rstrip().split(' ', 1)
+                words.append(word)
+                values.append(values_text)
+            # A whole chunk of vectors is parsed with a single numpy call
+            chunk = np.fromstring(' '.join(values), dtype=np.float32, sep=' ').reshape(len(lines), dim)
+            vectors[row:row + len(lines)] = chunk
+            row += len(lines)
+    vectors.flush()
+    del vectors
+    os.replace(vectors_path + '.tmp', vectors_path)
+
+    with open(words_path, 'w', encoding='utf-8') as f:
+        f.write('\n'.join(words))
+    return vectors_path
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Convert a GloVe txt file into a .npy matrix and a word index')
+    parser.add_argument('glove_txt', help='path to the GloVe txt, e.g. glove.6B.300d.txt')
+    parser.add_argument('--out-dir', default=None, help='output folder, by default the folder of the txt')
+    args = parser.parse_args()
+    print('Saved', convert_glove(args.glove_txt, args.out_dir))
@@ -1,12 +1,16 @@
 import os
+import json
+import hashlib
+import numpy as np
 import pandas as pd
 import torch
 from torch.nn.utils.rnn import pad_sequence
-from torch.utils.data import Dataset, DataLoader
+from torch.utils.data import Dataset, DataLoader, Sampler
 from torchvision import transforms
 import nltk
 from nltk.tokenize import word_tokenize, sent_tokenize
 from collections import Counter
+from multiprocessing import Pool
 from PIL import Image
 from sklearn.model_selection import train_test_split
 import matplotlib.pyplot as plt
@@ -15,6 +19,13 @@ import matplotlib.pyplot as plt
 import matplotlib.image as mpimg
 
 
+# Version of the on-disk vocabulary artifact, bump it when the format or the tokenizer changes
+VOCAB_VERSION = 1
+
+# Vocabularies (and encoded captions) already built or loaded in this process, keyed by fingerprint
+_vocab_cache = {}
+
+
 # Class to generate the vocabulary for our LSTM
 class Vocabulary:
     def __init__(self, freq_threshold: int):
@@ -24,6 +35,8 @@ class Vocabulary:
         self.stoi = {k:v for v,k in self.itos.items() }
         # Frequency threshold indicator, leading to ignore
         self.freq_threshold = freq_threshold  
+        # Word counts of the captions the vocabulary was built from
+        self.frequencies = {}
         
     def __len__(self):
         return len(self.itos)
@@ -33,11 +46,15 @@ class Vocabulary:
         return [token.lower() for token in word_tokenize(text)]
     
     def build_vocabulary(self, captions):
+        self.build_vocabulary_from_tokens(self.vocab_tokenizer(caption) for caption in captions)
+    
+    # Same as build_vocabulary but from already tokenized captions (see tokenize_captions)
+    def build_vocabulary_from_tokens(self, tokenized_captions):
         frequencies = {}
         # Start idx 4 because of previous itos tokens
         idx = 4
-        for caption in captions:
-            for word in self.vocab_tokenizer(caption):
+        for tokens in tokenized_captions:
+            for word in tokens:
                 if word not in frequencies:
                     frequencies[word] = 1
                 else:
@@ -46,72 +63,352 @@ class Vocabulary:
                     self.stoi[word] = idx
                     self.itos[idx] = word
                     idx += 1      
+        self.frequencies = frequencies
+                    
+    # Encodes all the tokenized captions into one flat int32 array, caption i is tokens[offsets[i]:offsets[i+1]]
+    def encode_captions(self, tokenized_captions):
+        unk_idx = self.stoi['<UNK>']
+        lengths = np.fromiter((len(tokens) for tokens in tokenized_captions), dtype=np.int64, count=len(tokenized_captions))
+        offsets = np.zeros(len(tokenized_captions) + 1, dtype=np.int64)
+        np.cumsum(lengths, out=offsets[1:])
+        tokens = np.fromiter((self.stoi.get(word, unk_idx) for caption in tokenized_captions for word in caption),
+                             dtype=np.int32, count=int(offsets[-1]))
+        return tokens, offsets
                     
     def to_one_hot(self, text: str):
         tokenized_text = self.vocab_tokenizer(text)
         return [self.stoi[word] if word in self.stoi else self.stoi['<UNK>'] for word in tokenized_text]
 
+    # Hash of the captions and the frequency threshold, identifies the vocabulary built from them
+    @staticmethod
+    def fingerprint(captions, freq_threshold: int):
+        h = hashlib.sha1('v{}:{}'.format(VOCAB_VERSION, freq_threshold).encode())
+        for caption in captions:
+            h.update(str(caption).encode('utf-8'))
+            h.update(b'\0')
+        return h.hexdigest()[:16]
+
+    def save(self, path: str):
+        artifact = {'version': VOCAB_VERSION, 'freq_threshold': self.freq_threshold,
+                    'itos': [self.itos[idx] for idx in range(len(self.itos))], 'frequencies': self.frequencies}
+        with open(path + '.tmp', 'w', encoding='utf-8') as f:
+            json.dump(artifact, f)
+        os.replace(path + '.tmp', path)
+
+    @classmethod
+    def load(cls, path: str):
+        with open(path, encoding='utf-8') as f:
+            artifact = json.load(f)
+        if artifact['version'] != VOCAB_VERSION:
+            raise ValueError('Vocabulary artifact {} has version {}, expected {}'.format(path, artifact['version'], VOCAB_VERSION))
+        vocab = cls(artifact['freq_threshold'])
+        vocab.itos = dict(enumerate(artifact['itos']))
+        vocab.stoi = {k:v for v,k in vocab.itos.items()}
+        vocab.frequencies = artifact['frequencies']
+        return vocab
+
+
+# Tokenizes every caption once, spread over a process pool when num_workers > 1
+def tokenize_captions(captions, num_workers=1):
+    if num_workers is None or num_workers <= 1 or len(captions) < 1000:
+        return [Vocabulary.vocab_tokenizer(caption) for caption in captions]
+    chunksize = max(1, len(captions) // (num_workers * 8))
+    with Pool(num_workers) as pool:
+        return pool.map(Vocabulary.vocab_tokenizer, captions, chunksize=chunksize)
+
+
+# Returns the vocabulary and the encoded captions (see Vocabulary.encode_captions) of the captions.
+# They are built once and then reused from memory, or from <vocab_dir>/<fingerprint>.json/.npz
+# on later runs. vocab_dir=None keeps them only in memory
+def load_or_build_vocabulary(captions, freq_threshold: int=3, vocab_dir='vocab_cache', tokenize_workers=1):
+    key = Vocabulary.fingerprint(captions, freq_threshold)
+    if key in _vocab_cache:
+        return _vocab_cache[key]
+
+    if vocab_dir is not None:
+        vocab_path = os.path.join(vocab_dir, key + '.json')
+        tokens_path = os.path.join(vocab_dir, key + '.npz')
+        if os.path.exists(vocab_path) and os.path.exists(tokens_path):
+            arrays = np.load(tokens_path)
+            _vocab_cache[key] = (Vocabulary.load(vocab_path), arrays['tokens'], arrays['offsets'])
+            return _vocab_cache[key]
+
+    tokenized_captions = tokenize_captions(captions, num_workers=tokenize_workers)
+    vocab = Vocabulary(freq_threshold)
+    vocab.build_vocabulary_from_tokens(tokenized_captions)
+    tokens, offsets = vocab.encode_captions(tokenized_captions)
+
+    if vocab_dir is not None:
+        os.makedirs(vocab_dir, exist_ok=True)
+        # Token arrays first, the vocabulary json marks a complete artifact
+        with open(tokens_path + '.tmp', 'wb') as f:
+            np.savez(f, tokens=tokens, offsets=offsets)
+        os.replace(tokens_path + '.tmp', tokens_path)
+        vocab.save(vocab_path)
+
+    _vocab_cache[key] = (vocab, tokens, offsets)
+    return _vocab_cache[key]
+
+
+# Column of strings stored as one flat buffer of their UTF-8 bytes plus the offset of every string.
+# The dataset keeps its image names and captions in these instead of pandas Series, as reading a
+# Series (or a list of str) from a DataLoader worker writes the refcounts of its Python objects and
+# copies the pages holding them into every forked worker. Numpy buffers have no per-string objects
+class StringColumn:
+    def __init__(self, strings):
+        encoded = [str(string).encode('utf-8') for string in strings]
+        self.offsets = np.zeros(len(encoded) + 1, dtype=np.int64)
+        np.cumsum([len(data) for data in encoded], out=self.offsets[1:])
+        self.data = np.frombuffer(b''.join(encoded), dtype=np.uint8)
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def __getitem__(self, idx: int):
+        return self.data[self.offsets[idx]:self.offsets[idx + 1]].tobytes().decode('utf-8')
+
+    def tolist(self):
+        return [self[idx] for idx in range(len(self))]
+
       
 # Class for our dataloader to access
 class ImageCaptionDataset(Dataset):
-    def __init__(self, data_dir: str, dataframe, transform=None, freq_threshold: int=3):
+    def __init__(self, data_dir: str, dataframe, transform=None, freq_threshold: int=3, tokenize_workers: int=1, vocab_dir='vocab_cache',
+                 dynamic_padding: bool=False, image_store=None):
         # Data path
         self.data_dir = data_dir
         
-        # Image captions dataframe
-        self.df = dataframe
-            
         # Transform value
         self.transform = transform
         
-        # Images and captions from DF
-        self.images = self.df['image']
-        self.captions = self.df['caption']
+        # Optional ImageStore (see image_store.py) with the decoded and resized images
+        self.image_store = image_store
         
-        # Build vocabulary
-        self.vocab = Vocabulary(freq_threshold)
-        self.vocab.build_vocabulary(self.captions.tolist())
+        # Images and captions from DF, the dataframe itself is not kept. The image names are interned:
+        # every row holds the int32 id of its image in image_names (see StringColumn)
+        captions = dataframe['caption'].tolist()
+        image_ids, image_names = pd.factorize(dataframe['image'])
+        self.image_ids = image_ids.astype(np.int32)
+        self.image_names = StringColumn(image_names)
+        self.captions = StringColumn(captions)
+        
+        # Build vocabulary, the captions are tokenized only once and all the captions are stored
+        # as a flat int32 array of vocabulary indices with the offsets of each caption
+        self.vocab, self.tokens, self.offsets = load_or_build_vocabulary(captions, freq_threshold,
+                                                                          vocab_dir=vocab_dir, tokenize_workers=tokenize_workers)
         self.freq_threshold = freq_threshold
         self.max_caption_length = self.get_max_caption_length()  
+        self.pad_idx = self.vocab.stoi['<PAD>']
+        self.sos_idx = self.vocab.stoi['<SOS>']
+        self.eos_idx = self.vocab.stoi['<EOS>']
+        
+        # With dynamic padding the captions are returned unpadded, and CaptionCollate pads them to the batch maximum
+        self.dynamic_padding = dynamic_padding
         
     def __len__(self):
-        return len(self.df)  
+        return len(self.image_ids)  
+    
+    def image_name(self, idx: int):
+        return self.image_names[self.image_ids[idx]]
     
     def __getitem__(self, idx: int):
-        caption = self.captions.iloc[idx]
-        img_dir = self.images.iloc[idx]
-        img = Image.open(os.path.join(self.data_dir, img_dir)).convert('RGB')
+        img_dir = self.image_name(idx)
+        return self.load_image(img_dir), self.encode_caption(idx), img_dir
+    
+    # Decoded (or read from the image store) and transformed image
+    def load_image(self, img_dir: str):
+        if self.image_store is not None:
+            img = self.image_store.open(img_dir)
+        else:
+            img = Image.open(os.path.join(self.data_dir, img_dir)).convert('RGB')
         if self.transform is not None:
             img = self.transform(img)
-        one_hot_caption = [self.vocab.stoi['<SOS>']]
-        one_hot_caption.extend(self.vocab.to_one_hot(caption))
-        one_hot_caption.append(self.vocab.stoi['<EOS>'])
-        padded_vector = self.padded_caption(one_hot_caption)
-        return img, torch.tensor(padded_vector), img_dir
+        return img
+    
+    # Padded <SOS> ... <EOS> index tensor of the caption in row idx, sliced from the pre-tokenized array.
+    # Same result as padded_caption, captions longer than max_caption_length are truncated
+    def encode_caption(self, idx: int):
+        start, end = int(self.offsets[idx]), int(self.offsets[idx + 1])
+        length = end - start
+        num_tokens = min(length, self.max_caption_length - 1)
+        padded_vector = torch.full((self.max_caption_length,), self.pad_idx, dtype=torch.long)
+        padded_vector[0] = self.sos_idx
+        padded_vector[1:num_tokens + 1] = torch.from_numpy(self.tokens[start:start + num_tokens])
+        if length + 2 <= self.max_caption_length:
+            padded_vector[length + 1] = self.eos_idx
+        if self.dynamic_padding:
+            return padded_vector[:min(length + 2, self.max_caption_length)]
+        return padded_vector
+    
+    # Length of every encoded caption (with <SOS> and <EOS>) without padding, used for bucketing
+    def caption_lengths(self):
+        return np.minimum(np.diff(self.offsets) + 2, self.max_caption_length)
     
     def get_max_caption_length(self):
-        max_length = 0
-        for caption in self.captions:
-            tokenized_caption = self.vocab.vocab_tokenizer(caption)
-            max_length = max(max_length, len(tokenized_caption))  
-        return max_length 
+        return int(np.diff(self.offsets).max()) if len(self.offsets) > 1 else 0
     
     def padded_caption(self, caption):
         padded_caption = caption[:self.max_caption_length]
         padded_caption += [self.vocab.stoi["<PAD>"]] * (self.max_caption_length - len(padded_caption))
         return padded_caption
     
-def get_loader(data_dir, dataframe, transform=None, batch_size=None, num_workers=1, shuffle=True, pin_memory=True):
-    dataset = ImageCaptionDataset(data_dir=data_dir, dataframe=dataframe, transform=transform)
+# View of an ImageCaptionDataset with one item per unique image: (image, list of all its encoded captions,
+# image name). Every image is loaded once per epoch instead of once per caption. The rows of every image
+# are kept as offsets into an array of dataset rows sorted by image id
+class ImageGroupDataset(Dataset):
+    def __init__(self, dataset: ImageCaptionDataset):
+        self.dataset = dataset
+        self.vocab = dataset.vocab
+        self.pad_idx = dataset.pad_idx
+        num_images = len(dataset.image_names)
+        self.rows = np.argsort(dataset.image_ids, kind='stable')
+        self.offsets = np.zeros(num_images + 1, dtype=np.int64)
+        np.cumsum(np.bincount(dataset.image_ids, minlength=num_images), out=self.offsets[1:])
+    
+    def __len__(self):
+        return len(self.offsets) - 1
+    
+    def __getitem__(self, image_id: int):
+        img_dir = self.dataset.image_names[image_id]
+        rows = self.rows[self.offsets[image_id]:self.offsets[image_id + 1]]
+        return self.dataset.load_image(img_dir), [self.dataset.encode_caption(int(row)) for row in rows], img_dir
+    
+# Sampler over a permutation of the dataset that only depends on (seed, epoch), so an epoch can be
+# resumed at any position with set_position(epoch, start). Every complete iteration moves to the next epoch
+class ResumableSampler(Sampler):
+    def __init__(self, num_samples: int, shuffle: bool=True, seed: int=0):
+        self.num_samples = num_samples
+        self.shuffle = shuffle
+        self.seed = seed
+        self.epoch = 0
+        self.start = 0
+
+    def set_position(self, epoch: int, start: int=0):
+        self.epoch = epoch
+        self.start = start
+
+    def __iter__(self):
+        if self.shuffle:
+            indices = np.random.default_rng((self.seed, self.epoch)).permutation(self.num_samples)
+        else:
+            indices = np.arange(self.num_samples)
+        for idx in indices[self.start:]:
+            yield int(idx)
+        self.set_position(self.epoch + 1)
+
+    def __len__(self):
+        return self.num_samples
+
+
+# Batch sampler that groups captions of similar length. The indices are shuffled, cut into
+# pools of bucket_size batches, sorted by length inside each pool and split into batches,
+# and the order of the batches is shuffled again. With a seed the batches only depend on
+# (seed, epoch) and set_position(epoch, start) resumes an epoch at its batch start
+class BucketBatchSampler(Sampler):
+    def __init__(self, lengths, batch_size: int, shuffle: bool=True, drop_last: bool=True, bucket_size: int=100, seed=None):
+        self.lengths = np.asarray(lengths)
+        self.batch_size = batch_size
+        self.shuffle = shuffle
+        self.drop_last = drop_last
+        self.bucket_size = bucket_size
+        self.seed = seed
+        self.epoch = 0
+        self.start = 0
+
+    def set_position(self, epoch: int, start: int=0):
+        self.epoch = epoch
+        self.start = start
+
+    def __iter__(self):
+        rng = np.random.default_rng((self.seed, self.epoch)) if self.seed is not None else np.random
+        if self.shuffle:
+            indices = rng.permutation(len(self.lengths))
+        else:
+            indices = np.arange(len(self.lengths))
+        pool_size = self.batch_size * self.bucket_size
+        batches = []
+        for start in range(0, len(indices), pool_size):
+            pool = indices[start:start + pool_size]
+            pool = pool[np.argsort(self.lengths[pool], kind='stable')]
+            for batch_start in range(0, len(pool), self.batch_size):
+                batches.append(pool[batch_start:batch_start + self.batch_size])
+        if self.drop_last:
+            batches = [batch for batch in batches if len(batch) == self.batch_size]
+        if self.shuffle:
+            batches = [batches[i] for i in rng.permutation(len(batches))]
+        for batch in batches[self.start:]:
+            yield batch.tolist()
+        self.set_position(self.epoch + 1)
+
+    def __len__(self):
+        if self.drop_last:
+            # Every pool but the last one is a multiple of batch_size, so only the last batch can be incomplete
+            return len(self.lengths) // self.batch_size
+        return (len(self.lengths) + self.batch_size - 1) // self.batch_size
+
+
+# Collate function that pads the captions only up to the longest caption of the batch
+class CaptionCollate:
+    def __init__(self, pad_idx: int):
+        self.pad_idx = pad_idx
+
+    def __call__(self, batch):
+        images, captions, img_dirs = zip(*batch)
+        images = torch.stack(images)
+        captions = pad_sequence(captions, batch_first=True, padding_value=self.pad_idx)
+        return images, captions, list(img_dirs)
+
+
+# Collate function of ImageGroupDataset batches: (unique images, all their captions, image names, image_index),
+# where image_index[i] is the row in images of the image of caption i
+class GroupedCaptionCollate:
+    def __init__(self, pad_idx: int):
+        self.pad_idx = pad_idx
+
+    def __call__(self, batch):
+        images, captions, img_dirs = zip(*batch)
+        counts = torch.tensor([len(image_captions) for image_captions in captions])
+        image_index = torch.repeat_interleave(torch.arange(len(images)), counts)
+        captions = pad_sequence([caption for image_captions in captions for caption in image_captions],
+                                batch_first=True, padding_value=self.pad_idx)
+        return torch.stack(images), captions, list(img_dirs), image_index
+
+
+def get_loader(data_dir, dataframe, transform=None, batch_size=None, num_workers=1, shuffle=True, pin_memory=True, tokenize_workers=1, vocab_dir='vocab_cache',
+               bucketing=False, image_store=None, seed=None, group_images=False):
+    # With bucketing=True the batches group captions of similar length and are padded only to their longest caption.
+    # With an image_store the images are read from it instead of decoding the JPEGs in data_dir.
+    # With a seed the order of every epoch only depends on (seed, epoch) and can be resumed mid-epoch (see checkpoint.py).
+    # With group_images=True every batch holds batch_size unique images with all their captions and a 4th element,
+    # the image_index of the captions, so that EncoderDecoder encodes each image once
+    dataset = ImageCaptionDataset(data_dir=data_dir, dataframe=dataframe, transform=transform, tokenize_workers=tokenize_workers,
+                                  vocab_dir=vocab_dir, dynamic_padding=bucketing, image_store=image_store)
     pad_idx = dataset.vocab.stoi['<PAD>']
+    if group_images:
+        if bucketing:
+            raise ValueError('group_images and bucketing cannot be combined')
+        group_dataset = ImageGroupDataset(dataset)
+        if seed is not None:
+            return DataLoader(dataset=group_dataset, batch_size=batch_size, sampler=ResumableSampler(len(group_dataset), shuffle, seed),
+                              collate_fn=GroupedCaptionCollate(pad_idx), num_workers=num_workers, pin_memory=pin_memory, drop_last=True)
+        return DataLoader(dataset=group_dataset, batch_size=batch_size, shuffle=shuffle, collate_fn=GroupedCaptionCollate(pad_idx),
+                          num_workers=num_workers, pin_memory=pin_memory, drop_last=True)
+    if bucketing:
+        batch_sampler = BucketBatchSampler(dataset.caption_lengths(), batch_size, shuffle=shuffle, drop_last=True, seed=seed)
+        data_loader = DataLoader(dataset=dataset, batch_sampler=batch_sampler, collate_fn=CaptionCollate(pad_idx),
+                                 num_workers=num_workers, pin_memory=pin_memory)
+        return data_loader
+    if seed is not None:
+        return DataLoader(dataset=dataset, batch_size=batch_size, sampler=ResumableSampler(len(dataset), shuffle, seed),
+                          num_workers=num_workers, pin_memory=pin_memory, drop_last=True)
     data_loader  = DataLoader(dataset=dataset, batch_size=batch_size,
                          num_workers=num_workers, shuffle=shuffle,
                          pin_memory=pin_memory, drop_last=True) 
     return data_loader 
  
-def get_vocab(data_dir, dataframe, transform=None):
-    dataset = ImageCaptionDataset(data_dir=data_dir, dataframe=dataframe, transform=transform)
-    vocab = dataset.vocab
+def get_vocab(data_dir, dataframe, transform=None, freq_threshold=3, vocab_dir='vocab_cache', tokenize_workers=1):
+    vocab, _, _ = load_or_build_vocabulary(dataframe['caption'].tolist(), freq_threshold, vocab_dir=vocab_dir,
+                                           tokenize_workers=tokenize_workers)
     return vocab.itos
 
 def show_image(tensor, title=None):
@@ -123,9 +420,8 @@ def show_image(tensor, title=None):
     plt.pause(0.001)
 
 
-def get_pad_index(data_dir, dataframe, transform=None):
-    dataset = ImageCaptionDataset(data_dir=data_dir, dataframe=dataframe, transform=transform)
-    pad_idx = dataset.vocab.stoi['<PAD>']
+def get_pad_index(data_dir, dataframe, transform=None, freq_threshold=3, vocab_dir='vocab_cache', tokenize_workers=1):
+    vocab, _, _ = load_or_build_vocabulary(dataframe['caption'].tolist(), freq_threshold, vocab_dir=vocab_dir,
+                                           tokenize_workers=tokenize_workers)
+    pad_idx = vocab.stoi['<PAD>']
     return pad_idx
-
-
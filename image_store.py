@@ -0,0 +1,95 @@
+import os
+import json
+import numpy as np
+from multiprocessing import Pool
+from PIL import Image
+import torchvision.transforms.functional as TF
+
+'''
+Every Flickr image appears five times in the captions CSV, so ImageCaptionDataset decodes
+each full size JPEG five times per epoch. This file decodes and resizes every image once into
+a memory-mapped (N, size, size, 3) uint8 .npy file with an image name index. Passing the
+ImageStore to ImageCaptionDataset (or get_loader) makes it read the images from there.
+
+The images keep their aspect ratio: the short side is resized to size and the center
+size x size square is kept, the output of transforms.Resize(size) + transforms.CenterCrop(size)
+on the JPEG. A transform that starts with Resize(size) and crops at most size x size gives the
+same result on the stored image as on the JPEG, the Resize being a no-op there.
+'''
+
+# File names of the store for a given size, without extension (.npy images, .json index)
+STORE_NAME = 'images_{}_center_crop'
+
+
+# Decodes one image, resizes its short side to size and crops the center square, runs in the pool workers
+def load_resized(args):
+    path, size = args
+    img = TF.center_crop(TF.resize(Image.open(path).convert('RGB'), size), size)
+    return np.asarray(img, dtype=np.uint8)
+
+
+# Writes the images of the dataframe to <out_dir>/images_<size>_center_crop.npy and its index to
+# images_<size>_center_crop.json. An existing store that already contains all the images is reused
+def build_image_store(data_dir, dataframe, out_dir='image_store', size=256, num_workers=os.cpu_count()):
+    images_path = os.path.join(out_dir, STORE_NAME.format(size) + '.npy')
+    index_path = os.path.join(out_dir, STORE_NAME.format(size) + '.json')
+    image_names = sorted(dataframe['image'].unique())
+
+    if os.path.exists(index_path) and os.path.exists(images_path):
+        with open(index_path) as f:
+            index = json.load(f)
+        if all(name in index for name in image_names):
+            return out_dir
+
+    os.makedirs(out_dir, exist_ok=True)
+    tmp_path = images_path + '.tmp'
+    images = np.lib.format.open_memmap(tmp_path, mode='w+', dtype=np.uint8, shape=(len(image_names), size, size, 3))
+    jobs = [(os.path.join(data_dir, name), size) for name in image_names]
+    if num_workers is None or num_workers <= 1:
+        for row, job in enumerate(jobs):
+            images[row] = load_resized(job)
+    else:
+        with Pool(num_workers) as pool:
+            for row, img in enumerate(pool.imap(load_resized, jobs, chunksize=16)):
+                images[row] = img
+    images.flush()
+    del images
+    os.replace(tmp_path, images_path)
+
+    # The index is written last, so its presence means the images file is complete
+    with open(index_path + '.tmp', 'w') as f:
+        json.dump({name: row for row, name in enumerate(image_names)}, f)
+    os.replace(index_path + '.tmp', index_path)
+    return out_dir
+
+
+# Read-only view of a store written by build_image_store, looked up by image name
+class ImageStore:
+    def __init__(self, store_dir: str = 'image_store', size: int = 256):
+        self.images_path = os.path.join(store_dir, STORE_NAME.format(size) + '.npy')
+        with open(os.path.join(store_dir, STORE_NAME.format(size) + '.json')) as f:
+            self.index = json.load(f)
+        self._images = None
+
+    def __len__(self):
+        return len(self.index)
+
+    # The memmap is opened lazily in each DataLoader worker, so all the workers share the page cache
+    @property
+    def images(self):
+        if self._images is None:
+            self._images = np.load(self.images_path, mmap_mode='r')
+        return self._images
+
+    # (size, size, 3) uint8 view of the image, no copy is made
+    def __getitem__(self, image_name: str):
+        return self.images[self.index[image_name]]
+
+    # The PIL image the transforms of ImageCaptionDataset expect
+    def open(self, image_name: str):
+        return Image.fromarray(self[image_name])
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['_images'] = None
+        return state
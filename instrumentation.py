@@ -0,0 +1,252 @@
+import os
+import csv
+import time
+from contextlib import nullcontext
+import torch
+
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None
+
+'''
+Optional per-batch instrumentation of train(), train_and_visualize_caps() and validate().
+Every batch is split into the time spent waiting on the DataLoader, the host to device copy,
+forward, backward and optimizer step, and each step also records samples/sec and the peak RSS
+of the process. Records and per-epoch summaries go to pluggable sinks (console, CSV, wandb),
+and a torch profiler trace can be captured for a window of steps:
+
+    instrument = Instrumentation(sinks=[ConsoleSink(every=50), CSVSink('perf.csv')], profile_steps=(10, 20))
+    train(criterion, model, optimizer, loader, device, instrument=instrument)
+
+On CUDA each stage synchronizes the device when it ends (sync_cuda=True), otherwise the
+asynchronous kernels would be attributed to whichever stage synchronizes next.
+'''
+
+STAGES = ('data_wait', 'h2d', 'forward', 'backward', 'optimizer')
+
+
+# Peak resident set size of the process in MB, None where the resource module is not available
+def peak_rss_mb():
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss is in bytes on macOS and in KB on Linux
+    return peak / 1024 ** 2 if os.uname().sysname == 'Darwin' else peak / 1024
+
+
+class ConsoleSink:
+    def __init__(self, every=50):
+        self.every = every
+
+    def write(self, record):
+        if record['step'] % self.every == 0:
+            print('[{phase}] step {step}  {ms}  {samples_per_s:.1f} samples/s'.format(
+                ms='  '.join('{} {:.1f}ms'.format(stage, record[stage + '_ms']) for stage in record['stages']), **record))
+
+    def summary(self, summary):
+        print('[{phase}] epoch {epoch}: {steps} steps, {samples_per_s:.1f} samples/s, peak RSS {rss}'.format(
+            rss='{:.0f} MB'.format(summary['peak_rss_mb']) if summary['peak_rss_mb'] is not None else 'n/a', **summary))
+        for stage in summary['stages']:
+            print('    {:10s} {:8.2f} ms/step  {:5.1%}'.format(stage, summary[stage + '_ms'], summary[stage + '_fraction']))
+
+    def close(self):
+        pass
+
+
+# One CSV row per step, appended to path
+class CSVSink:
+    FIELDS = ['phase', 'epoch', 'step', 'batch_size'] + [stage + '_ms' for stage in STAGES] + \
+             ['step_ms', 'samples_per_s', 'peak_rss_mb']
+
+    def __init__(self, path):
+        self.file = open(path, 'a', newline='')
+        self.writer = csv.DictWriter(self.file, fieldnames=self.FIELDS, extrasaction='ignore')
+        if self.file.tell() == 0:
+            self.writer.writeheader()
+
+    def write(self, record):
+        self.writer.writerow(record)
+
+    def summary(self, summary):
+        self.file.flush()
+
+    def close(self):
+        self.file.close()
+
+
+# Logs the steps (every `every` steps) and the epoch summaries to the active wandb run
+class WandbSink:
+    def __init__(self, every=10, prefix='perf'):
+        import wandb
+        self.wandb = wandb
+        self.every = every
+        self.prefix = prefix
+
+    def write(self, record):
+        if record['step'] % self.every == 0:
+            self.wandb.log({'{}/{}/{}'.format(self.prefix, record['phase'], key): value for key, value in record.items()
+                            if isinstance(value, (int, float)) and key not in ('step', 'epoch')})
+
+    def summary(self, summary):
+        self.wandb.log({'{}/{}/epoch_{}'.format(self.prefix, summary['phase'], key): value for key, value in summary.items()
+                        if isinstance(value, (int, float)) and key != 'epoch'})
+
+    def close(self):
+        pass
+
+
+class Instrumentation:
+    def __init__(self, sinks=None, profile_steps=None, profile_dir='profiler_traces', sync_cuda=True):
+        self.sinks = list(sinks) if sinks is not None else [ConsoleSink()]
+        # (first, last) global train step of the profiler window, None disables the profiler
+        self.profile_steps = profile_steps
+        self.profile_dir = profile_dir
+        self.sync = sync_cuda and torch.cuda.is_available()
+        self.profiler = None
+        self.global_step = 0
+        self.epochs = {}
+        self.summaries = []
+        self.phase = None
+        self.phase_step = 0
+        self.current = None
+
+    # Iterates over loader timing the wait for every batch. phase names the loop ('train', 'validate', ...)
+    def iterate(self, loader, phase='train'):
+        self.phase = phase
+        self.phase_step = 0
+        self.epochs[phase] = self.epochs.get(phase, 0) + 1
+        records = []
+        start_time = time.perf_counter()
+        iterator = iter(loader)
+        try:
+            while True:
+                wait_start = time.perf_counter()
+                try:
+                    batch = next(iterator)
+                except StopIteration:
+                    break
+                self.begin_step(wait_start)
+                self.current['durations']['data_wait'] = time.perf_counter() - wait_start
+                yield batch
+                if self.current is not None:
+                    records.append(self.end_step())
+        finally:
+            self.stop_profiler()
+            if records:
+                self.emit_summary(phase, records, time.perf_counter() - start_time)
+
+    def begin_step(self, start):
+        if self.phase == 'train' and self.profile_steps is not None and self.global_step == self.profile_steps[0]:
+            self.start_profiler()
+        self.current = {'start': start, 'durations': {}, 'batch_size': 0}
+
+    # Times the body of the with block as the given stage of the current step
+    def stage(self, name):
+        if self.current is None:
+            return nullcontext()
+        return StageTimer(self, name)
+
+    def set_batch_size(self, batch_size):
+        if self.current is not None:
+            self.current['batch_size'] = batch_size
+
+    def end_step(self):
+        step_time = time.perf_counter() - self.current['start']
+        durations = self.current['durations']
+        stages = [stage for stage in STAGES if stage in durations] + [stage for stage in durations if stage not in STAGES]
+        # Train steps are numbered globally across epochs (as the profiler window), the others within the epoch
+        step = self.global_step if self.phase == 'train' else self.phase_step
+        record = {'phase': self.phase, 'epoch': self.epochs[self.phase], 'step': step,
+                  'batch_size': self.current['batch_size'], 'stages': stages, 'step_ms': step_time * 1000,
+                  'samples_per_s': self.current['batch_size'] / step_time if step_time > 0 else 0.0,
+                  'peak_rss_mb': peak_rss_mb()}
+        for stage in stages:
+            record[stage + '_ms'] = durations[stage] * 1000
+        self.current = None
+        self.phase_step += 1
+        if self.phase == 'train':
+            self.global_step += 1
+            if self.profiler is not None and self.global_step > self.profile_steps[1]:
+                self.stop_profiler()
+        for sink in self.sinks:
+            sink.write(record)
+        return record
+
+    def emit_summary(self, phase, records, elapsed):
+        steps = len(records)
+        samples = sum(record['batch_size'] for record in records)
+        step_total = sum(record['step_ms'] for record in records)
+        stages = []
+        for record in records:
+            stages += [stage for stage in record['stages'] if stage not in stages]
+        summary = {'phase': phase, 'epoch': self.epochs[phase], 'steps': steps, 'samples': samples,
+                   'elapsed_s': elapsed, 'samples_per_s': samples / elapsed if elapsed > 0 else 0.0,
+                   'step_ms': step_total / steps, 'peak_rss_mb': peak_rss_mb(), 'stages': stages}
+        for stage in stages:
+            stage_total = sum(record.get(stage + '_ms', 0.0) for record in records)
+            summary[stage + '_ms'] = stage_total / steps
+            summary[stage + '_fraction'] = stage_total / step_total if step_total > 0 else 0.0
+        self.summaries.append(summary)
+        for sink in self.sinks:
+            sink.summary(summary)
+
+    def start_profiler(self):
+        activities = [torch.profiler.ProfilerActivity.CPU]
+        if torch.cuda.is_available():
+            activities.append(torch.profiler.ProfilerActivity.CUDA)
+        self.profiler = torch.profiler.profile(activities=activities, record_shapes=True, profile_memory=True)
+        self.profiler.__enter__()
+
+    def stop_profiler(self):
+        if self.profiler is None:
+            return
+        self.profiler.__exit__(None, None, None)
+        os.makedirs(self.profile_dir, exist_ok=True)
+        path = os.path.join(self.profile_dir, 'trace_steps_{}-{}.json'.format(*self.profile_steps))
+        self.profiler.export_chrome_trace(path)
+        print('Profiler trace written to', path)
+        self.profiler = None
+
+    def close(self):
+        self.stop_profiler()
+        for sink in self.sinks:
+            sink.close()
+
+
+class StageTimer:
+    def __init__(self, instrumentation, name):
+        self.instrumentation = instrumentation
+        self.name = name
+        # Stage labels in the profiler trace
+        self.label = torch.profiler.record_function(name) if instrumentation.profiler is not None else None
+
+    def __enter__(self):
+        if self.label is not None:
+            self.label.__enter__()
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        if self.instrumentation.sync:
+            torch.cuda.synchronize()
+        durations = self.instrumentation.current['durations']
+        durations[self.name] = durations.get(self.name, 0.0) + time.perf_counter() - self.start
+        if self.label is not None:
+            self.label.__exit__(*exc)
+        return False
+
+
+# Stand-in used when the loops run without instrumentation, every hook is a no-op
+class NoInstrumentation:
+    def iterate(self, loader, phase='train'):
+        return loader
+
+    def stage(self, name):
+        return nullcontext()
+
+    def set_batch_size(self, batch_size):
+        pass
+
+
+NO_INSTRUMENTATION = NoInstrumentation()
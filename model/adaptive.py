@@ -0,0 +1,74 @@
+import torch
+import torch.nn as nn
+from model.decoding import PAD_IDX, SOS_IDX, EOS_IDX
+
+'''
+Adaptive softmax output layer (Grave et al.) for DecoderRNN, in place of the full vocabulary
+projection fcn. The vocabulary is sorted by word frequency: the most frequent words form the
+head, which is computed for every timestep, and the rare words are split into tail clusters
+with smaller projections that are only computed for the timesteps that need them.
+The vocabulary indices of get_loader.py are not frequency sorted, so the head keeps the
+permutation between both orders and callers only ever see vocabulary indices.
+'''
+
+
+# Vocabulary indices sorted from the most to the least frequent word, from the counts of
+# Vocabulary.build_vocabulary. <PAD>, <SOS> and <EOS> (targets of every caption) go first,
+# <UNK> counts all the words below the frequency threshold
+def frequency_order(vocab):
+    counts = {idx: 0 for idx in range(len(vocab))}
+    for word, count in vocab.frequencies.items():
+        counts[vocab.stoi.get(word, vocab.stoi['<UNK>'])] += count
+    special = [PAD_IDX, SOS_IDX, EOS_IDX]
+    rest = sorted((idx for idx in counts if idx not in special), key=lambda idx: -counts[idx])
+    return special + rest
+
+
+# Head size and cluster boundaries for a vocabulary of vocab_size words
+def default_cutoffs(vocab_size, cutoffs=(2000, 10000, 50000)):
+    cutoffs = [cutoff for cutoff in cutoffs if cutoff < vocab_size]
+    return cutoffs if cutoffs else [max(1, vocab_size // 2)]
+
+
+class AdaptiveHead(nn.Module):
+    def __init__(self, hidden_size, vocab_size, cutoffs, order=None, div_value=4.0):
+        super(AdaptiveHead, self).__init__()
+        self.asm = nn.AdaptiveLogSoftmaxWithLoss(hidden_size, vocab_size, list(cutoffs), div_value=div_value)
+        order = torch.as_tensor(order if order is not None else range(vocab_size), dtype=torch.long)
+        # idx_of[position in the frequency order] = vocabulary index, rank_of is the inverse
+        self.register_buffer('idx_of', order)
+        self.register_buffer('rank_of', torch.empty_like(order).scatter_(0, order, torch.arange(vocab_size)))
+
+    # Mean negative log-likelihood of the (N,) vocabulary index targets given the (N, hidden) LSTM outputs
+    def loss(self, hidden, targets):
+        return self.asm(hidden, self.rank_of[targets]).loss
+
+    # (N, vocab) log-probabilities in vocabulary order, computes every cluster
+    def log_prob(self, hidden):
+        return self.asm.log_prob(hidden)[:, self.rank_of]
+
+    # Most likely word of each row, the tail clusters are only computed for the rows whose best head entry is a cluster
+    def predict(self, hidden):
+        return self.idx_of[self.asm.predict(hidden)]
+
+    # Exact top-k words of each row and their log-probabilities. A tail word scores at most the log-probability
+    # of its cluster, so a cluster is only computed for the rows where it can beat the current k-th candidate.
+    # k must not exceed the head size (cutoffs[0])
+    def topk(self, hidden, k):
+        asm = self.asm
+        head_log_probs = torch.log_softmax(asm.head(hidden), dim=1)
+        values, positions = head_log_probs[:, :asm.shortlist_size].topk(k, dim=1)
+        for i in range(asm.n_clusters):
+            cluster_log_prob = head_log_probs[:, asm.shortlist_size + i]
+            rows = (cluster_log_prob > values[:, -1]).nonzero().squeeze(1)
+            if rows.numel() == 0:
+                continue
+            start, end = asm.cutoffs[i], asm.cutoffs[i + 1]
+            tail_log_probs = torch.log_softmax(asm.tail[i](hidden[rows]), dim=1) + cluster_log_prob[rows].unsqueeze(1)
+            tail_positions = torch.arange(start, end, device=hidden.device).expand(rows.numel(), -1)
+            merged_values = torch.cat((values[rows], tail_log_probs), dim=1)
+            merged_positions = torch.cat((positions[rows], tail_positions), dim=1)
+            top_values, top_idx = merged_values.topk(k, dim=1)
+            values[rows] = top_values
+            positions[rows] = merged_positions.gather(1, top_idx)
+        return values, self.idx_of[positions]
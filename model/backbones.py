@@ -0,0 +1,58 @@
+import os
+import torch
+import torch.nn as nn
+import torchvision.models as models
+
+'''
+Image backbones of EncoderCNN. Every entry builds a torchvision classification network and
+returns its trunk, the layers up to and including the global average pooling, which maps
+(N, 3, H, W) images to (N, C, 1, 1) features. The embed projection of EncoderCNN is sized from
+C, registered with the trunk, so any trunk registered here works with the same decoder.
+
+The weights are the torchvision ImageNet ones registered with the trunk, IMAGENET1K_V1 for every
+backbone as the former pretrained=True (DEFAULT is IMAGENET1K_V2 for resnet50 and
+mobilenet_v3_large, which gives other features), downloaded when pretrained=True, or read from a local file (the state_dict of the full torchvision model)
+with weights_path, which needs no network access. hub_weights_filename gives the name of that
+file in the torchvision cache (~/.cache/torch/hub/checkpoints).
+'''
+
+
+def resnet_trunk(net):
+    return nn.Sequential(*list(net.children())[:-1])
+
+
+# features + avgpool, the classifier head is dropped
+def pooled_features_trunk(net):
+    return nn.Sequential(net.features, net.avgpool)
+
+
+# name: (torchvision constructor name, pretrained weights, trunk of the constructed network, channels C of its pooled features)
+BACKBONES = {
+    'resnet18': ('resnet18', models.ResNet18_Weights.IMAGENET1K_V1, resnet_trunk, 512),
+    'resnet34': ('resnet34', models.ResNet34_Weights.IMAGENET1K_V1, resnet_trunk, 512),
+    'resnet50': ('resnet50', models.ResNet50_Weights.IMAGENET1K_V1, resnet_trunk, 2048),
+    'mobilenet_v3_small': ('mobilenet_v3_small', models.MobileNet_V3_Small_Weights.IMAGENET1K_V1, pooled_features_trunk, 576),
+    'mobilenet_v3_large': ('mobilenet_v3_large', models.MobileNet_V3_Large_Weights.IMAGENET1K_V1, pooled_features_trunk, 960),
+    'efficientnet_b0': ('efficientnet_b0', models.EfficientNet_B0_Weights.IMAGENET1K_V1, pooled_features_trunk, 1280),
+}
+
+
+def check_backbone(name):
+    if name not in BACKBONES:
+        raise ValueError('Unknown backbone {}, available: {}'.format(name, ', '.join(BACKBONES)))
+
+
+# File name of the pretrained weights of a backbone in the torchvision cache, e.g. resnet50-0676ba61.pth
+def hub_weights_filename(name):
+    check_backbone(name)
+    return os.path.basename(BACKBONES[name][1].url)
+
+
+# Returns (trunk, feature dimension) of a registered backbone
+def build_backbone(name='resnet50', pretrained=True, weights_path=None):
+    check_backbone(name)
+    constructor, weights, make_trunk, feature_dim = BACKBONES[name]
+    net = getattr(models, constructor)(weights=weights if pretrained and weights_path is None else None)
+    if weights_path is not None:
+        net.load_state_dict(torch.load(weights_path, map_location='cpu'))
+    return make_trunk(net), feature_dim
@@ -0,0 +1,142 @@
+import torch
+
+'''
+Caption generation shared by the DecoderRNN of model.py and model_dropout.py.
+Every function works on a whole batch of image features at once and only returns
+index tensors, the conversion to words is done once at the end with ids_to_captions.
+'''
+
+# Indices of the special tokens, fixed by the Vocabulary class of get_loader.py
+PAD_IDX = 0
+SOS_IDX = 1
+EOS_IDX = 2
+
+
+def check_max_len(max_len):
+    if max_len < 1:
+        raise ValueError('max_len must be at least 1, got {}'.format(max_len))
+
+
+# Greedy decoding of a (B, embed) feature batch. Returns the (B, T) predicted indices, padded
+# with PAD after each row's <EOS>, and the (B,) lengths of each row including its <EOS>
+def greedy_decode(decoder, features, hidden=None, max_len=20, eos_idx=EOS_IDX, pad_idx=PAD_IDX):
+    check_max_len(max_len)
+    batch_size = features.size(0)
+    device = features.device
+    inputs = features.unsqueeze(1)
+    ids = torch.full((batch_size, max_len), pad_idx, dtype=torch.long, device=device)
+    lengths = torch.zeros(batch_size, dtype=torch.long, device=device)
+    finished = torch.zeros(batch_size, dtype=torch.bool, device=device)
+
+    for t in range(max_len):
+        output, hidden = decoder.lstm(inputs, hidden)
+        predicted = decoder.predict(output.squeeze(1))
+        # Rows that already produced <EOS> only emit padding
+        predicted = predicted.masked_fill(finished, pad_idx)
+        ids[:, t] = predicted
+        lengths += (~finished).long()
+        finished |= predicted == eos_idx
+        # Single host sync per step for the whole batch
+        if bool(finished.all()):
+            break
+        inputs = decoder.embedding(predicted.unsqueeze(1))
+
+    return ids[:, :t + 1], lengths
+
+
+# Converts the index tensor of a decoded batch to lists of words with a single device to host copy.
+# vocab is the itos dict returned by get_vocab. With strip=True the <SOS>/<EOS>/<PAD> tokens are removed
+def ids_to_captions(ids, lengths, vocab, strip=True):
+    special = {PAD_IDX, SOS_IDX, EOS_IDX} if strip else set()
+    captions = []
+    for row, length in zip(ids.tolist(), lengths.tolist()):
+        captions.append([vocab[idx] for idx in row[:length] if idx not in special])
+    return captions
+
+
+# GNMT length penalty, divides the summed log-probabilities by ((5 + length) / 6) ** length_penalty.
+# length_penalty=0 keeps the raw scores, larger values favour longer captions
+def length_normalize(scores, lengths, length_penalty=0.7):
+    return scores / ((5.0 + lengths.float()) / 6.0) ** length_penalty
+
+
+# Beam search over a (B, embed) feature batch. All the beams of all the images run as a single
+# (B*K) LSTM step, the hypotheses and the LSTM state are reordered with index_select, and the
+# images whose K beams all produced <EOS> are removed from the batch. Returns the best hypothesis
+# of each image (after length normalization) with the same format as greedy_decode
+def beam_search_decode(decoder, features, beam_size=3, max_len=20, length_penalty=0.7, eos_idx=EOS_IDX, pad_idx=PAD_IDX):
+    check_max_len(max_len)
+    batch_size = features.size(0)
+    device = features.device
+    k = beam_size
+
+    # Finished hypotheses of every image
+    out_ids = torch.full((batch_size, k, max_len), pad_idx, dtype=torch.long, device=device)
+    out_lengths = torch.zeros((batch_size, k), dtype=torch.long, device=device)
+    out_scores = torch.zeros((batch_size, k), device=device)
+
+    # Rows a*k ... a*k+k-1 hold the beams of the a-th active image
+    active = torch.arange(batch_size, device=device)
+    inputs = features.repeat_interleave(k, dim=0).unsqueeze(1)
+    hidden = None
+    ids = torch.full((batch_size * k, max_len), pad_idx, dtype=torch.long, device=device)
+    lengths = torch.zeros(batch_size * k, dtype=torch.long, device=device)
+    finished = torch.zeros(batch_size * k, dtype=torch.bool, device=device)
+    # All beams start identical, so only the first one is expanded at the first step
+    scores = torch.zeros((batch_size, k), device=device)
+    scores[:, 1:] = float('-inf')
+
+    for t in range(max_len):
+        output, hidden = decoder.lstm(inputs, hidden)
+        # The k best continuations of an image are among the k best tokens of each of its beams, so only
+        # those are expanded (and the adaptive softmax skips the clusters that cannot reach them)
+        log_probs, top_tokens = decoder.predict_topk(output.squeeze(1), k)
+        # Finished hypotheses can only be extended with <PAD>, at no cost
+        log_probs = log_probs.masked_fill(finished.unsqueeze(1), float('-inf'))
+        log_probs[:, 0] = log_probs[:, 0].masked_fill(finished, 0.0)
+        top_tokens[:, 0] = top_tokens[:, 0].masked_fill(finished, pad_idx)
+
+        num_active = active.size(0)
+        candidates = (scores.view(-1, 1) + log_probs).view(num_active, k * k)
+        scores, top_idx = candidates.topk(k, dim=1)
+        tokens = top_tokens.view(num_active, k * k).gather(1, top_idx).view(-1)
+        rows = (top_idx // k + torch.arange(num_active, device=device).unsqueeze(1) * k).view(-1)
+
+        # Reorder the hypotheses and the LSTM state to follow the surviving beams
+        ids = ids.index_select(0, rows)
+        lengths = lengths.index_select(0, rows)
+        finished = finished.index_select(0, rows)
+        hidden = tuple(state.index_select(1, rows) for state in hidden)
+        ids[:, t] = tokens
+        lengths += (~finished).long()
+        finished = finished | (tokens == eos_idx)
+
+        # Images with all their beams finished (or at max_len) are moved out of the batch
+        done = finished.view(num_active, k).all(dim=1)
+        if t == max_len - 1:
+            done = torch.ones_like(done)
+        if bool(done.any()):
+            done_images = active[done]
+            out_ids[done_images] = ids.view(num_active, k, max_len)[done]
+            out_lengths[done_images] = lengths.view(num_active, k)[done]
+            out_scores[done_images] = scores[done]
+            keep = ~done
+            if not bool(keep.any()):
+                break
+            keep_rows = keep.repeat_interleave(k)
+            active = active[keep]
+            scores = scores[keep]
+            ids = ids[keep_rows]
+            lengths = lengths[keep_rows]
+            finished = finished[keep_rows]
+            tokens = tokens[keep_rows]
+            hidden = tuple(state[:, keep_rows] for state in hidden)
+
+        inputs = decoder.embedding(tokens.unsqueeze(1))
+
+    # Best hypothesis of each image after the length penalty
+    best = length_normalize(out_scores, out_lengths, length_penalty).argmax(dim=1)
+    batch_idx = torch.arange(batch_size, device=device)
+    best_ids = out_ids[batch_idx, best]
+    best_lengths = out_lengths[batch_idx, best]
+    return best_ids[:, :int(best_lengths.max())], best_lengths
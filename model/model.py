@@ -1,32 +1,45 @@
 import torch
 import torch.nn as nn
+from torch.nn.utils.rnn import pack_padded_sequence
 import torch.optim as optim
 import torchvision.transforms as transforms
 import torchvision.models as models
+from model.decoding import greedy_decode, beam_search_decode, ids_to_captions
+from model.adaptive import AdaptiveHead
+from model.backbones import build_backbone
 # from utils.utils import create_embedding_layer
 
 
 class EncoderCNN(nn.Module):
-    def __init__(self,embed_size):
+    def __init__(self,embed_size, pretrained=True, backbone='resnet50', weights_path=None):
         super(EncoderCNN,self).__init__()
-        resnet = models.resnet50(pretrained=True) 
-        for param in resnet.parameters():
+        # pretrained=False skips the ImageNet weights download (offline benchmarks, weights loaded afterwards).
+        # backbone is a name of model/backbones.py, weights_path a local file with its torchvision weights
+        self.backbone = backbone
+        trunk, features_dim = build_backbone(backbone, pretrained, weights_path)
+        for param in trunk.parameters():
             param.requires_grad_(False)
         
-        modules = list(resnet.children())[:-1] # To extract the features of Rsenet from the last layer 
-        self.resnet = nn.Sequential(*modules)
-        self.embed = nn.Linear(resnet.fc.in_features,embed_size) 
+        # Features of the last layer of the backbone. The attribute keeps the name resnet for every backbone,
+        # so the checkpoints, feature_cache.py and quantize.py work with all of them
+        self.resnet = trunk
+        self.embed = nn.Linear(features_dim,embed_size) 
         
     def forward(self,images):
-        features = self.resnet(images) # resenet features shape - torch.Size([4, 2048, 1, 1])
-        features = features.view(features.size(0),-1)  # resenet features viewed shape - torch.Size([4, 2048])
+        if images.dim() == 2:
+            # Already pooled ResNet features (see feature_cache.py), only the embedding is applied
+            features = images
+        else:
+            features = self.resnet(images) # resenet features shape - torch.Size([4, 2048, 1, 1])
+            features = features.view(features.size(0),-1)  # resenet features viewed shape - torch.Size([4, 2048])
         features = self.embed(features) # resenet features embed shape - torch.Size([4, 400]
         
         return features
 
 
 class DecoderRNN(nn.Module):
-    def __init__(self, embed_size, hidden_size, vocab_size, num_layers=1, weight_matrix=None, finetune_embedding=False):
+    def __init__(self, embed_size, hidden_size, vocab_size, num_layers=1, weight_matrix=None, finetune_embedding=False,
+                 adaptive_cutoffs=None, adaptive_order=None):
         super(DecoderRNN,self).__init__()
         if weight_matrix is not None:
             if finetune_embedding:
@@ -43,17 +56,30 @@ class DecoderRNN(nn.Module):
             self.embedding = nn.Embedding(vocab_size, embed_size)
             self.lstm = nn.LSTM(embed_size, hidden_size, num_layers, batch_first=True)
             self.fcn = nn.Linear(hidden_size,vocab_size)
+
+        # Optional adaptive softmax output layer in place of fcn (see model/adaptive.py),
+        # adaptive_order is the frequency order of the vocabulary given by adaptive.frequency_order
+        self.adaptive = None
+        if adaptive_cutoffs is not None:
+            self.fcn = None
+            self.adaptive = AdaptiveHead(hidden_size, vocab_size, adaptive_cutoffs, adaptive_order)
   
     
-    def forward(self, features, captions):
+    def forward(self, features, captions, lengths=None):
         # Embedding
         embeddings = self.embedding(captions[:, :-1])
         # Concatenate embeddings and CNN features
         inputs = torch.cat((features.unsqueeze(1), embeddings), dim=1)
+        if lengths is not None:
+            # Packed sequences, only the real timesteps go through the LSTM and the fully connected layer.
+            # Returns the (sum(lengths), vocab) logits in the order of pack_padded_sequence(captions, lengths)
+            packed = pack_padded_sequence(inputs, lengths.cpu(), batch_first=True, enforce_sorted=False)
+            outputs, _ = self.lstm(packed)
+            return self.project(outputs.data)
         # LSTM
         outputs, _ = self.lstm(inputs)
         # Fully connected layer
-        outputs = self.fcn(outputs)
+        outputs = self.project(outputs)
         return outputs
 
     def create_embedding_layer(self, weights_matrix, finetune_embedding=False):
@@ -67,41 +93,55 @@ class DecoderRNN(nn.Module):
 
         return emb_layer, num_embeddings, embedding_dim
 
+    # fcn logits of the LSTM outputs. With the adaptive softmax the outputs are returned as they are,
+    # and the head computes the loss from them (see compute_loss in train.py)
+    def project(self, outputs):
+        if self.adaptive is not None:
+            return outputs
+        return self.fcn(outputs)
+
+    # Most likely next token of each (N, hidden) LSTM output
+    def predict(self, outputs):
+        if self.adaptive is not None:
+            return self.adaptive.predict(outputs)
+        return self.fcn(outputs).argmax(dim=1)
+
+    # k most likely next tokens of each (N, hidden) LSTM output, returns their (N, k) log-probabilities and indices
+    def predict_topk(self, outputs, k):
+        if self.adaptive is not None:
+            return self.adaptive.topk(outputs, k)
+        return torch.log_softmax(self.fcn(outputs), dim=-1).topk(k, dim=1)
+
     def generate_caption(self,inputs,hidden=None,max_len=20,vocab=None):
     
-        # Given the image features generate the caption
-        batch_size = inputs.size(0)
-        captions = []
-        for i in range(max_len):
-            output,hidden = self.lstm(inputs,hidden)
-            output = self.fcn(output)
-            output = output.view(batch_size,-1)
-        
-            #select the word with most val
-            predicted_word_idx = output.argmax(dim=1)
-            
-            #save the generated word
-            captions.append(predicted_word_idx.item())
-            
-            #end if <EOS detected>
-            if vocab[predicted_word_idx.item()] == "<EOS>":
-                break
-            
-            # Embed the predicted word to the next time step
-            inputs = self.embedding(predicted_word_idx.unsqueeze(1))
+        # Given the image features generate the caption of a single image, (1, 1, embed) inputs
+        ids, lengths = self.generate_captions(inputs.view(inputs.size(0), -1), hidden=hidden, max_len=max_len)
         
-         #convert the vocab idx to words and return generated sentence
-        return [vocab[idx] for idx in captions]  
+        #convert the vocab idx to words and return generated sentence (with <SOS> and <EOS>)
+        return ids_to_captions(ids, lengths, vocab, strip=False)[0]
+
+    def generate_captions(self, features, hidden=None, max_len=20, beam_size=1, length_penalty=0.7):
+        # Batched decoding of (B, embed) features, returns the padded (B, T) idx tensor and the lengths.
+        # Greedy with beam_size=1, otherwise beam search with the GNMT length penalty
+        if beam_size > 1:
+            return beam_search_decode(self, features, beam_size=beam_size, max_len=max_len, length_penalty=length_penalty)
+        return greedy_decode(self, features, hidden=hidden, max_len=max_len)
 
 class EncoderDecoder(nn.Module):
-    def __init__(self, embed_size, hidden_size, vocab_size,num_layers=1, weight_matrix=None, finetune_embedding=False):
+    def __init__(self, embed_size, hidden_size, vocab_size,num_layers=1, weight_matrix=None, finetune_embedding=False, pretrained=True,
+                 adaptive_cutoffs=None, adaptive_order=None, backbone='resnet50', weights_path=None):
         super(EncoderDecoder, self).__init__()
-        self.encoder = EncoderCNN(embed_size)
-        self.decoder = DecoderRNN(embed_size,hidden_size,vocab_size,num_layers, weight_matrix, finetune_embedding)
+        self.encoder = EncoderCNN(embed_size, pretrained, backbone, weights_path)
+        self.decoder = DecoderRNN(embed_size,hidden_size,vocab_size,num_layers, weight_matrix, finetune_embedding,
+                                  adaptive_cutoffs, adaptive_order)
     
-    def forward(self, images, captions):
+    # With image_index (see get_loader(..., group_images=True)) images holds every image once and caption i
+    # is the caption of images[image_index[i]], the features of each image are computed once and repeated
+    def forward(self, images, captions, lengths=None, image_index=None):
         features = self.encoder(images)
-        outputs = self.decoder(features, captions)
+        if image_index is not None:
+            features = features.index_select(0, image_index)
+        outputs = self.decoder(features, captions, lengths)
         return outputs
 
 
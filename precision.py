@@ -0,0 +1,62 @@
+import contextlib
+import torch
+
+'''
+Opt-in bf16 mixed precision for train(), validate() and train_and_visualize_caps().
+With precision='bf16' the forward pass runs under torch.autocast with bfloat16 (convolutions,
+LSTM and the fcn projection), the encoder weights and the images use the channels_last memory
+format, and the loss is still computed in fp32 from the model outputs.
+'''
+
+PRECISIONS = ('fp32', 'bf16')
+
+
+def check_precision(precision):
+    if precision not in PRECISIONS:
+        raise ValueError('Unknown precision {}, expected one of {}'.format(precision, PRECISIONS))
+
+
+# Context manager for the forward pass, does nothing in fp32
+def autocast(device, precision='fp32'):
+    check_precision(precision)
+    if precision == 'fp32':
+        return contextlib.nullcontext()
+    return torch.autocast(device_type=torch.device(device).type, dtype=torch.bfloat16)
+
+
+# Images in the memory format the encoder expects for the precision
+def prepare_images(images, precision='fp32'):
+    if precision != 'fp32' and images.dim() == 4:
+        return images.contiguous(memory_format=torch.channels_last)
+    return images
+
+
+# Converts the encoder of an EncoderDecoder (or EncoderDecoder_dropout) to channels_last for bf16,
+# and back to the default format for fp32. The parameters themselves stay in fp32
+def set_precision(model, precision='fp32'):
+    check_precision(precision)
+    memory_format = torch.channels_last if precision != 'fp32' else torch.contiguous_format
+    model.encoder.to(memory_format=memory_format)
+    return model
+
+
+# Loss of the same batch in fp32 and in the given precision, to check how much the loss drifts.
+# Runs in eval mode without gradients, so dropout does not change the result
+def parity_check(criterion, model, images, captions, device, pad_idx=None, precision='bf16'):
+    from train import compute_loss
+    was_training = model.training
+    model.eval()
+    images, captions = images.to(device), captions.to(device)
+    losses = {}
+    with torch.no_grad():
+        for name in ('fp32', precision):
+            set_precision(model, name)
+            losses[name] = compute_loss(criterion, model, images, captions, pad_idx, precision=name).item()
+    set_precision(model, 'fp32')
+    model.train(was_training)
+    drift = abs(losses[precision] - losses['fp32'])
+    report = {'fp32_loss': losses['fp32'], precision + '_loss': losses[precision],
+              'abs_drift': drift, 'rel_drift': drift / max(abs(losses['fp32']), 1e-12)}
+    print("Loss fp32: {:.5f}\tLoss {}: {:.5f}\tDrift: {:.2e} ({:.3%})".format(
+        losses['fp32'], precision, losses[precision], drift, report['rel_drift']))
+    return report
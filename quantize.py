@@ -0,0 +1,166 @@
+import io
+import copy
+import time
+import argparse
+import torch
+import torch.nn as nn
+from torch.ao.quantization import quantize_dynamic, default_dynamic_qconfig, get_default_qconfig_mapping
+from torch.ao.quantization.quantize_fx import prepare_fx, convert_fx
+
+'''
+Quantized CPU inference mode of a trained EncoderDecoder:
+    - dynamic int8 quantization of decoder.lstm, decoder.fcn and encoder.embed (weights stored
+      in int8, activations quantized on the fly), the ops that run once per generated token
+    - optionally, static int8 quantization of the ResNet trunk (encoder.resnet) with FX graph
+      mode, calibrated on a few batches of images
+Quantized checkpoints are saved with the model sizes and the quantization settings, so
+load_quantized() rebuilds the same structure before loading the int8 weights.
+quantization_report() compares size, CPU latency and test corpus BLEU with the fp32 model.
+'''
+
+DYNAMIC_MODULES = ('decoder.lstm', 'decoder.fcn', 'encoder.embed')
+
+
+# Copy of the model with dynamic int8 LSTM and Linear layers, the original model is left untouched
+def quantize_dynamic_model(model, modules=DYNAMIC_MODULES):
+    model = copy.deepcopy(model).cpu().eval()
+    return quantize_dynamic(model, {name: default_dynamic_qconfig for name in modules}, dtype=torch.qint8)
+
+
+# Replaces encoder.resnet of the (cpu, eval) model with its statically quantized version, calibrated
+# with the images of calibration_batches. Without calibration batches the scales are left at their
+# defaults, which is only meant to rebuild the structure before loading a quantized state_dict
+def quantize_static_trunk(model, calibration_batches=(), image_size=224, backend=None):
+    backend = backend or torch.backends.quantized.engine
+    torch.backends.quantized.engine = backend
+    example_inputs = (torch.randn(1, 3, image_size, image_size),)
+    trunk = prepare_fx(model.encoder.resnet.eval(), get_default_qconfig_mapping(backend), example_inputs)
+    with torch.no_grad():
+        for images in calibration_batches:
+            trunk(images)
+    model.encoder.resnet = convert_fx(trunk)
+    return model
+
+
+# Dynamic quantization of the decoder and the projection, plus the static trunk if static_trunk=True
+def quantize_model(model, static_trunk=False, calibration_batches=(), image_size=224, backend=None):
+    model = quantize_dynamic_model(model)
+    if static_trunk:
+        model = quantize_static_trunk(model, calibration_batches, image_size, backend)
+    return model
+
+
+# Images of the first num_batches batches of a loader yielding (images, captions, img_dirs)
+def calibration_images(loader, num_batches=8):
+    batches = []
+    for i, (images, _, _) in enumerate(loader):
+        if i == num_batches:
+            break
+        batches.append(images)
+    return batches
+
+
+def model_config(model):
+    decoder = model.decoder
+    return {'embed_size': decoder.embedding.embedding_dim, 'hidden_size': decoder.lstm.hidden_size,
+            'vocab_size': decoder.embedding.num_embeddings, 'num_layers': decoder.lstm.num_layers,
+            'backbone': model.encoder.backbone}
+
+
+def save_quantized(model, path, config, static_trunk=False, image_size=224):
+    torch.save({'config': config, 'static_trunk': static_trunk, 'image_size': image_size,
+                'backend': torch.backends.quantized.engine, 'state_dict': model.state_dict()}, path)
+
+
+def load_quantized(path, model_class=None):
+    if model_class is None:
+        from model.model import EncoderDecoder
+        model_class = EncoderDecoder
+    checkpoint = torch.load(path, map_location='cpu', weights_only=False)
+    config = checkpoint['config']
+    model = model_class(config['embed_size'], config['hidden_size'], config['vocab_size'], config['num_layers'],
+                        pretrained=False, backbone=config.get('backbone', 'resnet50'))
+    model = quantize_model(model.eval(), checkpoint['static_trunk'], image_size=checkpoint['image_size'],
+                           backend=checkpoint['backend'])
+    model.load_state_dict(checkpoint['state_dict'])
+    return model.eval()
+
+
+# Serialized size of the state_dict in MB
+def model_size_mb(model):
+    buffer = io.BytesIO()
+    torch.save(model.state_dict(), buffer)
+    return buffer.tell() / 1024 ** 2
+
+
+# Mean latency of captioning one image, encoder included
+def caption_latency_ms(model, image_size=224, runs=20, warmup=3, max_len=20):
+    images = torch.randn(1, 3, image_size, image_size)
+    with torch.no_grad():
+        for _ in range(warmup):
+            model.decoder.generate_captions(model.encoder(images), max_len=max_len)
+        start = time.perf_counter()
+        for _ in range(runs):
+            model.decoder.generate_captions(model.encoder(images), max_len=max_len)
+    return (time.perf_counter() - start) / runs * 1000
+
+
+# Size, latency and (when a test loader is given) corpus BLEU of every model in models = {name: model}
+def quantization_report(models, loader=None, df=None, vocab=None, image_size=224, runs=20):
+    from test import corpus_test_BLEU
+    report = {}
+    for name, model in models.items():
+        model = model.cpu().eval()
+        row = {'size_mb': model_size_mb(model), 'latency_ms': caption_latency_ms(model, image_size, runs)}
+        if loader is not None:
+            row.update(corpus_test_BLEU(model, loader, df, vocab, 'cpu'))
+        report[name] = row
+        print('{:14s} size {:8.2f} MB  latency {:8.2f} ms/caption'.format(name, row['size_mb'], row['latency_ms'])
+              + ''.join('  {} {:.4f}'.format(k, v) for k, v in row.items() if k.startswith('BLEU')))
+    return report
+
+
+if __name__ == '__main__':
+    import pandas as pd
+    from torchvision import transforms
+    from batch_transforms import IMAGENET_MEAN, IMAGENET_STD
+    from get_loader import Vocabulary, get_loader
+    from model.model import EncoderDecoder
+    from model.backbones import BACKBONES
+
+    parser = argparse.ArgumentParser(description='int8 quantized inference mode of the captioning model')
+    parser.add_argument('--weights', required=True, help='state_dict of the trained EncoderDecoder')
+    parser.add_argument('--vocab', required=True, help='vocabulary artifact (vocab_cache/<hash>.json)')
+    parser.add_argument('--embed-size', type=int, default=300)
+    parser.add_argument('--hidden-size', type=int, default=512)
+    parser.add_argument('--num-layers', type=int, default=2)
+    parser.add_argument('--image-size', type=int, default=224)
+    parser.add_argument('--backbone', default='resnet50', choices=list(BACKBONES))
+    parser.add_argument('--static-trunk', action='store_true', help='also quantize the ResNet trunk statically')
+    parser.add_argument('--data-dir', default=None, help='images folder, for calibration and BLEU')
+    parser.add_argument('--test-csv', default=None, help='captions CSV of the test split, for calibration and BLEU')
+    parser.add_argument('--batch-size', type=int, default=32)
+    parser.add_argument('--out', default='model_int8.pth')
+    args = parser.parse_args()
+
+    vocab = Vocabulary.load(args.vocab)
+    model = EncoderDecoder(args.embed_size, args.hidden_size, len(vocab), args.num_layers, pretrained=False,
+                           backbone=args.backbone)
+    model.load_state_dict(torch.load(args.weights, map_location='cpu'))
+    model.eval()
+
+    loader = df = None
+    if args.data_dir is not None and args.test_csv is not None:
+        df = pd.read_csv(args.test_csv)
+        transform = transforms.Compose([
+            transforms.Resize((args.image_size, args.image_size)),
+            transforms.ToTensor(),
+            transforms.Normalize(IMAGENET_MEAN, IMAGENET_STD)])
+        loader = get_loader(args.data_dir, df, transform, args.batch_size, shuffle=False)
+    elif args.static_trunk:
+        parser.error('--static-trunk needs --data-dir and --test-csv for calibration')
+
+    calibration = calibration_images(loader) if args.static_trunk else ()
+    quantized = quantize_model(model, args.static_trunk, calibration, args.image_size)
+    save_quantized(quantized, args.out, model_config(model), args.static_trunk, args.image_size)
+    quantization_report({'fp32': model, 'int8': load_quantized(args.out)}, loader, df, vocab.itos, args.image_size)
@@ -0,0 +1,259 @@
+import io
+import json
+import time
+import asyncio
+import argparse
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import urlparse
+import numpy as np
+import torch
+from PIL import Image
+from torchvision import transforms
+from batch_transforms import IMAGENET_MEAN, IMAGENET_STD
+from get_loader import Vocabulary
+from model.model import EncoderDecoder
+from model.backbones import BACKBONES
+from model.decoding import ids_to_captions
+from embedding_cache import EmbeddingCache, CachedEncoder
+
+'''
+Local caption service around EncoderDecoder. Requests are queued and grouped into
+micro-batches (up to max_batch_size images, or whatever arrived within max_latency_ms
+of the first one), and each micro-batch runs the encoder and the batched decoder once.
+
+    POST /caption   body: the image file bytes   ->  {"caption": "...", "latency_ms": ...}
+    GET  /stats     p50/p99 latency, batch size and throughput counters
+    GET  /health
+
+Run with a TCP port or a unix socket:
+    python serve.py --weights model.pth --vocab vocab_cache/<hash>.json --port 8000
+    python serve.py --weights model.pth --vocab vocab_cache/<hash>.json --unix-socket /tmp/captions.sock
+'''
+
+
+# Latency and throughput counters of the server
+class ServingStats:
+    def __init__(self, window: int = 10000):
+        self.latencies = deque(maxlen=window)
+        self.start_time = time.perf_counter()
+        self.requests = 0
+        self.errors = 0
+        self.batches = 0
+        self.batched_images = 0
+
+    def record_batch(self, latencies):
+        self.batches += 1
+        self.batched_images += len(latencies)
+        self.requests += len(latencies)
+        self.latencies.extend(latencies)
+
+    def snapshot(self):
+        elapsed = time.perf_counter() - self.start_time
+        latencies = np.array(self.latencies) * 1000 if self.latencies else np.zeros(1)
+        return {'requests': self.requests, 'errors': self.errors, 'batches': self.batches,
+                'mean_batch_size': self.batched_images / max(self.batches, 1),
+                'p50_ms': float(np.percentile(latencies, 50)), 'p99_ms': float(np.percentile(latencies, 99)),
+                'throughput_rps': self.requests / max(elapsed, 1e-9), 'uptime_s': elapsed}
+
+
+# Groups the submitted items into micro-batches and runs run_batch(list_of_items) -> list_of_results
+# on them in a single worker thread, so the event loop keeps accepting requests meanwhile
+class MicroBatcher:
+    def __init__(self, run_batch, max_batch_size: int = 16, max_latency_ms: float = 10.0):
+        self.run_batch = run_batch
+        self.max_batch_size = max_batch_size
+        self.max_latency = max_latency_ms / 1000.0
+        self.queue = asyncio.Queue()
+        self.executor = ThreadPoolExecutor(max_workers=1)
+        self.stats = ServingStats()
+
+    async def submit(self, item):
+        future = asyncio.get_running_loop().create_future()
+        await self.queue.put((item, future, time.perf_counter()))
+        return await future
+
+    async def collect_batch(self):
+        batch = [await self.queue.get()]
+        deadline = time.perf_counter() + self.max_latency
+        while len(batch) < self.max_batch_size:
+            timeout = deadline - time.perf_counter()
+            if timeout <= 0:
+                break
+            try:
+                batch.append(await asyncio.wait_for(self.queue.get(), timeout))
+            except asyncio.TimeoutError:
+                break
+        return batch
+
+    async def run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            batch = await self.collect_batch()
+            items = [item for item, _, _ in batch]
+            try:
+                results = await loop.run_in_executor(self.executor, self.run_batch, items)
+            except Exception as e:
+                self.stats.errors += len(batch)
+                for _, future, _ in batch:
+                    if not future.done():
+                        future.set_exception(e)
+                continue
+            now = time.perf_counter()
+            self.stats.record_batch([now - start for _, _, start in batch])
+            for (_, future, _), result in zip(batch, results):
+                if not future.done():
+                    future.set_result(result)
+
+
+# Preprocessing and batched captioning with a trained EncoderDecoder
+class Captioner:
+    def __init__(self, model, itos, device='cpu', image_size=224, max_len=20, beam_size=1, cache=None):
+        self.model = model.to(device).eval()
+        # Optional EmbeddingCache, repeated images skip the encoder
+        self.cache = cache
+        self.encoder = CachedEncoder(self.model.encoder, cache) if cache is not None else self.model.encoder
+        self.itos = itos
+        self.device = device
+        self.max_len = max_len
+        self.beam_size = beam_size
+        self.transform = transforms.Compose([
+            transforms.Resize((image_size, image_size)),
+            transforms.ToTensor(),
+            transforms.Normalize(IMAGENET_MEAN, IMAGENET_STD)])
+
+    def preprocess(self, image_bytes):
+        return self.transform(Image.open(io.BytesIO(image_bytes)).convert('RGB'))
+
+    def caption_batch(self, images):
+        with torch.no_grad():
+            features = self.encoder(torch.stack(images).to(self.device))
+            ids, lengths = self.model.decoder.generate_captions(features, max_len=self.max_len, beam_size=self.beam_size)
+        return [' '.join(words) for words in ids_to_captions(ids, lengths, self.itos)]
+
+
+def load_captioner(weights, vocab_path, embed_size=300, hidden_size=512, num_layers=2, device='cpu', backbone='resnet50', **kwargs):
+    vocab = Vocabulary.load(vocab_path)
+    model = EncoderDecoder(embed_size, hidden_size, len(vocab), num_layers, pretrained=False, backbone=backbone)
+    model.load_state_dict(torch.load(weights, map_location=device))
+    return Captioner(model, vocab.itos, device=device, **kwargs)
+
+
+# Minimal HTTP/1.1 front-end on top of the MicroBatcher
+class CaptionServer:
+    def __init__(self, captioner: Captioner, max_batch_size: int = 16, max_latency_ms: float = 10.0):
+        self.captioner = captioner
+        self.batcher = MicroBatcher(captioner.caption_batch, max_batch_size, max_latency_ms)
+
+    async def read_request(self, reader):
+        request_line = await reader.readline()
+        if not request_line:
+            return None
+        method, target, _ = request_line.decode('latin-1').split(' ', 2)
+        headers = {}
+        while True:
+            line = await reader.readline()
+            if line in (b'\r\n', b'\n', b''):
+                break
+            name, value = line.decode('latin-1').split(':', 1)
+            headers[name.strip().lower()] = value.strip()
+        body = await reader.readexactly(int(headers.get('content-length', 0)))
+        return method, urlparse(target).path, headers, body
+
+    async def write_response(self, writer, status, payload, keep_alive):
+        body = json.dumps(payload).encode()
+        reason = {200: 'OK', 400: 'Bad Request', 404: 'Not Found', 500: 'Internal Server Error'}[status]
+        head = 'HTTP/1.1 {} {}\r\nContent-Type: application/json\r\nContent-Length: {}\r\nConnection: {}\r\n\r\n'.format(
+            status, reason, len(body), 'keep-alive' if keep_alive else 'close')
+        writer.write(head.encode() + body)
+        await writer.drain()
+
+    async def handle(self, method, path, body):
+        if method == 'GET' and path == '/health':
+            return 200, {'status': 'ok'}
+        if method == 'GET' and path == '/stats':
+            stats = self.batcher.stats.snapshot()
+            if self.captioner.cache is not None:
+                stats['embedding_cache'] = self.captioner.cache.snapshot()
+            return 200, stats
+        if method == 'POST' and path == '/caption':
+            start = time.perf_counter()
+            loop = asyncio.get_running_loop()
+            try:
+                image = await loop.run_in_executor(None, self.captioner.preprocess, body)
+            except Exception as e:
+                self.batcher.stats.errors += 1
+                return 400, {'error': 'could not decode image: {}'.format(e)}
+            caption = await self.batcher.submit(image)
+            return 200, {'caption': caption, 'latency_ms': (time.perf_counter() - start) * 1000}
+        return 404, {'error': 'not found'}
+
+    async def handle_connection(self, reader, writer):
+        try:
+            while True:
+                request = await self.read_request(reader)
+                if request is None:
+                    break
+                method, path, headers, body = request
+                keep_alive = headers.get('connection', 'keep-alive').lower() != 'close'
+                try:
+                    status, payload = await self.handle(method, path, body)
+                except Exception as e:
+                    status, payload = 500, {'error': str(e)}
+                await self.write_response(writer, status, payload, keep_alive)
+                if not keep_alive:
+                    break
+        except (asyncio.IncompleteReadError, ConnectionResetError, ValueError):
+            pass
+        finally:
+            writer.close()
+
+    async def serve(self, host='127.0.0.1', port=8000, unix_socket=None):
+        batch_task = asyncio.ensure_future(self.batcher.run())
+        if unix_socket is not None:
+            server = await asyncio.start_unix_server(self.handle_connection, path=unix_socket)
+            print('Serving captions on unix socket', unix_socket)
+        else:
+            server = await asyncio.start_server(self.handle_connection, host, port)
+            print('Serving captions on http://{}:{}'.format(host, port))
+        try:
+            async with server:
+                await server.serve_forever()
+        finally:
+            batch_task.cancel()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Micro-batching caption server')
+    parser.add_argument('--weights', required=True, help='state_dict of the trained EncoderDecoder')
+    parser.add_argument('--vocab', required=True, help='vocabulary artifact (vocab_cache/<hash>.json)')
+    parser.add_argument('--embed-size', type=int, default=300)
+    parser.add_argument('--hidden-size', type=int, default=512)
+    parser.add_argument('--num-layers', type=int, default=2)
+    parser.add_argument('--image-size', type=int, default=224)
+    parser.add_argument('--backbone', default='resnet50', choices=list(BACKBONES))
+    parser.add_argument('--beam-size', type=int, default=1)
+    parser.add_argument('--max-batch-size', type=int, default=16)
+    parser.add_argument('--max-latency-ms', type=float, default=10.0)
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8000)
+    parser.add_argument('--unix-socket', default=None)
+    parser.add_argument('--threads', type=int, default=None, help='torch intra-op threads')
+    parser.add_argument('--cache-mb', type=float, default=0, help='memory budget of the embedding cache, 0 disables it')
+    parser.add_argument('--cache-spill-dir', default=None, help='folder for the embeddings evicted from memory')
+    parser.add_argument('--cache-spill-mb', type=float, default=1024, help='disk budget of the spill folder')
+    args = parser.parse_args()
+
+    if args.threads is not None:
+        torch.set_num_threads(args.threads)
+    cache = None
+    if args.cache_mb > 0:
+        cache = EmbeddingCache(int(args.cache_mb * 1024 ** 2), args.cache_spill_dir, int(args.cache_spill_mb * 1024 ** 2))
+    captioner = load_captioner(args.weights, args.vocab, args.embed_size, args.hidden_size, args.num_layers,
+                               backbone=args.backbone, image_size=args.image_size, beam_size=args.beam_size, cache=cache)
+    server = CaptionServer(captioner, args.max_batch_size, args.max_latency_ms)
+    try:
+        asyncio.run(server.serve(args.host, args.port, args.unix_socket))
+    finally:
+        if cache is not None:
+            cache.close()
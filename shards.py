@@ -0,0 +1,255 @@
+import os
+import io
+import json
+import math
+import tarfile
+import numpy as np
+import torch
+import torch.distributed as dist
+from multiprocessing import Pool
+from PIL import Image
+from torch.utils.data import IterableDataset, DataLoader, get_worker_info
+from get_loader import Vocabulary, load_or_build_vocabulary, CaptionCollate
+
+'''
+Tar shards for corpora that do not fit the dataframe + directory of JPEGs layout (Flickr30k
+and larger, or images on a network filesystem where small random reads are slow).
+
+write_shards() packs the images of a captions dataframe into tar files of samples_per_shard
+images. Each image is stored as the original JPEG bytes (<key>.jpg) next to a <key>.json with
+its name, captions and pre-encoded token ids. The vocabulary artifact and an index.json
+manifest, written last, go in the same folder.
+
+StreamingCaptionDataset reads the shards sequentially and yields the same (image, caption,
+image name) samples as ImageCaptionDataset, one per caption, shuffled inside a buffer. The
+shards are split across processes (torch.distributed ranks) and DataLoader workers, and the
+order only depends on (seed, epoch), so StreamingLoader can resume an epoch mid-way:
+
+    write_shards('flickr30k-images', df, 'shards_30k')
+    loader = get_stream_loader('shards_30k', transform, batch_size=32, num_workers=4)
+    train(criterion, model, optimizer, loader, device)
+'''
+
+
+# Writes one shard, runs in the pool workers. samples is a list of (image path, metadata dict)
+def write_shard(args):
+    path, samples = args
+    tmp_path = path + '.tmp'
+    with tarfile.open(tmp_path, 'w') as tar:
+        for key, (image_path, meta) in enumerate(samples):
+            with open(image_path, 'rb') as f:
+                image_bytes = f.read()
+            for name, data in (('{:09d}.jpg'.format(key), image_bytes), ('{:09d}.json'.format(key), json.dumps(meta).encode())):
+                info = tarfile.TarInfo(name)
+                info.size = len(data)
+                tar.addfile(info, io.BytesIO(data))
+    os.replace(tmp_path, path)
+    return os.path.basename(path)
+
+
+def write_shards(data_dir, dataframe, out_dir='shards', samples_per_shard=1000, freq_threshold=3, vocab_dir='vocab_cache',
+                 tokenize_workers=1, num_workers=1, seed=0):
+    captions = dataframe['caption'].tolist()
+    vocab, tokens, offsets = load_or_build_vocabulary(captions, freq_threshold, vocab_dir=vocab_dir, tokenize_workers=tokenize_workers)
+
+    # All the captions of an image go in the same sample
+    per_image = {}
+    for row, image in enumerate(dataframe['image']):
+        meta = per_image.setdefault(image, {'image': image, 'captions': [], 'tokens': []})
+        meta['captions'].append(str(captions[row]))
+        meta['tokens'].append(tokens[offsets[row]:offsets[row + 1]].tolist())
+    # Images are shuffled once here, so every shard is a random sample of the corpus
+    images = list(per_image)
+    images = [images[i] for i in np.random.default_rng(seed).permutation(len(images))]
+
+    os.makedirs(out_dir, exist_ok=True)
+    jobs = []
+    shards = []
+    for i, start in enumerate(range(0, len(images), samples_per_shard)):
+        names = images[start:start + samples_per_shard]
+        path = os.path.join(out_dir, 'shard-{:06d}.tar'.format(i))
+        jobs.append((path, [(os.path.join(data_dir, name), per_image[name]) for name in names]))
+        shards.append({'name': os.path.basename(path), 'images': len(names),
+                       'samples': sum(len(per_image[name]['captions']) for name in names)})
+    if num_workers is not None and num_workers > 1:
+        with Pool(num_workers) as pool:
+            pool.map(write_shard, jobs)
+    else:
+        for job in jobs:
+            write_shard(job)
+
+    vocab.save(os.path.join(out_dir, 'vocab.json'))
+    lengths = np.diff(offsets)
+    manifest = {'shards': shards, 'vocab': 'vocab.json', 'samples': len(captions),
+                'max_caption_length': int(lengths.max()) if len(lengths) else 0}
+    # The manifest is written last, so its presence means the shards are complete
+    with open(os.path.join(out_dir, 'index.json.tmp'), 'w') as f:
+        json.dump(manifest, f, indent=1)
+    os.replace(os.path.join(out_dir, 'index.json.tmp'), os.path.join(out_dir, 'index.json'))
+    return out_dir
+
+
+# (image bytes, metadata) of every image of a shard, read sequentially
+def read_shard(path):
+    with tarfile.open(path, 'r|') as tar:
+        image_bytes = None
+        for member in tar:
+            data = tar.extractfile(member).read()
+            if member.name.endswith('.jpg'):
+                image_bytes = data
+            elif member.name.endswith('.json'):
+                yield image_bytes, json.loads(data)
+                image_bytes = None
+
+
+class StreamingCaptionDataset(IterableDataset):
+    def __init__(self, shard_dir, transform=None, shuffle=True, shuffle_buffer=2000, seed=0, dynamic_padding=False,
+                 rank=None, world_size=None):
+        self.shard_dir = shard_dir
+        with open(os.path.join(shard_dir, 'index.json')) as f:
+            self.manifest = json.load(f)
+        self.vocab = Vocabulary.load(os.path.join(shard_dir, self.manifest['vocab']))
+        self.transform = transform
+        self.shuffle = shuffle
+        self.shuffle_buffer = shuffle_buffer
+        self.seed = seed
+        self.max_caption_length = self.manifest['max_caption_length']
+        self.pad_idx = self.vocab.stoi['<PAD>']
+        self.sos_idx = self.vocab.stoi['<SOS>']
+        self.eos_idx = self.vocab.stoi['<EOS>']
+        self.dynamic_padding = dynamic_padding
+        # Process split, taken from torch.distributed when it is initialized
+        if rank is None:
+            rank = dist.get_rank() if dist.is_available() and dist.is_initialized() else 0
+        if world_size is None:
+            world_size = dist.get_world_size() if dist.is_available() and dist.is_initialized() else 1
+        self.rank = rank
+        self.world_size = world_size
+        self.epoch = 0
+        # Batches of this process already consumed in the current epoch, skipped on resume
+        self.skip_batches = 0
+        self.batch_size = 1
+
+    def set_epoch(self, epoch):
+        self.epoch = epoch
+
+    def set_position(self, epoch, batches_seen, batch_size):
+        self.epoch = epoch
+        self.skip_batches = batches_seen
+        self.batch_size = batch_size
+
+    # Shards of this process (all DataLoader workers), in the order of the epoch
+    def rank_shards(self):
+        shards = [shard['name'] for shard in self.manifest['shards']]
+        if self.shuffle:
+            order = np.random.default_rng((self.seed, self.epoch)).permutation(len(shards))
+            shards = [shards[i] for i in order]
+        return shards[self.rank::self.world_size]
+
+    # Number of samples this process yields per epoch
+    def rank_samples(self):
+        samples = {shard['name']: shard['samples'] for shard in self.manifest['shards']}
+        return sum(samples[name] for name in self.rank_shards())
+
+    # Same padded <SOS> ... <EOS> tensor as ImageCaptionDataset.encode_caption
+    def encode_tokens(self, tokens):
+        length = len(tokens)
+        num_tokens = min(length, self.max_caption_length - 1)
+        padded_vector = torch.full((self.max_caption_length,), self.pad_idx, dtype=torch.long)
+        padded_vector[0] = self.sos_idx
+        padded_vector[1:num_tokens + 1] = torch.tensor(tokens[:num_tokens], dtype=torch.long)
+        if length + 2 <= self.max_caption_length:
+            padded_vector[length + 1] = self.eos_idx
+        if self.dynamic_padding:
+            return padded_vector[:min(length + 2, self.max_caption_length)]
+        return padded_vector
+
+    # (image bytes, tokens, image name) of every caption of the shards, in the shuffled order
+    def stream(self, shards, rng):
+        buffer = []
+        for shard in shards:
+            for image_bytes, meta in read_shard(os.path.join(self.shard_dir, shard)):
+                for tokens in meta['tokens']:
+                    item = (image_bytes, tokens, meta['image'])
+                    if not self.shuffle:
+                        yield item
+                        continue
+                    if len(buffer) < self.shuffle_buffer:
+                        buffer.append(item)
+                        continue
+                    # Swap a random element of the full buffer out for the new one
+                    i = rng.integers(len(buffer))
+                    yield buffer[i]
+                    buffer[i] = item
+        if self.shuffle:
+            for i in rng.permutation(len(buffer)):
+                yield buffer[i]
+
+    def __iter__(self):
+        worker = get_worker_info()
+        worker_id, num_workers = (worker.id, worker.num_workers) if worker is not None else (0, 1)
+        # The DataLoader takes the batches of the workers in turn, starting with worker 0. After skip_batches
+        # batches the next one belongs to worker skip_batches % num_workers, so on resume the workers take over
+        # the roles (shards, random state and position) that keep the original batch order
+        role = (worker_id + self.skip_batches) % num_workers
+        shards = self.rank_shards()[role::num_workers]
+        rng = np.random.default_rng((self.seed, self.epoch, self.rank, role))
+
+        # The worker with this role produced ceil((skip_batches - role) / num_workers) of the skipped batches.
+        # The skipped samples are read but not decoded. Exact as long as no worker ran out of shards before
+        # the interruption
+        role_batches = max(0, math.ceil((self.skip_batches - role) / num_workers))
+        skip = role_batches * self.batch_size
+
+        for i, (image_bytes, tokens, image_name) in enumerate(self.stream(shards, rng)):
+            if i < skip:
+                continue
+            img = Image.open(io.BytesIO(image_bytes)).convert('RGB')
+            if self.transform is not None:
+                img = self.transform(img)
+            yield img, self.encode_tokens(tokens), image_name
+
+
+# Iterable in place of the DataLoader of get_loader that keeps track of its position in the epoch.
+# state_dict() / load_state_dict() save and restore it, the next iteration resumes after the last
+# batch consumed. Every complete iteration moves to the next epoch (and shard order)
+class StreamingLoader:
+    def __init__(self, dataset, batch_size, num_workers=1, pin_memory=True, drop_last=True):
+        self.dataset = dataset
+        self.batch_size = batch_size
+        self.num_workers = num_workers
+        self.pin_memory = pin_memory
+        self.drop_last = drop_last
+        self.collate_fn = CaptionCollate(dataset.pad_idx) if dataset.dynamic_padding else None
+        self.epoch = 0
+        self.batches_seen = 0
+
+    # Approximate number of batches per epoch, every worker drops its own last incomplete batch
+    def __len__(self):
+        samples = self.dataset.rank_samples()
+        return samples // self.batch_size if self.drop_last else math.ceil(samples / self.batch_size)
+
+    def __iter__(self):
+        self.dataset.set_position(self.epoch, self.batches_seen, self.batch_size)
+        loader = DataLoader(self.dataset, batch_size=self.batch_size, num_workers=self.num_workers,
+                            pin_memory=self.pin_memory, drop_last=self.drop_last, collate_fn=self.collate_fn)
+        for batch in loader:
+            self.batches_seen += 1
+            yield batch
+        self.epoch += 1
+        self.batches_seen = 0
+
+    def state_dict(self):
+        return {'epoch': self.epoch, 'batches_seen': self.batches_seen}
+
+    def load_state_dict(self, state):
+        self.epoch = state['epoch']
+        self.batches_seen = state['batches_seen']
+
+
+def get_stream_loader(shard_dir, transform=None, batch_size=32, num_workers=1, shuffle=True, pin_memory=True,
+                      shuffle_buffer=2000, seed=0, dynamic_padding=False):
+    # Same batches as get_loader. With dynamic_padding=True the captions are padded to the longest one of the batch
+    dataset = StreamingCaptionDataset(shard_dir, transform, shuffle=shuffle, shuffle_buffer=shuffle_buffer, seed=seed,
+                                      dynamic_padding=dynamic_padding)
+    return StreamingLoader(dataset, batch_size, num_workers=num_workers, pin_memory=pin_memory)
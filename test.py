@@ -5,23 +5,33 @@ from torchvision import transforms
 import torchvision.transforms.functional as TF
 from get_loader import show_image
 from utils.utils import best_bleu_cap, img_denorm
+from batch_transforms import IMAGENET_MEAN, IMAGENET_STD
+from model.decoding import ids_to_captions
+from train import compute_loss, batch_image_index
+from instrumentation import NO_INSTRUMENTATION
+from utils.bleu import build_caption_index, build_reference_index, corpus_bleu
 
 # Function to validate the trained model, returns the average loss
-def validate(criterion, model, loader, device): 
-
+def validate(criterion, model, loader, device, pad_idx=None, precision='fp32', instrument=None): 
+    timer = instrument if instrument is not None else NO_INSTRUMENTATION
     model.eval()
     total_loss = 0
     total_samples = 0
 
     with torch.no_grad():
-        for images, captions,_ in loader:
-            images = images.to(device)
-            captions = captions.to(device)
-            batch_size = images.size(0)
+        for images, captions, *rest in timer.iterate(loader, 'validate'):
+            image_index = batch_image_index(rest)
+            with timer.stage('h2d'):
+                images = images.to(device)
+                captions = captions.to(device)
+                if image_index is not None:
+                    image_index = image_index.to(device)
+            batch_size = captions.size(0)
+            timer.set_batch_size(batch_size)
             total_samples += batch_size
 
-            outputs = model(images, captions)
-            loss = criterion(outputs.view(-1, outputs.size(-1)), captions.view(-1))
+            with timer.stage('forward'):
+                loss = compute_loss(criterion, model, images, captions, pad_idx, precision, image_index)
             total_loss += loss.item() * batch_size
 
     average_loss = total_loss / total_samples
@@ -31,13 +41,13 @@ def validate(criterion, model, loader, device):
 # for the val or test set once the model is trained 
 def evaluate_caps(model, loader, df, vocab, device):
     print_every = 20
+    captions_index = build_caption_index(df) # image -> list of all the original captions, built once
     #generate the caption
     model.eval()
     with torch.no_grad():
         for idx, (img, captions,img_dir) in enumerate(iter(loader)):
             if (idx+1)%print_every == 0:
-                    df_filtered = df.loc[df['image'] == img_dir[0], 'caption']
-                    original_captions = [caption.lower() for caption in df_filtered] # list of all the original captions
+                    original_captions = captions_index[img_dir[0]] # list of all the original captions
                     features = model.encoder(img[0:1].to(device))
                     caps = model.decoder.generate_caption(features.unsqueeze(0),vocab=vocab)
                     pred_caption = ' '.join(caps)
@@ -46,28 +56,65 @@ def evaluate_caps(model, loader, df, vocab, device):
                     print("Best original caption (1 out of 5):", original_caption)
                     print("Predicted caption:", pred_caption)
                     print("BLEU score:", bleu_score)
-                    img = img_denorm(img=img, mean=np.array([0.485, 0.456, 0.406]), std=np.array([0.229, 0.224, 0.225]))
+                    img = img_denorm(img=img, mean=IMAGENET_MEAN, std=IMAGENET_STD)
                     # img = TF.to_pil_image(img)
                     
                     show_image(img[0].cpu(),title=pred_caption)
         
-# Function to calculate the average test BLEU            
-def average_test_BLEU(model, loader, df, vocab, device):
+# Function to calculate the average test BLEU, the captions of a whole batch are generated at once
+# (greedy with beam_size=1, batched beam search otherwise)
+def average_test_BLEU(model, loader, df, vocab, device, beam_size=1, max_len=20, length_penalty=0.7):
     model.eval()
     total_bleu_score = 0.0
     total_predictions = 0
+    # image -> original captions and their tokens, built once for the whole set
+    captions_index = build_caption_index(df)
+    reference_index = build_reference_index(df)
 
     with torch.no_grad():
         for idx, (img, captions, img_dir) in enumerate(iter(loader)):
-            df_filtered = df.loc[df['image'] == img_dir[0], 'caption']
-            original_captions = [caption.lower() for caption in df_filtered] # list of all the original captions
-            features = model.encoder(img[0:1].to(device))
-            caps = model.decoder.generate_caption(features.unsqueeze(0),vocab=vocab)
-            pred_caption = ' '.join(caps)
-            pred_caption = ' '.join(pred_caption.split()[1:-1]) # to erase sos and eos tokens from pred caption
-            total_predictions += 1
-            original_caption, bleu_score = best_bleu_cap(original_captions, pred_caption) # call to function in utils.py
-            total_bleu_score += bleu_score
+            features = model.encoder(img.to(device))
+            ids, lengths = model.decoder.generate_captions(features, max_len=max_len, beam_size=beam_size,
+                                                           length_penalty=length_penalty)
+            pred_captions = ids_to_captions(ids, lengths, vocab) # sos and eos tokens already erased
+            for image_name, caps in zip(img_dir, pred_captions):
+                original_captions = captions_index[image_name] # list of all the original captions
+                pred_caption = ' '.join(caps)
+                total_predictions += 1
+                original_caption, bleu_score = best_bleu_cap(original_captions, pred_caption, reference_index[image_name]) # call to function in utils.py
+                total_bleu_score += bleu_score
 
     average_bleu_score = total_bleu_score / total_predictions
-    print("Average test BLEU-1 score:", average_bleu_score)
\ No newline at end of file
+    print("Average test BLEU-1 score:", average_bleu_score)
+
+
+# Corpus BLEU-1 to BLEU-4 of the generated captions against all the original captions of each image.
+# Every image is captioned only once even if the loader returns it once per caption, and the n-gram
+# counting is spread over num_workers processes
+def corpus_test_BLEU(model, loader, df, vocab, device, beam_size=1, max_len=20, length_penalty=0.7, num_workers=1):
+    model.eval()
+    reference_index = build_reference_index(df, num_workers=num_workers)
+    seen_images = set()
+    hypotheses = []
+    references = []
+
+    with torch.no_grad():
+        for img, captions, img_dir in loader:
+            keep = []
+            for i, image_name in enumerate(img_dir):
+                if image_name not in seen_images:
+                    seen_images.add(image_name)
+                    keep.append(i)
+            if not keep:
+                continue
+            features = model.encoder(img[keep].to(device))
+            ids, lengths = model.decoder.generate_captions(features, max_len=max_len, beam_size=beam_size,
+                                                           length_penalty=length_penalty)
+            for i, caps in zip(keep, ids_to_captions(ids, lengths, vocab)):
+                hypotheses.append(caps)
+                references.append(reference_index[img_dir[i]])
+
+    scores = corpus_bleu(hypotheses, references, num_workers=num_workers)
+    for name, score in scores.items():
+        print("Test corpus {} score: {:.4f}".format(name, score))
+    return scores
@@ -0,0 +1,35 @@
+import os
+import sys
+import numpy as np
+import pandas as pd
+import pytest
+from PIL import Image
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+WORDS = 'a dog cat runs on the grass man woman rides bike red blue ball jumps in water'.split()
+
+
+# Skips the calling test when the nltk punkt tokenizer used to build the vocabulary is not installed
+def require_tokenizer():
+    import nltk
+    try:
+        nltk.word_tokenize('a dog')
+    except LookupError:
+        pytest.skip('nltk punkt tokenizer data is not installed')
+
+
+# Folder of random JPEGs of different sizes and aspect ratios, and a dataframe with 5 random captions per image
+@pytest.fixture
+def caption_data(tmp_path):
+    rng = np.random.default_rng(0)
+    data_dir = tmp_path / 'images'
+    data_dir.mkdir()
+    rows = []
+    for i in range(12):
+        name = 'img{}.jpg'.format(i)
+        height, width = rng.integers(120, 320, size=2)
+        Image.fromarray(rng.integers(0, 256, (height, width, 3), dtype=np.uint8)).save(data_dir / name)
+        for _ in range(5):
+            rows.append((name, ' '.join(rng.choice(WORDS, rng.integers(3, 12))) + ' .'))
+    return str(data_dir), pd.DataFrame(rows, columns=['image', 'caption'])
@@ -0,0 +1,49 @@
+import random
+import pytest
+from nltk.translate import bleu_score
+from utils.bleu import corpus_bleu
+
+WORDS = 'a dog cat runs on the grass man woman rides bike red ball in water'.split()
+
+
+# Random tokenized hypotheses with 1 to 5 references each, short ones included (shorter than the n-gram orders).
+# Half of the hypotheses copy a piece of one of their references, so that every n-gram order has matches
+def random_corpus(size, seed=0):
+    rng = random.Random(seed)
+    sentence = lambda: [rng.choice(WORDS) for _ in range(rng.randint(1, 14))]
+    hypotheses = []
+    references = []
+    for _ in range(size):
+        image_references = [sentence() for _ in range(rng.randint(1, 5))]
+        hypothesis = sentence()
+        if rng.random() < 0.5:
+            reference = rng.choice(image_references)
+            start = rng.randint(0, len(reference) - 1)
+            hypothesis = hypothesis[:rng.randint(0, 3)] + reference[start:start + rng.randint(1, 8)]
+        hypotheses.append(hypothesis)
+        references.append(image_references)
+    return hypotheses, references
+
+
+def nltk_scores(hypotheses, references, max_n=4):
+    return {'BLEU-{}'.format(n): bleu_score.corpus_bleu(references, hypotheses, weights=[1.0 / n] * n)
+            for n in range(1, max_n + 1)}
+
+
+@pytest.mark.parametrize('num_workers, chunk_size', [(1, None), (1, 17), (3, 17)])
+def test_corpus_bleu_matches_nltk(num_workers, chunk_size):
+    hypotheses, references = random_corpus(200)
+    scores = corpus_bleu(hypotheses, references, num_workers=num_workers, chunk_size=chunk_size)
+    expected = nltk_scores(hypotheses, references)
+    assert scores.keys() == expected.keys()
+    for key in expected:
+        assert scores[key] == pytest.approx(expected[key], abs=1e-12)
+        assert scores[key] > 0
+
+
+def test_corpus_bleu_without_higher_order_matches_is_zero():
+    hypotheses, references = [['a', 'dog']], [[['dog', 'a']]]
+    with pytest.warns(UserWarning):
+        expected = nltk_scores(hypotheses, references)
+    assert corpus_bleu(hypotheses, references) == pytest.approx(expected)
+    assert corpus_bleu(hypotheses, references)['BLEU-2'] == 0.0
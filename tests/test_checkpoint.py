@@ -0,0 +1,83 @@
+import pytest
+import torch
+import torch.nn as nn
+from torchvision import transforms
+from conftest import require_tokenizer
+from checkpoint import CheckpointManager, list_checkpoints
+
+
+class Interrupted(Exception):
+    pass
+
+
+# Checkpoint manager that stops the training after batch `stop_at` of epoch `stop_epoch`
+class InterruptingCheckpoint(CheckpointManager):
+    def __init__(self, *args, stop_epoch=2, stop_at=7, **kwargs):
+        super(InterruptingCheckpoint, self).__init__(*args, **kwargs)
+        self.stop_epoch = stop_epoch
+        self.stop_at = stop_at
+
+    def step(self, batches_seen, total_loss, total_samples):
+        super(InterruptingCheckpoint, self).step(batches_seen, total_loss, total_samples)
+        if (self.epoch, batches_seen) == (self.stop_epoch, self.stop_at):
+            raise Interrupted
+
+
+def test_keep_must_be_positive(tmp_path):
+    with pytest.raises(ValueError):
+        CheckpointManager(str(tmp_path), nn.Linear(2, 2), keep=0)
+
+
+# A run interrupted mid-epoch and resumed from its last checkpoint gives the same epoch losses and
+# the same weights as an uninterrupted one (num_workers=0, random flips and dropout included)
+@pytest.mark.parametrize('bucketing', [False, True])
+def test_interrupted_run_resumes_bit_identical(caption_data, tmp_path, bucketing):
+    require_tokenizer()
+    from get_loader import get_loader
+    from model.model_dropout import EncoderDecoder_dropout
+    from train import train
+
+    data_dir, df = caption_data
+    transform = transforms.Compose([transforms.Resize((32, 32)), transforms.RandomHorizontalFlip(), transforms.ToTensor()])
+    epochs = 3
+
+    def setup():
+        torch.manual_seed(0)
+        loader = get_loader(data_dir, df, transform, batch_size=4, num_workers=0, vocab_dir=str(tmp_path / 'vocab'),
+                            bucketing=bucketing, seed=1)
+        model = EncoderDecoder_dropout(16, 32, len(loader.dataset.vocab), pretrained=False, backbone='resnet18')
+        optimizer = torch.optim.Adam([p for p in model.parameters() if p.requires_grad], lr=1e-3)
+        scheduler = torch.optim.lr_scheduler.ReduceLROnPlateau(optimizer)
+        return loader, model, optimizer, scheduler
+
+    def run(checkpoint, loader, model, optimizer, scheduler):
+        pad_idx = loader.dataset.pad_idx if bucketing else None
+        criterion = nn.CrossEntropyLoss(ignore_index=loader.dataset.pad_idx)
+        losses = []
+        for epoch in range(checkpoint.resume(), epochs + 1):
+            losses.append(train(criterion, model, optimizer, loader, 'cpu', pad_idx, checkpoint=checkpoint))
+            scheduler.step(losses[-1])
+            checkpoint.end_epoch()
+        checkpoint.close()
+        return losses
+
+    loader, model, optimizer, scheduler = setup()
+    reference_losses = run(CheckpointManager(str(tmp_path / 'reference'), model, optimizer, scheduler, every=3),
+                           loader, model, optimizer, scheduler)
+    reference_weights = [p.detach().clone() for p in model.parameters()]
+
+    loader, model, optimizer, scheduler = setup()
+    checkpoint = InterruptingCheckpoint(str(tmp_path / 'resumed'), model, optimizer, scheduler, every=3)
+    with pytest.raises(Interrupted):
+        run(checkpoint, loader, model, optimizer, scheduler)
+    checkpoint.close()
+    assert list_checkpoints(str(tmp_path / 'resumed'))[-1][:2] == (2, 6)
+
+    # Fresh process state: new model, optimizer and loader, and a different RNG state that the resume must replace
+    loader, model, optimizer, scheduler = setup()
+    torch.manual_seed(123)
+    resumed_losses = run(CheckpointManager(str(tmp_path / 'resumed'), model, optimizer, scheduler, every=3),
+                         loader, model, optimizer, scheduler)
+
+    assert resumed_losses == reference_losses[1:]
+    assert all(torch.equal(a, b) for a, b in zip(reference_weights, model.parameters()))
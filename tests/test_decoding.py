@@ -0,0 +1,45 @@
+import pytest
+import torch
+from model.model import DecoderRNN
+from model.decoding import greedy_decode, beam_search_decode, EOS_IDX
+
+
+# Random decoder with sharpened outputs and an <EOS> bias, so that the captions of the batch finish at
+# different steps and some of them only at max_len
+def make_decoder(vocab_size=30, seed=0):
+    torch.manual_seed(seed)
+    decoder = DecoderRNN(16, 32, vocab_size).eval()
+    with torch.no_grad():
+        decoder.fcn.weight *= 8
+        decoder.fcn.bias[EOS_IDX] += 0.5
+        decoder.lstm.weight_hh_l0 *= 3
+    return decoder, torch.randn(8, 16) * 3
+
+
+def test_beam_size_1_equals_greedy():
+    decoder, features = make_decoder()
+    with torch.no_grad():
+        greedy_ids, greedy_lengths = greedy_decode(decoder, features, max_len=12)
+        beam_ids, beam_lengths = beam_search_decode(decoder, features, beam_size=1, max_len=12)
+    assert len(set(greedy_lengths.tolist())) > 1
+    assert torch.equal(beam_lengths, greedy_lengths)
+    assert torch.equal(beam_ids, greedy_ids)
+
+
+@pytest.mark.parametrize('beam_size', [2, 4])
+def test_batched_beam_search_equals_per_image(beam_size):
+    decoder, features = make_decoder()
+    with torch.no_grad():
+        ids, lengths = beam_search_decode(decoder, features, beam_size=beam_size, max_len=12)
+        for i in range(features.size(0)):
+            image_ids, image_lengths = beam_search_decode(decoder, features[i:i + 1], beam_size=beam_size, max_len=12)
+            assert lengths[i] == image_lengths[0]
+            assert torch.equal(ids[i, :lengths[i]], image_ids[0, :image_lengths[0]])
+    assert len(set(lengths.tolist())) > 1
+
+
+@pytest.mark.parametrize('decode', [greedy_decode, beam_search_decode])
+def test_max_len_below_1_is_rejected(decode):
+    decoder, features = make_decoder()
+    with pytest.raises(ValueError):
+        decode(decoder, features, max_len=0)
@@ -0,0 +1,32 @@
+import pytest
+import torch
+import torch.nn as nn
+from torchvision import transforms
+from conftest import require_tokenizer
+
+
+@pytest.mark.parametrize('loader_args', [{'bucketing': True}, {'group_images': True}])
+def test_background_evaluator_on_variable_length_batches(caption_data, tmp_path, loader_args):
+    require_tokenizer()
+    from get_loader import get_loader
+    from model.model import EncoderDecoder
+    from evaluator import BackgroundEvaluator
+
+    data_dir, df = caption_data
+    transform = transforms.Compose([transforms.Resize((64, 64)), transforms.ToTensor()])
+    loader = get_loader(data_dir, df, transform, batch_size=4, num_workers=0, vocab_dir=str(tmp_path / 'vocab'),
+                        **loader_args)
+    pad_idx = loader.dataset.pad_idx
+    torch.manual_seed(0)
+    model = EncoderDecoder(16, 32, len(loader.dataset.vocab), pretrained=False, backbone='resnet18')
+    criterion = nn.CrossEntropyLoss(ignore_index=pad_idx)
+
+    evaluator = BackgroundEvaluator(model, loader.dataset, df, criterion, pad_idx, num_batches=2, batch_size=8,
+                                    num_workers=0, max_len=5, mode='thread')
+    assert evaluator.submit(model, epoch=1, batch=3)
+    results = evaluator.close()
+
+    assert len(results) == 1
+    assert (results[0]['epoch'], results[0]['batch']) == (1, 3)
+    assert torch.isfinite(torch.tensor(results[0]['val_loss']))
+    assert results[0]['images'] > 0
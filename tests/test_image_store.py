@@ -0,0 +1,23 @@
+import os
+import numpy as np
+import pytest
+from PIL import Image
+from torchvision import transforms
+from image_store import build_image_store, ImageStore
+
+
+@pytest.mark.parametrize('num_workers', [0, 2])
+def test_store_matches_on_disk_transform(caption_data, tmp_path, num_workers):
+    data_dir, df = caption_data
+    size = 64
+    store = ImageStore(build_image_store(data_dir, df, str(tmp_path / 'store'), size, num_workers), size)
+    resize_crop = transforms.Compose([transforms.Resize(size), transforms.CenterCrop(size)])
+    # Training transform of the dataset, applied to the JPEG and to the stored image
+    train_transform = transforms.Compose([transforms.Resize(size), transforms.CenterCrop(56), transforms.ToTensor()])
+
+    for name in df['image'].unique():
+        img = Image.open(os.path.join(data_dir, name)).convert('RGB')
+        assert min(img.size) != max(img.size)
+        assert store[name].shape == (size, size, 3)
+        np.testing.assert_array_equal(store[name], np.asarray(resize_crop(img)))
+        assert train_transform(store.open(name)).equal(train_transform(img))
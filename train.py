@@ -1,5 +1,8 @@
 import torch
+from torch.nn.utils.rnn import pack_padded_sequence
 from get_loader import show_image
+from precision import autocast, prepare_images
+from instrumentation import NO_INSTRUMENTATION
 import matplotlib.pyplot as plt
 from torch.optim.lr_scheduler import ReduceLROnPlateau
 from utils.utils import best_bleu_cap
@@ -7,24 +10,80 @@ import torchvision.transforms as transforms
 
 
 
-# Training function that calculates the average train loss at each epoch
-def train(criterion, model, optimizer, loader, device):
+# Loss of a batch. Without pad_idx every padded timestep is computed, as the criterion gets the
+# full (batch * max_length, vocab) outputs. With pad_idx the caption lengths are read from the padding
+# and the model runs on packed sequences, so the LSTM, the fully connected layer and the loss
+# only see the real tokens. With precision='bf16' the forward pass runs under bf16 autocast
+# (see precision.py) and the loss is computed in fp32. A decoder with an adaptive softmax head
+# returns its LSTM outputs and the head computes the loss. With image_index (batches of
+# get_loader(..., group_images=True)) images holds each image once, see EncoderDecoder.forward
+def compute_loss(criterion, model, images, captions, pad_idx=None, precision='fp32', image_index=None):
+    images = prepare_images(images, precision)
+    extra = {} if image_index is None else {'image_index': image_index}
+    with autocast(images.device, precision):
+        if pad_idx is None:
+            outputs = model(images, captions, **extra)
+        else:
+            lengths = (captions != pad_idx).sum(dim=1)
+            outputs = model(images, captions, lengths, **extra)
+    outputs = outputs.float()
+    if pad_idx is None:
+        outputs, targets = outputs.reshape(-1, outputs.size(-1)), captions.reshape(-1)
+    else:
+        targets = pack_padded_sequence(captions, lengths.cpu(), batch_first=True, enforce_sorted=False).data
+    head = adaptive_head(model)
+    if head is not None:
+        # The adaptive softmax computes its own negative log-likelihood from the LSTM outputs,
+        # only the ignore_index of the criterion applies
+        keep = targets != getattr(criterion, 'ignore_index', -100)
+        return head.loss(outputs[keep], targets[keep])
+    return criterion(outputs, targets)
+
+
+# image_index of a batch, the optional 4th element of the grouped batches
+def batch_image_index(rest):
+    return rest[1] if len(rest) > 1 else None
+
 
+# Adaptive softmax head of the decoder (see model/adaptive.py), None with the full fcn output layer
+def adaptive_head(model):
+    model = getattr(model, 'module', model)  # DistributedDataParallel
+    return getattr(model.decoder, 'adaptive', None)
+
+
+# Training function that calculates the average train loss at each epoch
+# instrument is an optional instrumentation.Instrumentation that times every stage of the batches
+# checkpoint is an optional checkpoint.CheckpointManager, the epoch then resumes after its last saved batch
+def train(criterion, model, optimizer, loader, device, pad_idx=None, precision='fp32', instrument=None, checkpoint=None):
+    timer = instrument if instrument is not None else NO_INSTRUMENTATION
     total_samples = 0
     total_loss = 0.0
+    start_batch = 0
+    if checkpoint is not None:
+        loader, start_batch, total_loss, total_samples = checkpoint.begin_epoch(loader)
     model.train()
 
-    for batch_idx, (images, captions,_) in enumerate(loader):
-        images = images.to(device)
-        captions = captions.to(device)
-        batch_size = images.size(0)
+    for batch_idx, (images, captions, *rest) in enumerate(timer.iterate(loader, 'train'), start_batch):
+        image_index = batch_image_index(rest)
+        with timer.stage('h2d'):
+            images = images.to(device)
+            captions = captions.to(device)
+            if image_index is not None:
+                image_index = image_index.to(device)
+        batch_size = captions.size(0)
+        timer.set_batch_size(batch_size)
         total_samples += batch_size
-        optimizer.zero_grad()
-        outputs = model(images, captions)
-        loss = criterion(outputs.view(-1, outputs.size(-1)), captions.view(-1))
-        loss.backward()
-        optimizer.step()
+        with timer.stage('optimizer'):
+            optimizer.zero_grad()
+        with timer.stage('forward'):
+            loss = compute_loss(criterion, model, images, captions, pad_idx, precision, image_index)
+        with timer.stage('backward'):
+            loss.backward()
+        with timer.stage('optimizer'):
+            optimizer.step()
         total_loss += loss.item() * batch_size
+        if checkpoint is not None:
+            checkpoint.step(batch_idx + 1, total_loss, total_samples)
 
     average_loss = total_loss / total_samples
     return average_loss
@@ -32,30 +91,53 @@ def train(criterion, model, optimizer, loader, device):
 
 # Function to train and generate captions at the same time to analyze how the model learns
 # and improves its captions predictions with the pass of the epochs
-def train_and_visualize_caps(epoch, train_dataloader, val_dataloader, model, optimizer, criterion, vocab, val_df, device):
+# With an evaluator (see evaluator.py) the periodic caption visualization is replaced by a snapshot of the
+# weights sent to the background evaluator, so training does not stop for it. With a checkpoint (see checkpoint.py)
+# the epoch resumes after its last saved batch
+def train_and_visualize_caps(epoch, train_dataloader, val_dataloader, model, optimizer, criterion, vocab, val_df, device, pad_idx=None, precision='fp32', instrument=None,
+                             evaluator=None, checkpoint=None):
+    timer = instrument if instrument is not None else NO_INSTRUMENTATION
     print_every = 400
     total_loss = 0
     total_samples = 0
+    start_batch = 0
+    batches = train_dataloader
+    if checkpoint is not None:
+        batches, start_batch, total_loss, total_samples = checkpoint.begin_epoch(train_dataloader)
     model.train()
-    for batch_idx, (image, captions,_) in enumerate(iter(train_dataloader)):
-        images, captions = image.to(device), captions.to(device)
-        batch_size = images.size(0)
+    for batch_idx, (image, captions, *rest) in enumerate(timer.iterate(batches, 'train'), start_batch):
+        image_index = batch_image_index(rest)
+        with timer.stage('h2d'):
+            images, captions = image.to(device), captions.to(device)
+            if image_index is not None:
+                image_index = image_index.to(device)
+        batch_size = captions.size(0)
+        timer.set_batch_size(batch_size)
         total_samples += batch_size
-        optimizer.zero_grad()
-        outputs = model(images, captions)
         
+        with timer.stage('optimizer'):
+            optimizer.zero_grad()
         # Calculate the batch loss.
-        loss = criterion(outputs.view(-1, outputs.size(-1)), captions.view(-1))
-        loss.backward()
-        optimizer.step()
+        with timer.stage('forward'):
+            loss = compute_loss(criterion, model, images, captions, pad_idx, precision, image_index)
+        with timer.stage('backward'):
+            loss.backward()
+        with timer.stage('optimizer'):
+            optimizer.step()
         total_loss += loss.item() * batch_size
+        if checkpoint is not None:
+            checkpoint.step(batch_idx + 1, total_loss, total_samples)
         if (batch_idx + 1) % print_every == 0:
             print("Train Epoch: {} Batch [{}/{}]\tLoss: {:.5f}".format(epoch,
             batch_idx + 1, len(train_dataloader), loss.item()
         ))
+            if evaluator is not None:
+                evaluator.submit(model, epoch, batch_idx + 1)
+                evaluator.poll()
+                continue
             #Generate the caption
             model.eval()
-            with torch.no_grad():
+            with torch.no_grad(), timer.stage('visualize'):
                 dataiter = iter(val_dataloader)
                 img,captions_val,img_dir = next(dataiter)
                 df_filtered = val_df.loc[val_df['image'] == img_dir[0], 'caption']
@@ -71,6 +153,8 @@ def train_and_visualize_caps(epoch, train_dataloader, val_dataloader, model, opt
                 show_image(img[0],title=pred_caption)
             model.train()
             
+    if evaluator is not None:
+        evaluator.poll()
     average_loss = total_loss / total_samples
     print("Train Epoch: {} - Training set:  AVERAGE TRAINING LOSS: {:.5f}".format(epoch, average_loss))
     return average_loss
@@ -0,0 +1,210 @@
+import os
+import json
+import time
+import socket
+import argparse
+import tempfile
+import pandas as pd
+import torch
+import torch.nn as nn
+import torch.distributed as dist
+import torch.multiprocessing as mp
+from torch.nn.parallel import DistributedDataParallel
+from torch.utils.data import DataLoader
+from torch.utils.data.distributed import DistributedSampler
+from torchvision import transforms
+from batch_transforms import IMAGENET_MEAN, IMAGENET_STD
+from get_loader import ImageCaptionDataset
+from model.model import EncoderDecoder
+from model.backbones import BACKBONES
+from train import train
+from test import validate
+
+'''
+Data-parallel training on CPU with one process per group of cores. Every process holds a
+replica of EncoderDecoder wrapped in DistributedDataParallel over gloo, trains on its own
+shard of ImageCaptionDataset (DistributedSampler) with the usual train() / validate(), and
+the epoch losses are all-reduced so every rank reports the same value. Only rank 0 writes
+checkpoints. The intra-op threads are split between the processes.
+
+    python train_distributed.py --data-dir data/Images --train-csv train.csv --val-csv val.csv --world-size 4
+    python train_distributed.py --scaling 1 2 4 8        # throughput on a synthetic dataset
+'''
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+def setup(rank, world_size, port, threads=None):
+    dist.init_process_group('gloo', init_method='tcp://127.0.0.1:{}'.format(port), rank=rank, world_size=world_size)
+    # Without this every process would start os.cpu_count() threads
+    torch.set_num_threads(threads or max(1, (os.cpu_count() or 1) // world_size))
+
+
+# Mean over all the ranks of a per-rank average computed on num_samples samples
+def all_reduce_average(average, num_samples):
+    totals = torch.tensor([average * num_samples, float(num_samples)], dtype=torch.float64)
+    dist.all_reduce(totals, op=dist.ReduceOp.SUM)
+    return (totals[0] / totals[1]).item()
+
+
+def default_transform(image_size=224):
+    return transforms.Compose([
+        transforms.Resize((image_size, image_size)),
+        transforms.ToTensor(),
+        transforms.Normalize(IMAGENET_MEAN, IMAGENET_STD)])
+
+
+# Dataset built by rank 0 first, so that only one process tokenizes the captions and writes the
+# vocabulary cache, the other ranks then load it
+def build_dataset(data_dir, dataframe, transform, vocab_dir='vocab_cache'):
+    if dist.get_rank() == 0:
+        dataset = ImageCaptionDataset(data_dir, dataframe, transform, vocab_dir=vocab_dir)
+    dist.barrier()
+    if dist.get_rank() != 0:
+        dataset = ImageCaptionDataset(data_dir, dataframe, transform, vocab_dir=vocab_dir)
+    return dataset
+
+
+# Synthetic images and captions.csv of benchmark.py written by rank 0 only, the other ranks read them once complete
+def build_synthetic_dataset(out_dir, num_images):
+    from benchmark import make_synthetic_dataset
+    if dist.get_rank() == 0:
+        make_synthetic_dataset(out_dir, num_images)
+    dist.barrier()
+    return os.path.join(out_dir, 'Images'), pd.read_csv(os.path.join(out_dir, 'captions.csv'))
+
+
+# DataLoader over this rank's shard of the dataset, call loader.sampler.set_epoch(epoch) every epoch
+def get_distributed_loader(dataset, batch_size, shuffle=True, num_workers=1, pin_memory=False, seed=0):
+    sampler = DistributedSampler(dataset, num_replicas=dist.get_world_size(), rank=dist.get_rank(), shuffle=shuffle, seed=seed)
+    return DataLoader(dataset, batch_size=batch_size, sampler=sampler, num_workers=num_workers,
+                      pin_memory=pin_memory, drop_last=True)
+
+
+def run_training(rank, world_size, port, args):
+    setup(rank, world_size, port, args.threads)
+    torch.manual_seed(args.seed)
+    transform = default_transform(args.image_size)
+    train_dataset = build_dataset(args.data_dir, pd.read_csv(args.train_csv), transform, args.vocab_dir)
+    val_dataset = build_dataset(args.data_dir, pd.read_csv(args.val_csv), transform, args.vocab_dir)
+    train_loader = get_distributed_loader(train_dataset, args.batch_size, True, args.num_workers, seed=args.seed)
+    val_loader = get_distributed_loader(val_dataset, args.batch_size, False, args.num_workers)
+    pad_idx = train_dataset.pad_idx
+
+    # Rank 0 downloads the ResNet weights first. DDP then broadcasts its parameters, so all the replicas start identical
+    if rank == 0:
+        model = EncoderDecoder(args.embed_size, args.hidden_size, len(train_dataset.vocab), args.num_layers,
+                               backbone=args.backbone, weights_path=args.weights_path)
+    dist.barrier()
+    if rank != 0:
+        model = EncoderDecoder(args.embed_size, args.hidden_size, len(train_dataset.vocab), args.num_layers,
+                               backbone=args.backbone, weights_path=args.weights_path)
+    model = DistributedDataParallel(model)
+    criterion = nn.CrossEntropyLoss(ignore_index=pad_idx)
+    optimizer = torch.optim.Adam(filter(lambda p: p.requires_grad, model.parameters()), lr=args.lr)
+
+    best_loss = float('inf')
+    for epoch in range(1, args.epochs + 1):
+        train_loader.sampler.set_epoch(epoch)
+        start = time.perf_counter()
+        train_loss = train(criterion, model, optimizer, train_loader, 'cpu', pad_idx)
+        train_loss = all_reduce_average(train_loss, len(train_loader) * args.batch_size)
+        val_loss = validate(criterion, model, val_loader, 'cpu', pad_idx)
+        val_loss = all_reduce_average(val_loss, len(val_loader) * args.batch_size)
+        if rank == 0:
+            print('Epoch {}: train loss {:.5f}  val loss {:.5f}  ({:.1f}s)'.format(epoch, train_loss, val_loss, time.perf_counter() - start))
+            os.makedirs(args.checkpoint_dir, exist_ok=True)
+            torch.save(model.module.state_dict(), os.path.join(args.checkpoint_dir, 'model_epoch{}.pth'.format(epoch)))
+            if val_loss < best_loss:
+                best_loss = val_loss
+                torch.save(model.module.state_dict(), os.path.join(args.checkpoint_dir, 'model_best.pth'))
+        # The other ranks wait for the checkpoint before the next epoch
+        dist.barrier()
+    dist.destroy_process_group()
+
+
+# Trains for warmup + steps batches on the synthetic dataset and writes the global throughput (rank 0)
+def run_scaling(rank, world_size, port, args, out_path):
+    setup(rank, world_size, port, args.threads)
+    torch.manual_seed(args.seed)
+    image_dir, df = build_synthetic_dataset(args.synthetic_dir, args.synthetic_images)
+    dataset = build_dataset(image_dir, df, default_transform(args.image_size), os.path.join(args.synthetic_dir, 'vocab_cache'))
+    loader = get_distributed_loader(dataset, args.batch_size, num_workers=args.num_workers)
+    batches = list(iter(loader))
+    if len(batches) < args.warmup + args.steps:
+        batches = (batches * (args.warmup + args.steps))[:args.warmup + args.steps]
+
+    model = DistributedDataParallel(EncoderDecoder(args.embed_size, args.hidden_size, len(dataset.vocab), args.num_layers,
+                                                   pretrained=False, backbone=args.backbone))
+    criterion = nn.CrossEntropyLoss(ignore_index=dataset.pad_idx)
+    optimizer = torch.optim.Adam(filter(lambda p: p.requires_grad, model.parameters()), lr=args.lr)
+
+    # The batches are decoded in advance, only the training step is timed
+    train(criterion, model, optimizer, batches[:args.warmup], 'cpu', dataset.pad_idx)
+    dist.barrier()
+    start = time.perf_counter()
+    train(criterion, model, optimizer, batches[args.warmup:], 'cpu', dataset.pad_idx)
+    dist.barrier()
+    elapsed = time.perf_counter() - start
+    if rank == 0:
+        with open(out_path, 'w') as f:
+            json.dump({'processes': world_size, 'threads_per_process': torch.get_num_threads(),
+                       'samples_per_s': world_size * args.steps * args.batch_size / elapsed}, f)
+    dist.destroy_process_group()
+
+
+def scaling_benchmark(args):
+    results = []
+    for world_size in args.scaling:
+        with tempfile.TemporaryDirectory() as tmp:
+            out_path = os.path.join(tmp, 'result.json')
+            mp.spawn(run_scaling, args=(world_size, free_port(), args, out_path), nprocs=world_size)
+            with open(out_path) as f:
+                results.append(json.load(f))
+        result = results[-1]
+        result['speedup'] = result['samples_per_s'] / results[0]['samples_per_s']
+        result['efficiency'] = result['speedup'] / (result['processes'] / results[0]['processes'])
+        print('{processes} processes x {threads_per_process} threads: {samples_per_s:8.1f} samples/s  '
+              'speedup {speedup:.2f}x  efficiency {efficiency:.0%}'.format(**result))
+    return results
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Data-parallel CPU training over gloo')
+    parser.add_argument('--data-dir', default=None)
+    parser.add_argument('--train-csv', default=None)
+    parser.add_argument('--val-csv', default=None)
+    parser.add_argument('--world-size', type=int, default=2)
+    parser.add_argument('--threads', type=int, default=None, help='intra-op threads per process, cores / world size by default')
+    parser.add_argument('--epochs', type=int, default=10)
+    parser.add_argument('--batch-size', type=int, default=32, help='per process')
+    parser.add_argument('--lr', type=float, default=3e-4)
+    parser.add_argument('--embed-size', type=int, default=300)
+    parser.add_argument('--hidden-size', type=int, default=512)
+    parser.add_argument('--num-layers', type=int, default=2)
+    parser.add_argument('--image-size', type=int, default=224)
+    parser.add_argument('--backbone', default='resnet50', choices=list(BACKBONES))
+    parser.add_argument('--weights-path', default=None, help='local torchvision weights of the backbone, no download')
+    parser.add_argument('--num-workers', type=int, default=1, help='DataLoader workers per process')
+    parser.add_argument('--vocab-dir', default='vocab_cache')
+    parser.add_argument('--checkpoint-dir', default='checkpoints')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--scaling', type=int, nargs='+', default=None, help='run the scaling benchmark for these process counts')
+    parser.add_argument('--steps', type=int, default=20, help='timed steps of the scaling benchmark')
+    parser.add_argument('--warmup', type=int, default=3)
+    parser.add_argument('--synthetic-dir', default='benchmark_data')
+    parser.add_argument('--synthetic-images', type=int, default=256)
+    args = parser.parse_args()
+
+    if args.scaling is not None:
+        results = scaling_benchmark(args)
+        with open('scaling_results.json', 'w') as f:
+            json.dump(results, f, indent=2)
+    else:
+        if args.data_dir is None or args.train_csv is None or args.val_csv is None:
+            parser.error('--data-dir, --train-csv and --val-csv are required for training')
+        mp.spawn(run_training, args=(args.world_size, free_port(), args), nprocs=args.world_size)
@@ -0,0 +1,104 @@
+import math
+from collections import Counter
+from multiprocessing import Pool
+import nltk
+
+'''
+Corpus level BLEU-1 to BLEU-4 against all the reference captions of each image.
+The references are tokenized once into an image -> references index, and the n-gram
+counting of the hypotheses can be spread over a process pool.
+The scores are the same as nltk.translate.bleu_score.corpus_bleu without smoothing.
+'''
+
+
+# Same tokenization as Vocabulary.vocab_tokenizer in get_loader.py
+def tokenize_caption(caption):
+    return [token.lower() for token in nltk.word_tokenize(str(caption))]
+
+
+# Maps every image of the dataframe to the lowercased text of its captions
+def build_caption_index(df):
+    index = {}
+    for image, caption in zip(df['image'], df['caption']):
+        index.setdefault(image, []).append(str(caption).lower())
+    return index
+
+
+# Maps every image of the dataframe to the list of its tokenized captions
+def build_reference_index(df, num_workers=1):
+    captions = [str(caption) for caption in df['caption']]
+    if num_workers is not None and num_workers > 1 and len(captions) >= 1000:
+        with Pool(num_workers) as pool:
+            tokenized = pool.map(tokenize_caption, captions, chunksize=max(1, len(captions) // (num_workers * 8)))
+    else:
+        tokenized = [tokenize_caption(caption) for caption in captions]
+    index = {}
+    for image, tokens in zip(df['image'], tokenized):
+        index.setdefault(image, []).append(tokens)
+    return index
+
+
+def ngram_counts(tokens, n):
+    return Counter(tuple(tokens[i:i + n]) for i in range(len(tokens) - n + 1))
+
+
+# Clipped n-gram matches and totals of one hypothesis, plus its length and the closest reference length.
+# Returned as a flat list [matches_1..max_n, totals_1..max_n, hyp_len, ref_len] so it can be summed
+def sentence_stats(hypothesis, references, max_n=4):
+    matches = []
+    totals = []
+    for n in range(1, max_n + 1):
+        hyp_counts = ngram_counts(hypothesis, n)
+        max_ref_counts = Counter()
+        for reference in references:
+            max_ref_counts |= ngram_counts(reference, n)
+        matches.append(sum(min(count, max_ref_counts[ngram]) for ngram, count in hyp_counts.items()))
+        # As in nltk, a hypothesis shorter than n still counts 1 in the denominator
+        totals.append(max(1, len(hypothesis) - n + 1))
+    hyp_len = len(hypothesis)
+    ref_len = min((len(reference) for reference in references), key=lambda ref_len: (abs(ref_len - hyp_len), ref_len))
+    return matches + totals + [hyp_len, ref_len]
+
+
+# Summed stats of a chunk of (hypothesis, references) pairs, runs in the pool workers
+def chunk_stats(args):
+    pairs, max_n = args
+    total = [0] * (2 * max_n + 2)
+    for hypothesis, references in pairs:
+        for i, value in enumerate(sentence_stats(hypothesis, references, max_n)):
+            total[i] += value
+    return total
+
+
+# Corpus BLEU-1 ... BLEU-max_n of the tokenized hypotheses, references[i] is the list of
+# tokenized references of hypotheses[i]. Returns {'BLEU-1': ..., ..., 'BLEU-4': ...}
+def corpus_bleu(hypotheses, references, max_n=4, num_workers=1, chunk_size=None):
+    pairs = list(zip(hypotheses, references))
+    if chunk_size is None:
+        chunk_size = max(500, len(pairs) // (4 * max(1, num_workers or 1)))
+    chunks = [(pairs[i:i + chunk_size], max_n) for i in range(0, len(pairs), chunk_size)]
+    if num_workers is not None and num_workers > 1 and len(chunks) > 1:
+        with Pool(num_workers) as pool:
+            results = pool.map(chunk_stats, chunks)
+    else:
+        results = [chunk_stats(chunk) for chunk in chunks]
+    stats = [sum(values) for values in zip(*results)] if results else [0] * (2 * max_n + 2)
+
+    matches, totals = stats[:max_n], stats[max_n:2 * max_n]
+    hyp_len, ref_len = stats[-2], stats[-1]
+    if hyp_len == 0:
+        brevity_penalty = 0.0
+    elif hyp_len > ref_len:
+        brevity_penalty = 1.0
+    else:
+        brevity_penalty = math.exp(1 - ref_len / hyp_len)
+
+    scores = {}
+    for n in range(1, max_n + 1):
+        # Without smoothing the score is 0 as soon as one order has no matches
+        if any(matches[k] == 0 or totals[k] == 0 for k in range(n)):
+            scores['BLEU-{}'.format(n)] = 0.0
+            continue
+        log_precision = sum(math.log(matches[k] / totals[k]) for k in range(n)) / n
+        scores['BLEU-{}'.format(n)] = brevity_penalty * math.exp(log_precision)
+    return scores
@@ -0,0 +1,33 @@
+import os
+import numpy as np
+import torch
+
+'''
+Loading of the pretrained GloVe embedding written by generate_embedding_data.py.
+The matrix is memory-mapped, so only the rows of the words in the vocabulary are read.
+'''
+
+
+# Returns the memory-mapped (num_words, dim) matrix and the word -> row dict
+def load_glove(glove_npy):
+    vectors = np.load(glove_npy, mmap_mode='r')
+    with open(os.path.splitext(glove_npy)[0] + '.words.txt', encoding='utf-8') as f:
+        words = f.read().split('\n')
+    word2idx = {word: row for row, word in enumerate(words)}
+    return vectors, word2idx
+
+
+# Embedding matrix for the vocabulary (itos dict or list of words), ready for DecoderRNN(weight_matrix=...).
+# The words found in GloVe are gathered with a single indexing of the memmap, the rest are random as in
+# utils.weights_matrix
+def glove_weights_matrix(vocab, glove_npy, seed=None):
+    vectors, word2idx = load_glove(glove_npy)
+    words = [vocab[idx] for idx in range(len(vocab))] if isinstance(vocab, dict) else list(vocab)
+    rows = np.array([word2idx.get(word, -1) for word in words], dtype=np.int64)
+    found = rows >= 0
+
+    rng = np.random.default_rng(seed)
+    matrix = rng.normal(scale=0.6, size=(len(words), vectors.shape[1])).astype(np.float32)
+    matrix[found] = vectors[rows[found]]
+    print('Words found in GloVe: {}/{}'.format(int(found.sum()), len(words)))
+    return torch.from_numpy(matrix)
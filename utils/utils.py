@@ -6,19 +6,21 @@ import torchvision.transforms as transforms
 import numpy as np
 from model.model import *
 import nltk
+from batch_transforms import IMAGENET_MEAN, IMAGENET_STD
 
-def best_bleu_cap(list_original_caps, pred_cap):
+def best_bleu_cap(list_original_caps, pred_cap, list_reference_tokens=None):
 
     # Initialization of variables to return
     best_bleu_score = 0.0
     best_caption = ""
     
+    # Tokenize (the references can be given already tokenized, see utils/bleu.py)
+    generated_tokens = nltk.word_tokenize(pred_cap)
+    if list_reference_tokens is None:
+        list_reference_tokens = [nltk.word_tokenize(reference_caption) for reference_caption in list_original_caps]
+    
     # Iterate over the 5 captions that the dataset provides for each image
-    for reference_caption in list_original_caps:
-        
-        # Tokenize
-        reference_tokens = nltk.word_tokenize(reference_caption)
-        generated_tokens = nltk.word_tokenize(pred_cap )
+    for reference_caption, reference_tokens in zip(list_original_caps, list_reference_tokens):
         
         # Calculate BLEU-1, based on unigrams
         bleu_score = nltk.translate.bleu_score.sentence_bleu([reference_tokens], generated_tokens, weights=(1, 0, 0, 0))
@@ -54,10 +56,10 @@ def weights_matrix(vocab, emb_dim, glove_embedding):
     return weights_matrix
 
 
-def img_denorm(img, mean, std):
-    #for ImageNet the mean and std are:
-    #mean = np.asarray([ 0.485, 0.456, 0.406 ])
-    #std = np.asarray([ 0.229, 0.224, 0.225 ])
+def img_denorm(img, mean=IMAGENET_MEAN, std=IMAGENET_STD):
+    #for ImageNet the mean and std are the constants of batch_transforms.py
+    mean = np.asarray(mean)
+    std = np.asarray(std)
 
     denormalize = transforms.Normalize((-1 * mean / std), (1.0 / std))
 